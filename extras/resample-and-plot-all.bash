@@ -10,7 +10,7 @@ do
 		do
 				for precip in L H
 				do
-						python -m kcs.resample  @extra-all-nlpoint.list --ranges step2ranges.toml --steering steering.csv --penalties penalties.toml --relative pr -vv --nstep3 12  --precip-scenario L 4 --precip-scenario H 8 --scenario $scenario $epoch $precip --indices-out indices_${scenario}_${epoch}_${precip}.h5 --resamples-out resamples_${scenario}_${epoch}_${precip}.h5 &
+						python -m kcs.resample  @extra-all-nlpoint.list --ranges step2ranges.toml --steering steering.csv --penalties penalties.toml --relative pr -vv --nstep3 12  --precip-scenario L 4 --precip-scenario H 8 --scenario $scenario $epoch $precip --indices-out indices_${scenario}_${epoch}_${precip}.h5 --resamples-out resamples_${scenario}_${epoch}_${precip}.h5 --csv &
 				done
 		done
 		# Run only four processes at a time.
@@ -92,17 +92,9 @@ do
 done
 
 
-for epoch in 2050 2085
-do
-		for scenario in G W
-		do
-				for precip in L H
-				do
-						python -m kcs.resample  @ecearth-all-nlpoint-averaged.list  --steering steering.csv --relative pr -vvv  --precip-scenario L 4 --precip-scenario H 8 --scenario $scenario $epoch $precip --indices-out indices_${scenario}_${epoch}_${precip}.h5 --resamples-out resamples_${scenario}_${epoch}_${precip}.h5 &
-				done
-		done
-		wait  # run a maximum of four calculations at the same time
-done
+# All (eight) scenarios are run in parallel, within a single process
+# that reads and segments the data only once.
+python -m kcs.resample  @ecearth-all-nlpoint-averaged.list  --steering steering.csv --relative pr -vvv  --precip-scenario L 4 --precip-scenario H 8 --nproc 8 --indices-out indices.h5 --resamples-out resamples.h5 --csv
 
 
 for epoch in 2050 2085
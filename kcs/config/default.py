@@ -68,6 +68,8 @@ precip = "H"
 # Define areas of interest
 # Use w, e, s, n identifiers in a inline-table/map/dict for a rectangular area
 # Or lat, lon in a inline-table/map/dict for a single point
+# Or points, with a list of [lat, lon] pairs, for multiple points
+# (for example, stations), e.g. {points = [[51.25, 6.25], [52.1, 5.18]]}
 # Or the special value "global"
 # Values for w/e/s/n/lat/lon should all be floating point.
 # Shapefiles and masks are not yet supported.
@@ -109,6 +111,14 @@ historical_experiment = "historical"
 
 [data.extraction]
 template = "data/{var}-{area}-averaged/{filename}.nc"
+# Directory to store (area-weighted) regridding weights, for use by
+# later runs on the same grid, for example "data/regrid-weights".
+# By default (an empty string), the weights are only kept in memory,
+# for the files of a single run. The files are named after the cell
+# bounds of both grids, so grids that differ only in their bounds get
+# separate files. Files are never removed: delete the directory to
+# clear it.
+regrid_weights = ""
 
 
 [data.filenames]
@@ -296,9 +306,36 @@ nsample = 10_000
 
 # Number of simultaneous processes for the calculations of step 1.
 # Note that for relatively few input runs (< 12), the overhead
-# generally costs more than multiprocessing wins.
+# generally costs more than multiprocessing wins. With step1_method =
+# "auto", step 1 only uses multiple processes if that is estimated to
+# be faster.
 nproc = 1
 
+# Algorithm for step 1:
+# - "full": score all resamples, and sort them. Memory usage scales with
+#   the number of resamples (nruns^nsections).
+# - "stream": score the resamples in chunks, keeping only the best
+#   nstep1 resamples. Memory usage scales with nstep1 and chunksize.
+# - "mitm": find the best nstep1 resamples with a meet-in-the-middle
+#   search. Time and memory scale with nruns^(nsections/2), which makes
+#   larger ensembles and more sections practical. Resamples whose
+#   scores differ only by rounding errors may be ranked differently
+#   than with the other methods.
+# - "index": sort the averages of all resamples once per period, and
+#   find the best nstep1 resamples for each precipitation target with a
+#   binary search. Useful for many targets (subscenarios) per period.
+# - "auto": estimate the memory use and running time of the above
+#   methods, with and without multiprocessing, and use the fastest
+#   method that fits within memory_limit. The choice depends on
+#   timings on the current machine, so the method used (and for
+#   "mitm", the ranking of near-ties) may differ between runs.
+step1_method = "full"
+# Number of resamples scored at once in step 1
+chunksize = 100_000
+# Memory (in GB) that the "auto" step 1 method may use; 0 means half
+# of the physical memory
+memory_limit = 0
+
 # TOML file that defines the percentiles ranges used in step 2
 step2_conditions = "step2.toml"
 
@@ -310,4 +347,30 @@ step2_conditions = "step2.toml"
 # All penalties should be floating point numbers.
 penalties = {1 = 0.0, 2 = 0.0, 3 = 1.0, 4 = 5.0}
 
+# Algorithm for step 3:
+# - "random": Monte-Carlo sampling of nsample sets of resamples
+# - "exact": score all possible sets of resamples
+# - "anneal": simulated annealing, swapping one resample per step, for nsample steps
+# - "auto": "exact" if the number of possible sets is at most
+#   step3_exact_limit, "anneal" otherwise
+step3_method = "random"
+step3_exact_limit = 1_000_000
+# Number of independent step 3 searches ("chains"), run in parallel
+# with nproc processes; the best result is kept. Each chain searches
+# with nsample samples or steps; 0 means one chain per process
+# (nproc). With a given seed (the --seed option), results depend on
+# the number of chains, but not on nproc: set step3_nchains to a
+# fixed number to reproduce results with a different nproc.
+step3_nchains = 0
+
+# Calculation of the statistics (mean and percentiles) of the final resamples:
+# - "exact": from all values of the selected segments
+# - "sketch": from the sum of histograms of the selected segments. This
+#   is much faster, and uses far less memory, for long (e.g. daily)
+#   time series. The mean is exact; the percentiles are accurate to
+#   within sketch_error times the data range (of each variable, season
+#   and period).
+statistics_method = "exact"
+sketch_error = 0.001
+
 '''
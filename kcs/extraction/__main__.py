@@ -61,6 +61,9 @@ def parse_args():
     parser.add_argument('--tempdir')
     parser.add_argument('--subdir-per-realization', action='store_true')
     parser.add_argument('--ignore-common-warnings', action='store_true')
+    parser.add_argument('--time-window', type=int,
+                        help="Read and extract the data this many time steps at a time, "
+                        "to limit the memory use. The default is to read all data at once")
 
     args = parser.parse_args()
     setup_logging(args.verbosity)
@@ -88,7 +91,8 @@ def main():
          nproc=args.nproc, template=args.template,
          tempdir=args.tempdir,
          subdir_per_realization=args.subdir_per_realization,
-         ignore_common_warnings=args.ignore_common_warnings)
+         ignore_common_warnings=args.ignore_common_warnings,
+         time_window=args.time_window)
     logger.debug("%s finished", sys.argv[0])
 
 
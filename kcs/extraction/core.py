@@ -7,6 +7,18 @@ subdirectoriees named after the variable and area (given by a template
 that follows Python formatted strings with variable names; the default
 is given in the `TEMPLATE` constant).
 
+When running multiple processes without saving the results, the
+extracted data are passed back to the main process through shared
+memory (Python 3.8 and later, on POSIX systems), or else through
+temporary files.
+
+With a time window, the data are read, and reduced to the areas, a
+fixed number of time steps at a time; the extracted windows are then
+concatenated. The peak memory use then depends on the size of the
+window, instead of on the length of the dataset (which, for daily
+data or realizations spread over multiple files, may not fit in
+memory).
+
 """
 
 import os
@@ -20,6 +32,16 @@ import re
 import multiprocessing
 import warnings
 import logging
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:   # Python < 3.8
+    shared_memory = None   # pylint: disable=invalid-name
+if os.name != 'posix':
+    # On Windows, a shared memory block is freed as soon as the worker
+    # closes its handle, and there is no resource tracker to keep it
+    shared_memory = None   # pylint: disable=invalid-name
+import numpy as np
+import dask.array as da
 import iris
 from ..utils.io import load_cube
 from ..utils.coord import fixcoords, extract_areas, create_grid
@@ -29,6 +51,12 @@ from ..config import default_config
 
 Data = namedtuple('Data', ['path', 'realization', 'area', 'cube'])
 
+# An extracted cube, passed from a worker process through shared
+# memory: the name, dtype and shape of the shared memory buffer, whether
+# a mask follows the data in the buffer, and a copy of the cube with
+# lazy (placeholder) data, for the metadata
+SharedCube = namedtuple('SharedCube', ['name', 'dtype', 'shape', 'masked', 'template'])
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
@@ -53,9 +81,87 @@ def get_varname(path):  # pylint: disable=inconsistent-return-statements
         return match.group('var')
 
 
+def to_shared_memory(cube):
+    """Copy the data of a cube into a new shared memory buffer
+
+    Returns a `SharedCube` record, which is small enough to be passed
+    between processes; `from_shared_memory` turns it back into a cube.
+
+    """
+
+    data = cube.data
+    values = np.ma.getdata(data)
+    mask = np.ma.getmaskarray(data) if np.ma.isMaskedArray(data) else None
+    size = values.nbytes + (mask.nbytes if mask is not None else 0)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    buffer = np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)
+    buffer[...] = values
+    if mask is not None:
+        buffer = np.ndarray(mask.shape, dtype=bool, buffer=shm.buf, offset=values.nbytes)
+        buffer[...] = mask
+    del buffer   # Release the buffer, so that the shared memory can be closed
+    template = cube.copy(data=da.zeros(values.shape, dtype=values.dtype))
+    shm.close()
+    return SharedCube(shm.name, values.dtype.str, values.shape, mask is not None, template)
+
+
+def from_shared_memory(record):
+    """Create a cube from a `SharedCube` record, and free its shared memory"""
+
+    shm = shared_memory.SharedMemory(name=record.name)
+    try:
+        values = np.ndarray(record.shape, dtype=record.dtype, buffer=shm.buf).copy()
+        if record.masked:
+            mask = np.ndarray(record.shape, dtype=bool, buffer=shm.buf,
+                              offset=values.nbytes).copy()
+            values = np.ma.array(values, mask=mask)
+    finally:
+        shm.close()
+        shm.unlink()
+    cube = record.template
+    cube.data = values
+    return cube
+
+
+def extract_windows(cube, time_window, areas, **kwargs):
+    """Extract the areas from a cube, `time_window` time steps at a time
+
+    Other keyword arguments are passed on to `extract_areas`. The cube
+    should have lazy data, so that only the data of a single window is
+    read into memory at once.
+
+    Returns a dict with the extracted cubes, as `extract_areas`.
+
+    """
+
+    if time_window < 1:
+        raise ValueError(f"time window should be at least 1, not {time_window}")
+    dim, = cube.coord_dims('time')
+    ntimes = cube.shape[dim]
+    windows = defaultdict(list)
+    for start in range(0, ntimes, time_window):
+        logger.debug("Extracting time steps %d to %d of %d",
+                     start, min(start + time_window, ntimes), ntimes)
+        index = tuple(slice(start, start + time_window) if i == dim else slice(None)
+                      for i in range(cube.ndim))
+        for name, excube in extract_areas(cube[index], areas=areas, **kwargs).items():
+            windows[name].append(excube)
+
+    cubes = {}
+    for name in areas:
+        if any(excube is None for excube in windows[name]):
+            cubes[name] = None
+        elif len(windows[name]) == 1:
+            cubes[name] = windows[name][0]
+        else:
+            cubes[name] = iris.cube.CubeList(windows[name]).concatenate_cube()
+    return cubes
+
+
 def process_single(path, areas, targetgrid=None, save_result=True,
                    average_area=True, gridscheme='area', template=None,
-                   multiprocess=False, tempdir=None, ignore_common_warnings=False):
+                   multiprocess=False, tempdir=None, ignore_common_warnings=False,
+                   time_window=None):
     """DUMMY DOCSTRING"""
 
     if template is None:
@@ -64,12 +170,12 @@ def process_single(path, areas, targetgrid=None, save_result=True,
         realizations = set(get_realization_from_path(p) for p in path)
         if len(realizations) > 1:
             raise ValueError("multiple realizations inside subdir "
-                             "{path[0].parent}")
+                             f"{path[0].parent}")
         realization = realizations.pop()
     else:
         realization = get_realization_from_path(path)
     logger.debug("Realization %d for %s", realization, path)
-    varname = get_varname(path)
+    varname = get_varname(path[0] if isinstance(path, list) else path)
     with warnings.catch_warnings():
         if ignore_common_warnings:
             warnings.filterwarnings("ignore", category=UserWarning,
@@ -98,8 +204,12 @@ def process_single(path, areas, targetgrid=None, save_result=True,
         if ignore_common_warnings:
             warnings.filterwarnings("ignore", category=UserWarning,
                                     message="Using DEFAULT_SPHERICAL_EARTH_RADIUS")
-        cubes = extract_areas(cube, areas=areas, targetgrid=targetgrid,
-                              average_area=average_area, gridscheme=gridscheme)
+        if time_window:
+            cubes = extract_windows(cube, time_window, areas=areas, targetgrid=targetgrid,
+                                    average_area=average_area, gridscheme=gridscheme)
+        else:
+            cubes = extract_areas(cube, areas=areas, targetgrid=targetgrid,
+                                  average_area=average_area, gridscheme=gridscheme)
     assert len(cubes) == len(areas)
 
     data = []
@@ -123,6 +233,11 @@ def process_single(path, areas, targetgrid=None, save_result=True,
                             area, realization, outpath)
                 iris.save(cube, outpath)
                 data.append(Data(outpath, realization, area, cube))
+    elif multiprocess and shared_memory is not None:
+        # Pass the data to the main process through shared memory,
+        # instead of pickling it
+        data = [Data(None, realization, area, to_shared_memory(cube))
+                for area, cube in cubes.items()]
     elif multiprocess:  # We're using multiple processes in separate threads
         # We're saving the output to a temporary file
         # The data is generally too large to pass directly to the main thread,
@@ -143,14 +258,17 @@ def process_single(path, areas, targetgrid=None, save_result=True,
         data = [Data(None, realization, area, cube) for area, cube in cubes.items()]
 
     if multiprocess:  # Ensure no cubes are passed back to the main thread
-        data = [Data(item.path, item.realization, item.area, None) for item in data]
+        data = [Data(item.path, item.realization, item.area,
+                     item.cube if isinstance(item.cube, SharedCube) else None)
+                for item in data]
 
     return data
 
 
 def process(paths, areas, regrid=False, save_result=True, average_area=True,
             gridscheme='area', nproc=1, template=None, tempdir=None,
-            subdir_per_realization=False, ignore_common_warnings=False):
+            subdir_per_realization=False, ignore_common_warnings=False,
+            time_window=None):
     """DUMMY DOCSTRING"""
 
     if template is None:
@@ -169,10 +287,16 @@ def process(paths, areas, regrid=False, save_result=True, average_area=True,
                              save_result=save_result, average_area=average_area,
                              gridscheme=gridscheme, template=template,
                              multiprocess=(nproc > 1), tempdir=tempdir,
-                             ignore_common_warnings=ignore_common_warnings)
+                             ignore_common_warnings=ignore_common_warnings,
+                             time_window=time_window)
     if nproc == 1:
         data = list(itertools.chain.from_iterable(map(func, paths)))
     else:  # Need maxtaskperchild, to avoid multiprocessing getting stuck
+        if shared_memory is not None and not save_result:
+            # Start the resource tracker here, to be shared by the
+            # workers; otherwise, each worker starts its own, which
+            # removes the worker's shared memory when the worker exits
+            resource_tracker.ensure_running()
         with multiprocessing.Pool(nproc, maxtasksperchild=1) as pool:
             data = list(itertools.chain.from_iterable(pool.map(func, paths)))
     return data
@@ -180,7 +304,7 @@ def process(paths, areas, regrid=False, save_result=True, average_area=True,
 
 def calc(paths, areas, regrid=False, save_result=True, average_area=True, nproc=1,
          template=None, tempdir=None, subdir_per_realization=False,
-         ignore_common_warnings=False):
+         ignore_common_warnings=False, time_window=None):
     """DUMMY DOCSTRING"""
 
     if template is None:
@@ -192,13 +316,18 @@ def calc(paths, areas, regrid=False, save_result=True, average_area=True, nproc=
     data = process(paths, areas, regrid=regrid, save_result=save_result, average_area=average_area,
                    nproc=nproc, template=template, tempdir=tempdir,
                    subdir_per_realization=subdir_per_realization,
-                   ignore_common_warnings=ignore_common_warnings)
+                   ignore_common_warnings=ignore_common_warnings,
+                   time_window=time_window)
 
     # Handle data post-processing, so we can return the data to the caller
     # Data files were not passed when using multiprocessing: files may be
     # too large for, or incompatible with, the pickling protocol used
     # by multiprocessing. We'll have to reload the data from disk instead.
-    if nproc > 1:
+    if nproc > 1 and not save_result and shared_memory is not None:
+        logger.debug("Collecting data from shared memory in main thread")
+        data = [Data(None, item.realization, item.area, from_shared_memory(item.cube))
+                for item in data]
+    elif nproc > 1:
         logger.debug("Reloading files in main thread")
         data = [Data(item.path, item.realization, item.area, iris.load_cube(str(item.path)))
                 for item in data]
@@ -26,6 +26,8 @@ import logging
 import pathlib
 import itertools
 import json
+import queue
+import threading
 import toml
 import numpy as np
 import pandas as pd
@@ -36,7 +38,9 @@ from ..utils.logging import setup as setup_logging
 from ..utils.atlist import atlist
 from ..utils.attributes import get as get_attrs
 from ..config import read_config, default_config
-from .core import calc
+from .core import calc, prepare_scenarios
+from .plan import plan_step1
+from . import shards
 
 
 STATS = ['mean', '5', '10', '25', '50', '75', '90', '95']
@@ -106,67 +110,189 @@ def read_steering_target(filename, scenarios, scenario_selection=None):
 
 def save_indices_h5(filename, indices):
     """Save the (resampled) array of indices in a HDF5 file"""
-    h5file = h5py.File(filename, 'a')
-    for key, value in indices.items():
-        name = "/".join(key)
-        try:
-            group = h5file[name]
-        except KeyError:
-            group = h5file.create_group(name)
-        for k, v in value['meta'].items():  # pylint: disable=invalid-name
-            # Transforms a dict to str so it can be saved in HDF 5
-            group.attrs[k] = json.dumps(v) if isinstance(v, (dict, list)) else v
-        if 'control' in group:
-            del group['control']
-        group.create_dataset('control', data=value['data']['control'])
-        if 'future' in group:
-            del group['future']
-        group.create_dataset('future', data=value['data']['future'])
-
-
-def save_resamples(filename, diffs, as_csv=True):
-    """Save the resampled data, that is, the changes (differences) between
-    epochs, to a HDF5 file
-
-    With `as_csv` set to `True`, save each individual
+    with h5py.File(filename, 'a') as h5file:
+        for key, value in indices.items():
+            name = "/".join(key)
+            try:
+                group = h5file[name]
+            except KeyError:
+                group = h5file.create_group(name)
+            for k, v in value['meta'].items():  # pylint: disable=invalid-name
+                # Transforms a dict to str so it can be saved in HDF 5
+                group.attrs[k] = json.dumps(v) if isinstance(v, (dict, list)) else v
+            if 'control' in group:
+                del group['control']
+            group.create_dataset('control', data=value['data']['control'])
+            if 'future' in group:
+                del group['future']
+            group.create_dataset('future', data=value['data']['future'])
+
+
+class ResamplesWriter:
+    """Write the resampled data of each scenario, from a background thread
+
+    For each scenario, the changes (differences) between epochs, for
+    all variables and seasons, are stored as a single table: a
+    chunked and compressed 'diff' dataset, with one row per resampled
+    run, for each variable and season, and one column per statistic.
+    The 'index' dataset labels each row with its "variable/season",
+    and the 'keys' dataset names the columns (statistics).
+
+    With `as_csv` set to `True`, also save each individual
     scenario-variable-season combination as a separate CSV file, named
     after the combination (and `resampled_` prepended). These CSV
     files can be used with kcs.change_perc.plot, with the --scenario
     option.
 
-    Files are always overwritten if they exist.
+    The file is created (and overwritten, if it exists) when the first
+    result is written. Use as a context manager, so that all results
+    are written, and the file closed, at the end:
+
+        with ResamplesWriter('resamples.h5') as writer:
+            for key, diffs in ...:
+                writer.write(key, diffs)   # returns immediately
 
     """
 
-    h5file = h5py.File(filename, 'w')
-    for key, value in diffs.items():
-        keyname = "/".join(key)
-        for var, value2 in value.items():
-            for season, diff in value2.items():
-                name = f"{keyname}/{var}/{season}"
-                if name not in h5file:
-                    h5file.create_group(name)
-                group = h5file[name]
+    def __init__(self, filename, as_csv=False):
+        self.filename = filename
+        self.as_csv = as_csv
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An error of the writer should not mask the exception that
+        # ended the with-block
+        self.close(reraise=exc_type is None)
+
+    def write(self, key, diffs):
+        """Queue the results of scenario `key` for writing
+
+        `diffs` is a nested dict with the variables and seasons as
+        keys, and a DataFrame with the statistics as values.
+
+        """
+
+        if self._error is not None:
+            raise self._error
+        if self._thread is None:
+            # Only start (and open the file) now, so that an existing
+            # file is kept until there are results to replace it
+            self._thread = threading.Thread(target=self._run, name='resamples-writer',
+                                            daemon=True)
+            self._thread.start()
+        self._queue.put((key, diffs))
+
+    def close(self, reraise=True):
+        """Wait until all results are written, and close the file
+
+        An error while writing is raised here, or only logged if
+        `reraise` is False.
+
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            if reraise:
+                raise self._error
+            logger.error("Writing the resampled data to %s failed: %s", self.filename,
+                         self._error)
+
+    def _run(self):
+        try:
+            with h5py.File(self.filename, 'w') as h5file:
+                while True:
+                    item = self._queue.get()
+                    if item is None:
+                        break
+                    self._write(h5file, *item)
+        except Exception as exc:   # pylint: disable=broad-except
+            # Reraised in the main thread
+            self._error = exc
+            # Keep consuming, so that `close` does not block
+            while self._queue.get() is not None:
+                pass
+
+    def _write(self, h5file, key, diffs):
+        index = []
+        tables = []
+        for var, value in diffs.items():
+            for season, diff in value.items():
+                assert list(diff.columns) == STATS
+                index.extend([f"{var}/{season}"] * len(diff))
+                tables.append(diff.values)
+                if self.as_csv:
+                    csvfile = "_".join(key)
+                    csvfile = f"resampled_{csvfile}_{var}_{season}.csv"
+                    diff.to_csv(csvfile, index=False)
+        table = np.concatenate(tables)
 
-                # Remove existing datasets, to avoid problems
-                # (we probably could overwrite them; this'll work just as easily)
-                for k in {'diff', 'mean', 'std', 'keys'}:
-                    if k in group:
-                        del group[k]
+        group = h5file.create_group("/".join(key))
+        group.create_dataset('diff', data=table, chunks=True, compression='gzip',
+                             shuffle=True)
+        # pylint: disable=no-member
+        group.create_dataset('index', data=index, dtype=h5py.string_dtype(),
+                             compression='gzip')
+        group.create_dataset('keys', data=STATS, dtype=h5py.string_dtype())
+        logger.debug("Wrote resampled data for %s to %s", "/".join(key), self.filename)
 
-                group.create_dataset('diff', data=diff.values)
-                group.create_dataset('mean', data=diff.mean(axis=0))
-                group.create_dataset('std', data=diff.std(axis=0))
-                # pylint: disable=no-member
-                dataset = group.create_dataset('keys', (len(STATS),), dtype=h5py.string_dtype())
-                dataset[:] = STATS
 
-                assert len(STATS) == len(diff.mean(axis=0))
+def save_resamples(filename, diffs, as_csv=False):
+    """Save the resampled data, that is, the changes (differences) between
+    epochs, to a HDF5 file
 
-                if as_csv:
-                    csvfile = "_".join(key)
-                    csvfile = f"resampled_{csvfile}_{var}_{season}.csv"
-                    diff.to_csv(csvfile, index=False)
+    See `ResamplesWriter` for the file layout, and `as_csv`.
+
+    """
+
+    with ResamplesWriter(filename, as_csv=as_csv) as writer:
+        for key, value in diffs.items():
+            writer.write(key, value)
+
+
+def load_resamples(filename):
+    """Read the resampled data, as written by `ResamplesWriter`
+
+    Returns a nested dict with the scenario keys, variables and
+    seasons as keys, and a DataFrame with the statistics as values;
+    the same as the resampled data returned by `calc`.
+
+    Files in the earlier layout, with separate 'diff', 'mean', 'std'
+    and 'keys' datasets in a group per scenario, variable and season
+    (such as "2050/G/H/pr/djf"), are read as well.
+
+    """
+
+    def text(value):
+        # Depending on the h5py version, strings are read as bytes or str
+        return value.decode() if isinstance(value, bytes) else value
+
+    diffs = {}
+    with h5py.File(filename, 'r') as h5file:
+        def visit(name, item):
+            if isinstance(item, h5py.Group) and 'diff' in item:
+                table = item['diff'][()]
+                columns = [text(key) for key in item['keys'][()]]
+                if 'index' not in item:
+                    # Earlier layout: a group per variable and season
+                    *key, var, season = name.split('/')
+                    diffs.setdefault(tuple(key), {}).setdefault(var, {})[season] = \
+                        pd.DataFrame(table, columns=columns)
+                    return
+                index = np.array([text(key) for key in item['index'][()]])
+                diffs[tuple(name.split('/'))] = results = {}
+                for label in dict.fromkeys(index):
+                    var, season = label.split('/')
+                    results.setdefault(var, {})[season] = pd.DataFrame(
+                        table[index == label], columns=columns)
+        h5file.visititems(visit)
+    return diffs
 
 
 def str2bool(string):
@@ -204,6 +330,42 @@ def parse_args():
                         help="number of S3 resamples to keep")
     parser.add_argument('--nsample', type=int,
                         help="Monte Carlo sampling number")
+    parser.add_argument('--step1-method', choices=['full', 'stream', 'mitm', 'index', 'auto'],
+                        help="Algorithm for step 1: score and sort all resamples ('full'), "
+                        "keep only the best nstep1 resamples while scoring the resamples "
+                        "in chunks ('stream'), search for the best nstep1 resamples with "
+                        "a meet-in-the-middle algorithm ('mitm'), or sort the resample "
+                        "averages once per period, and search that for each target ('index'). "
+                        "'stream' and 'mitm' use far less memory, and 'mitm' is also much "
+                        "faster for large ensembles; 'index' is fastest for many targets. "
+                        "'auto' picks the method (and whether to use multiple processes) "
+                        "with the lowest estimated running time, from timings on the current "
+                        "machine; see --plan. The default is 'full'.")
+    parser.add_argument('--chunksize', type=int,
+                        help="Number of resamples to score at once in step 1")
+    parser.add_argument('--step3-method', choices=['random', 'exact', 'anneal', 'auto'],
+                        help="Algorithm for step 3: random sampling ('random'), scoring all "
+                        "possible sets of resamples ('exact'), simulated annealing ('anneal'), "
+                        "or 'exact' when the number of possible sets is small enough and "
+                        "'anneal' otherwise ('auto'). --nsample sets the number of samples "
+                        "or annealing steps.")
+    parser.add_argument('--nchains', type=int,
+                        help="Number of independent step 3 searches, each with --nsample "
+                        "samples or steps, run in parallel with --nproc processes. The best "
+                        "result is kept. The default (0, unless configured otherwise) is one "
+                        "search per process. Note that the results depend on the number of "
+                        "searches, not on --nproc: give --nchains explicitly to reproduce "
+                        "results with a different --nproc.")
+    parser.add_argument('--seed', type=int,
+                        help="Seed for the random number generator of step 3. For a given seed "
+                        "and --nchains, the results are reproducible, independent of --nproc.")
+    parser.add_argument('--statistics-method', choices=['exact', 'sketch'],
+                        help="Calculate the percentiles of the final resamples from all values "
+                        "('exact'), or from histograms of each segment ('sketch'), which is much "
+                        "faster and uses less memory for daily data. See --sketch-error.")
+    parser.add_argument('--sketch-error', type=float,
+                        help="Maximum error of the percentiles with --statistics-method "
+                        "sketch, as a fraction of the data range.")
     parser.add_argument('--reference-period', nargs=2, type=int,
                         help="Reference period given by start and end year (inclusive)")
     parser.add_argument('--nsections', type=int,
@@ -220,8 +382,39 @@ def parse_args():
                         "for the indices.")
     parser.add_argument('--resamples-out', default="resamples.h5", help="HDF 5 output file "
                         "for the resampled data.")
-
-    parser.add_argument('-N', '--nproc', type=int, help="Number of simultaneous processes.")
+    parser.add_argument('--csv', action='store_true', help="Also write the resampled data of "
+                        "each scenario, variable and season to a CSV file in the current "
+                        "directory, named 'resampled_<epoch>_<scenario>_<subscenario>_<var>_"
+                        "<season>.csv'. These can be used with kcs.change_perc.plot.")
+
+    parser.add_argument('--cache-dir', help="Directory to cache the results of the "
+                        "individual steps in. A rerun with the same inputs then resumes from the "
+                        "latest step whose parameters are unchanged. Step 3 results are only "
+                        "cached when --seed is given.")
+
+    parser.add_argument('--memmap-dir', help="Directory to store the segmented data in, as "
+                        "memory-mapped files, instead of keeping these in memory. Runs with the "
+                        "same input files (by name, modification time and size) and --nsections "
+                        "reuse these files; concurrent runs on the same machine then also share "
+                        "their memory.")
+
+    parser.add_argument('--shard', help="Only calculate step 1, for shard I out of N of "
+                        "the combination space, given as 'I/N' (I from 1 to N). The best "
+                        "nstep1 resamples of this shard are written to --shard-out, after "
+                        "which the program exits. Run all N shards (as separate jobs), then "
+                        "continue with --merge-shards.")
+    parser.add_argument('--shard-out', default="shard-{shard}-of-{nshards}.npz",
+                        help="Output file for --shard. '{shard}' and '{nshards}' are replaced "
+                        "by the shard number and the number of shards.")
+    parser.add_argument('--merge-shards', nargs='+', metavar='FILE', help="Merge the step 1 "
+                        "results of all shards, and continue from there with steps 2 and 3.")
+
+    parser.add_argument('--plan', action='store_true', help="Print the estimated memory use "
+                        "and running time of the step 1 methods, and the method chosen with "
+                        "--step1-method auto, then exit without calculating anything.")
+
+    parser.add_argument('-N', '--nproc', type=int, help="Number of simultaneous processes. "
+                        "Multiple scenarios are processed in parallel, one per process.")
 
     args = parser.parse_args()
     setup_logging(args.verbosity)
@@ -240,6 +433,26 @@ def parse_args():
         args.nsample = default_config['resampling']['nsample']
     if args.nsections is None:
         args.nsections = default_config['resampling']['nsections']
+    if args.step1_method is None:
+        args.step1_method = default_config['resampling']['step1_method']
+    if args.chunksize is None:
+        args.chunksize = default_config['resampling']['chunksize']
+    if args.step3_method is None:
+        args.step3_method = default_config['resampling']['step3_method']
+    if args.nchains is None:
+        args.nchains = default_config['resampling']['step3_nchains']
+    if args.statistics_method is None:
+        args.statistics_method = default_config['resampling']['statistics_method']
+    if args.sketch_error is None:
+        args.sketch_error = default_config['resampling']['sketch_error']
+
+    if args.shard:
+        if args.merge_shards:
+            parser.error("--shard and --merge-shards are mutually exclusive")
+        try:
+            args.shard = shards.parse_shard(args.shard)
+        except ValueError as exc:
+            parser.error(str(exc))
 
     args.paths = [pathlib.Path(filename) for filename in args.files]
 
@@ -281,12 +494,45 @@ def main():
 
     steering_table = read_steering_target(args.steering, args.pr_scenarios, args.scenario)
 
-    indices, diffs = calc(dataset, steering_table, args.conditions, args.penalties,
+    if args.plan:
+        nruns = dataset.groupby('var').size()
+        if nruns.nunique() != 1:
+            raise ValueError("Datasets are not the same length for different variables")
+        nperiods = len({tuple(map(int, period)) for period in steering_table['period']})
+        _, report = plan_step1(int(nruns.iloc[0]), args.nsections, len(steering_table),
+                               nperiods, nstep1=args.nstep1, nproc=args.nproc,
+                               chunksize=args.chunksize)
+        print(f"Step 1 for {len(steering_table)} scenario(s), {nperiods} period(s), "
+              f"{int(nruns.iloc[0])} runs and {args.nsections} sections:")
+        print(report)
+        return
+
+    if args.shard:
+        shard, nshards = args.shard
+        _, indices, means = prepare_scenarios(dataset, steering_table, args.nsections,
+                                              args.reference_period, directory=args.memmap_dir)
+        results = shards.calc_shard(means, indices, steering_table, shard, nshards,
+                                    nstep1=args.nstep1, nproc=args.nproc,
+                                    chunksize=args.chunksize)
+        shards.save(args.shard_out.format(shard=shard, nshards=nshards), results,
+                    shard, nshards)
+        return
+
+    s1_shards = shards.load(args.merge_shards) if args.merge_shards else None
+    # The resampled data of each scenario are written while the next
+    # scenarios are still being calculated
+    with ResamplesWriter(args.resamples_out, as_csv=args.csv) as writer:
+        indices, _ = calc(dataset, steering_table, args.conditions, args.penalties,
                           args.nstep1, args.nstep3, args.nsample, args.nsections,
-                          args.reference_period, relative=args.relative, nproc=args.nproc)
+                          args.reference_period, relative=args.relative, nproc=args.nproc,
+                          step1_method=args.step1_method, chunksize=args.chunksize,
+                          step3_method=args.step3_method, seed=args.seed,
+                          nchains=args.nchains, cache_dir=args.cache_dir,
+                          s1_shards=s1_shards, statistics_method=args.statistics_method,
+                          sketch_error=args.sketch_error, memmap_dir=args.memmap_dir,
+                          callback=writer.write)
 
     save_indices_h5(args.indices_out, indices)
-    save_resamples(args.resamples_out, diffs)
 
 
 if __name__ == '__main__':
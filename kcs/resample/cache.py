@@ -0,0 +1,100 @@
+"""On-disk cache for the results of the resampling steps
+
+The results of each step (S1, S2 and S3) of `find_resamples` are
+stored in a directory, as a NumPy .npz file with a 'control' and a
+'future' array. The file name contains the step and a SHA-256 hash of
+everything that determines the result: the inputs and parameters of
+the step itself, and (through its hash) of the previous step. When
+only a parameter of a later step changes (for example, the step 3
+penalties), a new run then resumes from the latest step that is still
+valid, instead of starting from step 1.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import numpy as np
+from .segments import PERIODS
+
+
+logger = logging.getLogger(__name__)   # pylint: disable=invalid-name
+
+
+def hash_key(*parts):
+    """Return a hexadecimal SHA-256 hash of `parts`
+
+    The parts can be NumPy arrays (hashed by dtype, shape and
+    contents) or any JSON-serializable value (other values are
+    hashed by their `repr`).
+
+    """
+
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(f"{part.dtype.str}{part.shape}".encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=repr).encode())
+        # Separate the parts, so that they can't run into each other
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class StageCache:
+    """Directory with cached step results
+
+    Usage example:
+
+        cache = StageCache('cache')
+        key = hash_key('s1', means.values, target, nstep1)
+        result = cache.load('s1', key)
+        if result is None:
+            result = calculate_s1(...)
+            cache.save('s1', key, result)
+
+    """
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}('{self.directory}')"
+
+    def path(self, stage, key):
+        """Return the file path for the result of `stage` with `key`"""
+        return self.directory / f"{stage}-{key}.npz"
+
+    def load(self, stage, key):
+        """Return the cached result, or None if it is not available or invalid"""
+
+        path = self.path(stage, key)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                result = {period: data[period] for period in PERIODS}
+        except (OSError, ValueError, KeyError) as exc:
+            logger.warning("Ignoring invalid cache file %s: %s", path, exc)
+            return None
+        logger.info("Using cached %s results from %s", stage, path)
+        return result
+
+    def save(self, stage, key, result):
+        """Store the result of `stage` with `key`
+
+        The file is written under a temporary name first, so that an
+        interrupted run does not leave an incomplete cache file.
+
+        """
+
+        path = self.path(stage, key)
+        tmppath = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmppath, 'wb') as fh:
+            np.savez(fh, **{period: np.asarray(result[period]) for period in PERIODS})
+        os.replace(tmppath, path)
+        logger.debug("Stored %s results in %s", stage, path)
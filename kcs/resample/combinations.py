@@ -0,0 +1,108 @@
+"""The space of all possible resamples, without materializing it
+
+A resample takes, for each of the `nsections` sections of a period,
+the segment of one of `nsets` runs. All resamples together form the
+Cartesian product of `nsections` times `range(nsets)`, which grows
+rapidly: 16 runs and 6 sections already yield 16.7 million
+resamples, and an (int64) array of all these index rows takes about
+800 MB.
+
+Instead, a resample is identified by a single integer, its ID: the
+mixed-radix number (with base `nsets` for every digit) that has the
+run indices of the sections as its digits, the first section being
+the most significant digit. The IDs thus follow the order of
+`itertools.product`, and can be decoded into the run indices for
+each section when (and only for those rows where) these are needed.
+
+"""
+
+import numpy as np
+
+
+UINT_DTYPES = [np.uint8, np.uint16, np.uint32, np.uint64]
+
+
+def smallest_uint(maxvalue):
+    """Return the smallest unsigned integer dtype that can hold `maxvalue`"""
+
+    for dtype in UINT_DTYPES:
+        if maxvalue <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"{maxvalue} does not fit in a 64-bit unsigned integer")
+
+
+class Combinations:
+    """All `nsets`^`nsections` resamples, as integer IDs
+
+    The `dtype` attribute is the smallest dtype that fits any ID, and
+    `index_dtype` the smallest dtype that fits a run index (that is,
+    the values of the decoded rows).
+
+    Usage example:
+
+        combinations = Combinations(16, 6)
+        len(combinations)   # 16**6
+        rows = combinations.decode([0, 1, 16])
+        # [[0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0, 1], [0, 0, 0, 0, 1, 0]]
+        combinations.encode(rows)   # [0, 1, 16]
+
+    """
+
+    def __init__(self, nsets, nsections):
+        self.nsets = nsets
+        self.nsections = nsections
+        self.size = nsets ** nsections
+        self.dtype = smallest_uint(self.size - 1)
+        self.index_dtype = smallest_uint(nsets - 1)
+        # Place value of each digit (section); the last section varies fastest
+        self.weights = np.array([nsets ** i for i in reversed(range(nsections))],
+                                dtype=np.uint64)
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.nsets}, {self.nsections})"
+
+    def ids(self, start=0, stop=None):
+        """Return an array with the IDs from `start` up to (not including) `stop`"""
+
+        if stop is None:
+            stop = self.size
+        return np.arange(start, stop, dtype=self.dtype)
+
+    def chunks(self, chunksize, start=0, stop=None):
+        """Iterate over the IDs in consecutive ranges of (at most) `chunksize`
+
+        The chunks are `range` objects, which are cheap to create and
+        to pass to other processes; they can be passed to `decode` as
+        is.
+
+        """
+
+        if stop is None:
+            stop = self.size
+        for first in range(start, stop, chunksize):
+            yield range(first, min(first + chunksize, stop))
+
+    def decode(self, ids):
+        """Decode IDs into rows of run indices, one row per ID
+
+        `ids` can be an array (or list) of integers, or a `range`.
+
+        Returns an array with shape (len(ids), nsections).
+
+        """
+
+        if isinstance(ids, range):
+            ids = np.arange(ids.start, ids.stop, ids.step, dtype=np.uint64)
+        else:
+            ids = np.asarray(ids, dtype=np.uint64)
+        rows = (ids[:, np.newaxis] // self.weights) % np.uint64(self.nsets)
+        return rows.astype(self.index_dtype)
+
+    def encode(self, rows):
+        """Encode rows of run indices into IDs; the inverse of `decode`"""
+
+        rows = np.asarray(rows, dtype=np.uint64)
+        return (rows * self.weights).sum(axis=1).astype(self.dtype)
@@ -1,14 +1,22 @@
 """DUMMY DOCSTRING"""
 
-import math
-import itertools
-from datetime import datetime
-import multiprocessing
+import zlib
+import contextlib
 import logging
+import os
+import pathlib
 import numpy as np
 import pandas as pd
-import iris
 from ..config import default_config
+from .combinations import Combinations
+from .segments import SegmentMeans, PERIODS, segment_means
+from . import shared
+from . import shards
+from .cache import StageCache, hash_key
+from . import plan
+from . import sketch
+from .step1 import calculate_s1, calculate_s1_control
+from .step3 import calculate_s3
 
 
 ALLSEASONS = ['djf', 'mam', 'jja', 'son']
@@ -18,114 +26,243 @@ STATS = ['mean', '5', '10', '25', '50', '75', '90', '95']
 logger = logging.getLogger(__name__)   # pylint: disable=invalid-name
 
 
-def segment_data(cubes, period, control_period, nsections, seasons=None):
-    """Given a list of cubes (or CubeList), return a dict with periods and seasons extracted"""
+def read_runs(cubes):
+    """Read the year and season coordinates of all cubes
+
+    Returns a list with a (years, seasons, cube) tuple for each cube.
+    The data themselves are not read: `segment_period` reads them run
+    by run, for the time steps it needs only (see `read_run`).
+
+    """
+
+    return [(cube.coord('year').points, cube.coord('season').points, cube) for cube in cubes]
+
+
+def read_run(cube, start=0, stop=None):
+    """Read the data of a cube, for the time steps `start` up to `stop`
+
+    Time is the first dimension of the cube. Returns a 2D (time,
+    values) floating point array, with all values of a time step in
+    one row (a single value for time series), and masked values set
+    to NaN. The data are read through `core_data`, so that lazy data
+    stay lazy on the cube, and are not kept in memory.
+
+    """
+
+    values = cube.core_data()[start:stop]
+    if cube.has_lazy_data():
+        values = values.compute()
+    dtype = np.result_type(values.dtype, np.float32)
+    values = np.ma.filled(np.ma.asarray(values, dtype=dtype), np.nan)
+    return values.reshape(len(values), -1)
+
+
+def runs_key(runs, paths=None):
+    """Return a hash that identifies the input data of `runs`
+
+    With the `paths` of the input files of the runs, the hash derives
+    from the file names, modification times and sizes, and the data
+    are not read. Otherwise, the data are hashed one run at a time.
+
+    """
+
+    if paths is not None:
+        files = []
+        for path in paths:
+            stat = os.stat(path)
+            files.append([str(pathlib.Path(path).resolve()), stat.st_mtime_ns, stat.st_size])
+        return hash_key('files', files)
+    key = hash_key('data')
+    for years, seasons, cube in runs:
+        key = hash_key(key, years, seasons.astype(str), read_run(cube))
+    return key
+
+
+def segment_period(runs, years, nsections, seasons=None, directory=None, paths=None):
+    """Segment the data of all runs for a single period
+
+    `runs` is the output of `read_runs`, `years` the first and last
+    year (inclusive) of the period.
+
+    Returns a dict with the seasons as keys, and (nruns, nsections,
+    ntimes) arrays as values; see `segment_data`.
+
+    The data are read one run at a time, and only for the time steps
+    of the period. For cubes with other dimensions besides time, the
+    segments contain all values of their time steps.
+
+    If `directory` is given, the arrays are written to .npy files in
+    that directory, and returned as read-only memory-mapped arrays, so
+    that they don't need to fit in memory. The file names are derived
+    from the input files (`paths`, see `runs_key`) and the
+    segmentation, so that later or concurrent runs with the same
+    input reuse these files, and share their pages in memory.
+
+    """
 
     if seasons is None:
         seasons = ALLSEASONS
 
-    data = {season: {} for season in seasons}
-    # pragma pylint: disable=cell-var-from-loop
-    for key, years in zip(['control', 'future'], [control_period, period]):
-        # Chop each cube into n-year segments
-        span = (years[1] - years[0] + 1) // nsections
-        constraint = iris.Constraint(year=lambda point: years[0] <= point <= years[1])
-        logger.debug("Extraction %s period %s for all datasets", key, years)
-        excubes = [constraint.extract(cube) for cube in cubes]
+    # Number of values per time step, for each run
+    sizes = [int(np.prod(cube.shape[1:])) for _, _, cube in runs]
+    data = {}
+    if directory is not None:
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        runskey = runs_key(runs, paths)
+        files = {}
         for season in seasons:
-            logger.debug("Extraction season %s for all datasets", season)
-            constraint = iris.Constraint(season=lambda point: point == season)
-            season_cubes = [constraint.extract(cube) for cube in excubes]
-            logger.debug("Extracting %d-year segments for all datasets", span)
-            data[season][key] = np.array([
-                [iris.Constraint(year=lambda point: year <= point < year+span).extract(cube)
-                 for year in range(years[0], years[1], span)]
-                for cube in season_cubes], dtype=np.object)
-    # pragma pylint: enable=cell-var-from-loop
+            key = hash_key(runskey, list(years), nsections, season, sizes)
+            path = directory / f"segments-{key}.npy"
+            if path.exists():
+                logger.debug("Using segmented data from %s", path)
+                data[season] = np.load(path, mmap_mode='r')
+            files[season] = path
+    missing = [season for season in seasons if season not in data]
+
+    # Chop each run into n-year segments
+    span = (years[1] - years[0] + 1) // nsections
+    logger.debug("Extracting %d-year segments for period %s for all datasets", span, years)
+    indices = {}
+    segments = {}
+    tmppaths = {}
+    for season in missing:
+        indices[season] = [segment_indices(year, seasonpoints, years[0], span, nsections, season)
+                           for year, seasonpoints, _ in runs]
+        ntimes = max(len(index) * size for runindices, size in zip(indices[season], sizes)
+                     for index in runindices)
+        shape = (len(runs), nsections, ntimes)
+        dtype = np.result_type(runs[0][2].dtype, np.float32) if runs else np.float64
+        if directory is None:
+            segments[season] = np.full(shape, np.nan, dtype=dtype)
+        else:
+            # Write under a temporary name first, so that other runs
+            # never see an incomplete file
+            tmppaths[season] = files[season].with_name(f"{files[season].name}.{os.getpid()}.tmp")
+            segments[season] = np.lib.format.open_memmap(tmppaths[season], mode='w+',
+                                                         dtype=dtype, shape=shape)
+            segments[season][...] = np.nan
+
+    for i, (_, _, cube) in enumerate(runs):
+        used = [index for season in missing for index in indices[season][i] if len(index)]
+        if not used:
+            continue
+        start = min(index[0] for index in used)
+        values = read_run(cube, start, max(index[-1] for index in used) + 1)
+        for season in missing:
+            for j, index in enumerate(indices[season][i]):
+                segments[season][i, j, :len(index) * sizes[i]] = values[index - start].ravel()
+
+    for season in missing:
+        if directory is not None:
+            segments[season].flush()
+            del segments[season]
+            os.replace(tmppaths[season], files[season])
+            logger.debug("Stored segmented data in %s", files[season])
+            segments[season] = np.load(files[season], mmap_mode='r')
+        data[season] = segments[season]
+    return {season: data[season] for season in seasons}
 
-    return data
 
+def segment_data(cubes, period, control_period, nsections, seasons=None):
+    """Given a list of cubes (or CubeList), return a dict with periods and seasons extracted
 
-def create_indices(nsets, nsections):
-    """Create an array of indices for all possible resamples
+    The data of each cube are read once per period, for the time steps
+    of that period only; the segments are selected with index arrays
+    computed from the year and season coordinates.
+
+    The returned dict has the seasons as keys; each value is a dict
+    with a 'control' and a 'future' array. These arrays have shape
+    (ncubes, nsections, ntimes): the values of each n-year segment
+    for each cube (run). For cubes with other dimensions besides time
+    (such as multiple grid points), these are all values of the time
+    steps of the segment, so that the segment averages and statistics
+    are over all of them. Segments that are shorter than the longest
+    segment are padded with NaN; masked values are also set to NaN.
 
-    This results in an array with a shape of (nsets^nsections,
-    nsections). Each row is a separate resample, indexing the relevant
-    segment from a dataset i.
+    Each period is divided into `nsections` segments of equal length
+    (in years); any remaining years at the end are discarded.
 
     """
 
-    indices = list([range(nsets) for _ in range(nsections)])
-    indices = np.array(list(itertools.product(*indices)))
-    assert len(indices) == nsets**nsections, "incorrect number of generated indices"
+    if seasons is None:
+        seasons = ALLSEASONS
 
-    return indices
+    runs = read_runs(cubes)
+    data = {season: {} for season in seasons}
+    for key, years in zip(PERIODS, [control_period, period]):
+        for season, segments in segment_period(runs, years, nsections, seasons).items():
+            data[season][key] = segments
+
+    return data
+
+
+def segment_indices(year, season, start, span, nsections, selected_season):
+    """Return the time indices for each segment of a single run
+
+    `year` and `season` are the year and season coordinate values
+    along the time axis; the segments are `span` years long, starting
+    at year `start`, and contain only the time steps for
+    `selected_season`.
+
+    Returns a list with an array of time indices for each of the
+    `nsections` segments.
 
+    """
+
+    section = (np.asarray(year) - start) // span
+    valid = (np.asarray(season) == selected_season) & (section >= 0) & (section < nsections)
+    section = np.where(valid, section, -1)
+    return [np.flatnonzero(section == i) for i in range(nsections)]
 
-class Calculation:
-    """Class to calculate the difference between a calculated precipiation
-    change, and a target value
 
-    We use a class, so it can be used with multiprocessing: fixed
-    arguments are passed to the constructor, while the variable
-    argument (the subselection of the data) is passed to the call
-    method.
+def create_indices(nsets, nsections):
+    """Create the space of indices for all possible resamples
 
-    An alternative is the use of functools.partial.
+    This results in a `Combinations` object of size nsets^nsections,
+    where each resample is a single integer ID. The ID decodes to a
+    row of nsections run indices, the index for each section
+    indexing the relevant segment from a dataset i. The IDs follow
+    the order of `itertools.product`; the full array of index rows is
+    never created.
 
     """
 
-    def __init__(self, data, target):
-        self.data = data
-        self.target = target
-        self.cols = np.arange(data.shape[1])
+    indices = Combinations(nsets, nsections)
+    assert len(indices) == nsets**nsections, "incorrect number of generated indices"
 
-    def __call__(self, index):
-        return np.abs(self.data[index, self.cols].mean() - self.target)
+    return indices
 
 
 def calc_means(data, seasons=None):
     """Calculate the averages of all n-year segments, and store them in a
-    dataframe
+    `SegmentMeans` object
 
-    The dataframe columns correspond to the n-year segments (simply
-    numbered 0 to ndata-1).
-
-    The dataframe index consists of the variable, season and period
-    (control or future), and the individual datasets (runs) as a
-    multi-index.
+    The averages are indexed by variable, season and period (control
+    or future), and then by the individual datasets (runs) and the
+    n-year segments (simply numbered 0 to ndata-1).
 
     The values then, of course, are the averages for that specific
     n-year segment, variable, season, period and dataset.
 
+    Other statistics of the segments are calculated on request only,
+    by the returned object.
+
     """
 
     if seasons is None:
         seasons = ALLSEASONS
-    means = {}
-    std = {}
-    for var in data:
-        for season in seasons:
-            for period in ['control', 'future']:
-                item = data[var][season][period]
-                for i, cubelist in enumerate(item):
-                    means[(var, season, period, i)] = [cube.data.mean() for cube in cubelist]
-                    std[(var, season, period, i)] = [cube.data.std() for cube in cubelist]
-
-    df_mean = pd.DataFrame.from_dict(means, orient='index')
-    df_mean.index = pd.MultiIndex.from_tuples(means.keys(),
-                                              names=['var', 'season', 'period', 'run'])
-    df_mean = df_mean.sort_index()
+    variables = list(data)
+    values = np.array([
+        [[segment_means(data[var][season][period]) for period in PERIODS]
+         for season in seasons]
+        for var in variables])
 
-    df_std = pd.DataFrame.from_dict(std, orient='index')
-    df_std.index = pd.MultiIndex.from_tuples(means.keys(),
-                                             names=['var', 'season', 'period', 'run'])
-    df_std = df_std.sort_index()
+    return SegmentMeans(variables, seasons, values, data=data)
 
-    return df_mean, df_std
 
-
-def prepare_data(dataset, variables, period, control_period, nsections):
+def prepare_data(dataset, variables, period, control_period, nsections, cache=None,
+                 directory=None):
     """Prepare the data for a scenario
 
     - segment the data into nsections.
@@ -133,14 +270,37 @@ def prepare_data(dataset, variables, period, control_period, nsections):
     - calculate the means for variables and seasons of interest, for
       all individual ensemble runs, for each n-year period.
 
+    `cache` is an optional dict, in which the segmented data are kept
+    per variable, period and number of sections. Scenarios that share
+    a period (in particular the control period) then share its
+    segmentation, when called with the same `cache`.
+
+    With `directory`, the segmented data are memory-mapped from files
+    in that directory; see `segment_period`. The files are keyed on
+    the input files, if `dataset` has a 'path' column.
+
     """
 
+    if cache is None:
+        cache = {}
+
     data = {}
     ndata = set()
     for var in variables:
         cubes = dataset.loc[dataset['var'] == var, 'cube']
+        paths = dataset.loc[dataset['var'] == var, 'path'] if 'path' in dataset else None
         logger.debug("Segmenting %s data into %d sections", var, nsections)
-        data[var] = segment_data(cubes, period, control_period, nsections)
+        data[var] = {season: {} for season in ALLSEASONS}
+        runs = None
+        for key, years in zip(PERIODS, [control_period, period]):
+            cachekey = (var, tuple(years), nsections)
+            if cachekey not in cache:
+                if runs is None:
+                    runs = read_runs(cubes)
+                cache[cachekey] = segment_period(runs, years, nsections, directory=directory,
+                                                 paths=paths)
+            for season, segments in cache[cachekey].items():
+                data[var][season][key] = segments
         season = list(data[var].keys())[0]
         segment = data[var][season]['future']
         ndata.add(len(segment))
@@ -150,74 +310,34 @@ def prepare_data(dataset, variables, period, control_period, nsections):
     indices = create_indices(ndata, nsections)
 
     logger.debug("start")
-    means, _ = calc_means(data)
+    means = calc_means(data)
     logger.debug("stop")
 
     return data, indices, means, ndata
 
 
-def calculate_s1(means, indices, target, var='pr', season='djf', nproc=None):
-    """Calculate the subset S1: winter precipitation change equals `target`"""
-
-    if not nproc:
-        nproc = default_config['resampling']['nproc']
-
-    # Calculate the procentual change in winter precipitation for all sections individually,
-    # With respect to an overall-averaged control period
-    controlmean = means.loc[(var, season, 'control'), :]
-    controlmean = controlmean.mean().mean()
-    data = means.loc[(var, season, 'future'), :].values
-    data = 100 * (data - controlmean) / controlmean
-
-    calculation = Calculation(data, target)
-    tstart = datetime.now()
-    if nproc == 1:
-        values = list(map(calculation, indices))
-    else:
-        with multiprocessing.Pool(nproc) as pool:
-            values = pool.map(calculation, indices)
-    logger.debug("time(calculation) = %s", datetime.now() - tstart)
-    values = np.array(values)
-
-    tstart = datetime.now()
-    order = np.argsort(values)
-
-    selind = {'future': indices[order]}
-
-    data = means.loc[(var, season, 'control'), :].values
-    data = data - controlmean
-    calculation = Calculation(data, 0)
-    tstart = datetime.now()
-    if nproc == 1:
-        values = list(map(calculation, indices))
-    else:
-        with multiprocessing.Pool(nproc) as pool:
-            values = pool.map(calculation, indices)
-    logger.debug("time(calculation) = %s", datetime.now() - tstart)
-    values = np.array(values)
-
-    tstart = datetime.now()
-    order = np.argsort(values)
-
-    selind['control'] = indices[order]
-
-    return selind
+def calculate_s2(means, indices, scenarios, combinations=None):
+    """Calculate the subset S2: select percentile ranges for average
+    precipitation and temperatures
 
+    If `indices` contains resample IDs instead of index rows, the
+    corresponding `combinations` should be given, to decode the IDs.
 
-def calculate_s2(means, indices, scenarios):
-    """Calculate the subset S2: select percentile ranges for average
-    precipitation and temperatures"""
+    """
 
     s2_indices = {}
-    columns = np.arange(indices['control'].shape[1])
     for period in ['control', 'future']:
-        selection = np.ones(indices[period].shape[0], dtype=np.bool)
+        selection = np.ones(len(indices[period]), dtype=bool)
         s2_indices[period] = indices[period][selection]
+        rows = s2_indices[period]
+        if combinations is not None:
+            rows = combinations.decode(rows)
+        columns = np.arange(rows.shape[1])
         for scenario in scenarios:
             var = scenario['var']
             season = scenario['season']
             logger.debug("Subsetting with percentiles for %s, %s, %s", var, season, period)
-            values = means.loc[(var, season, period), :].values[s2_indices[period], columns]
+            values = means.get(var, season, period)[rows, columns]
             # Calculate mean along the columns, i.e., one 30-year period
             mean = values.mean(axis=1)
             logger.debug("Min, max, mean, median values: %f  %f  %f  %f",
@@ -228,52 +348,46 @@ def calculate_s2(means, indices, scenarios):
             logger.debug("Percentile values = %f  --  %f", low, high)
             selection = (low <= mean) & (mean <= high)
             s2_indices[period] = s2_indices[period][selection]
+            rows = rows[selection]
             logger.debug("Subsetting down to %d samples", selection.sum())
 
     return s2_indices
 
 
-def calculate_s3(indices_dict, penalties, nstep3=None, nsample=None,
-                 minimum_penalty=None):
+def stage_keys(indices, means, precip_change, ranges, penalties, nstep1, nstep3, nsample,
+               step1_method, step3_method, seed, nchains):
+    """Return the `StageCache` keys of the results of the steps of
+    `find_resamples`, for the given inputs and parameters"""
 
-    """Calculate the subset S3: find a subset with the least re-use of
-    segments, using random sampling"""
+    space = repr(indices) if isinstance(indices, Combinations) else np.asarray(indices)
+    keys = {}
+    keys['s1'] = hash_key('s1', means.variables, means.seasons, means.values, space,
+                          precip_change, nstep1, step1_method)
+    keys['s2'] = hash_key('s2', keys['s1'], ranges)
+    keys['s3'] = hash_key('s3', keys['s2'], penalties, nstep3, nsample, step3_method,
+                          seed, nchains, default_config['resampling']['step3_exact_limit'])
+    return keys
 
-    if not nstep3:
-        nstep3 = default_config['resampling']['nstep3']
-    if not nsample:
-        nsample = default_config['resampling']['nsample']
-    if minimum_penalty is None:
-        minimum_penalty = np.finfo(float).eps
-
-    s3_indices = {}
-    rng = np.random.default_rng()   # pylint: disable=no-member
-    for period, indices in indices_dict.items():
-        n = len(indices)  # pylint: disable=invalid-name
-        ncomb = math.factorial(n) // math.factorial(nstep3) // math.factorial(n - nstep3)
-        logger.debug("Number of combinations for the %s period = %d", period, ncomb)
-        best = np.inf
-        for i in range(nsample):
-            choice = rng.choice(indices, size=nstep3, replace=False)
-            penalty = 0
-            for column in choice.T:
-                _, counts = np.unique(column, return_counts=True)
-                for count in counts:
-                    penalty += penalties[count]
-            if penalty <= best:
-                best = penalty
-                s3_indices[period] = choice
-            if best < minimum_penalty:
-                logger.debug("Minimum penalty reached after %d iterations", i)
-                break
-        logger.info("Best sample for %s (penalty: %f) out of %d samples: %s",
-                    period, best, nsample, s3_indices[period])
 
-    return s3_indices
+def needs_step1(stage_cache, keys, seed=None):
+    """Return whether `find_resamples` has to calculate step 1, or can
+    start from a result in `stage_cache` with `keys`
+
+    Step 3 results are only used with a `seed`.
+
+    """
+
+    if stage_cache is None:
+        return True
+    stages = ['s1', 's2'] + (['s3'] if seed is not None else [])
+    return not any(stage_cache.path(stage, keys[stage]).exists() for stage in stages)
 
 
 def find_resamples(indices, means, precip_change, ranges, penalties,
-                   nstep1=None, nstep3=None, nsample=None, nproc=None):
+                   nstep1=None, nstep3=None, nsample=None, nproc=None,
+                   step1_method=None, chunksize=None, step3_method=None,
+                   seed=None, nchains=None, cache=None, stage_cache=None, s1_indices=None,
+                   step1_nproc=None):
     """Find the (best) resamples
 
     This does the actual work:
@@ -285,13 +399,28 @@ def find_resamples(indices, means, precip_change, ranges, penalties,
       to be in certain percentile change compared to the overall mean
       values of the remaining resamples.
 
-    - run step three, by randomly selecting samples, keeping the
+    - run step three, by selecting samples (randomly, exhaustively or
+      with simulated annealing, see `calculate_s3`), keeping the
       number of duplicate segments to a minimum.
 
     Note that the actual data cubes are not required: we have already
     calculated the averages, and those are used in step one and two
     (step three doesn't require any actual data).
 
+    `cache` is passed on to `calculate_s1`, to share the control
+    period ranking between scenarios.
+
+    If a `StageCache` is given as `stage_cache`, the results of each
+    step are stored on disk, and the calculation resumes from the
+    latest step whose inputs and parameters have not changed. Step 3
+    results are only cached when a `seed` is given, since they are not
+    reproducible otherwise.
+
+    If `s1_indices` is given (for example, merged from shards), it is
+    used as the result of step 1.
+
+    `step1_nproc`, if given, overrides `nproc` for step 1.
+
     """
     logger.debug("Calculating S1")
     logger.debug("Precipitation change: %.1f", precip_change)
@@ -304,57 +433,276 @@ def find_resamples(indices, means, precip_change, ranges, penalties,
     if not nproc:
         nproc = default_config['resampling']['nproc']
 
-    indices = calculate_s1(means, indices, precip_change, nproc=nproc)
-    indices['control'] = indices['control'][:nstep1]
-    indices['future'] = indices['future'][:nstep1]
-
-    indices = calculate_s2(means, indices, ranges)
+    if not step1_method:
+        step1_method = default_config['resampling']['step1_method']
+    if not step3_method:
+        step3_method = default_config['resampling']['step3_method']
+    if not nchains:
+        nchains = default_config['resampling']['step3_nchains'] or nproc
+    if step1_method == 'auto':
+        chosen, report = plan.plan_step1(means.nruns, means.nsections, nstep1=nstep1,
+                                         nproc=step1_nproc or nproc, chunksize=chunksize)
+        logger.info("Step 1 estimates:\n%s", report)
+        step1_method, step1_nproc = chosen.method, chosen.nproc
+        if step1_method == 'mitm' and not isinstance(indices, Combinations):
+            step1_method = 'stream'
+
+    combinations = indices if isinstance(indices, Combinations) else None
+    keys = {}
+    if stage_cache is not None:
+        keys = stage_keys(indices, means, precip_change, ranges, penalties, nstep1, nstep3,
+                          nsample, step1_method, step3_method, seed, nchains)
+
+    def load(stage):
+        return None if stage_cache is None else stage_cache.load(stage, keys[stage])
+
+    def save(stage, result):
+        if stage_cache is not None:
+            stage_cache.save(stage, keys[stage], result)
+
+    s3_indices = load('s3') if seed is not None else None
+    if s3_indices is not None:
+        return s3_indices
+
+    s2_indices = load('s2')
+    if s2_indices is None:
+        if s1_indices is None:
+            s1_indices = load('s1')
+        if s1_indices is None:
+            s1_indices = calculate_s1(means, indices, precip_change, nproc=step1_nproc or nproc,
+                                      nstep1=nstep1, method=step1_method, chunksize=chunksize,
+                                      cache=cache)
+            s1_indices['control'] = s1_indices['control'][:nstep1]
+            s1_indices['future'] = s1_indices['future'][:nstep1]
+            save('s1', s1_indices)
+
+        s2_indices = calculate_s2(means, s1_indices, ranges, combinations=combinations)
+        save('s2', s2_indices)
     logger.debug("The S2 subset has %d & %d indices for the control & future periods, resp.",
-                 len(indices['control']), len(indices['future']))
+                 len(s2_indices['control']), len(s2_indices['future']))
 
-    indices = calculate_s3(indices, penalties, nstep3=nstep3, nsample=nsample)
+    s3_indices = calculate_s3(s2_indices, penalties, nstep3=nstep3, nsample=nsample,
+                              combinations=combinations, method=step3_method,
+                              seed=seed, nchains=nchains, nproc=nproc)
+    if seed is not None:
+        save('s3', s3_indices)
+
+    return s3_indices
 
-    return indices
 
+def segment_statistics(segments, rows):
+    """Calculate the statistics of a set of resamples
 
-def resample(indices, data, variables, seasons, relative):
-    """Perform the actual resampling of data, given the resampled indices"""
+    `segments` is a (nruns, nsections, ntimes) array with segmented
+    data, `rows` a (nresamples, nsections) array of run indices. The
+    selected segments are stacked into a single (nresamples, values)
+    array, and the statistics are calculated for all resamples at once.
 
+    Returns a (nresamples, len(STATS)) array, with the mean followed
+    by the percentiles.
+
+    """
+
+    columns = np.arange(segments.shape[1])
+    block = segments[rows, columns].reshape(len(rows), -1)
     percs = list(map(float, STATS[1:]))
+    stats = np.empty((len(rows), len(STATS)))
+    if np.isnan(block).any():
+        stats[:, 0] = np.nanmean(block, axis=1, dtype=np.float64)
+        stats[:, 1:] = np.nanpercentile(block, percs, axis=1).T
+    else:
+        stats[:, 0] = block.mean(axis=1, dtype=np.float64)
+        stats[:, 1:] = np.percentile(block, percs, axis=1).T
+    return stats
 
-    diffs = {}
+
+def _segment_statistics(args):
+    """Calculate `segment_statistics` for shared segmented data, for use with `Pool.map`"""
+    key, rows = args
+    return segment_statistics(shared.get(key), rows)
+
+
+def _sketch_statistics(args):
+    """Calculate `sketch.sketch_statistics` for a shared sketch, for use with `Pool.map`"""
+    key, rows = args
+    item = sketch.Sketch(*(shared.get(key + (field,)) for field in sketch.Sketch._fields))
+    return sketch.sketch_statistics(item, rows, list(map(float, STATS[1:])))
+
+
+def resample(indices, data, variables, seasons, relative, nproc=1, method='exact',
+             error=None, callback=None):
+    """Perform the actual resampling of data, given the resampled indices
+
+    The statistics for each (scenario, variable, season, period) are
+    independent; these are calculated in parallel if `nproc` > 1.
+    Statistics for identical selections of the same segmented data
+    (such as the control period, when shared between scenarios) are
+    calculated only once.
+
+    With `method` "sketch", the percentiles are estimated from
+    histograms of each segment (see the `sketch` module), with a
+    maximum error of `error` times the data range, instead of from
+    all values of the selected segments.
+
+    `callback`, if given, is called with the key and the results of
+    each scenario, as soon as these are available, while the statistics
+    for the next scenarios are still being calculated.
+
+    """
+
+    if method not in ('exact', 'sketch'):
+        raise ValueError(f"unknown statistics method: {method}")
+    if error is None:
+        error = default_config['resampling']['sketch_error']
+
+    arrays = {}
+    tasks = {}
+    keys = {}
+    # Number of tasks needed for the results of each scenario
+    ntasks = {}
     for key, value in indices.items():
-        diffs[key] = {}
-        tempindices = value['data']
         for var in variables:
-            diffs[key][var] = {}
             for season in seasons:
-                stats = {}
-                for period in ['control', 'future']:
-                    cubes = data[key][var][season][period]
-                    columns = np.arange(cubes.shape[1])
-                    resampled = cubes[tempindices[period], columns]
-                    stats[period] = pd.DataFrame({'mean': 0, '5': 0, '10': 0, '25': 0, '50': 0,
-                                                  '75': 0, '90': 0, '95': 0},
-                                                 index=np.arange(len(resampled)))
-                    for i, cubeset in enumerate(resampled):
-                        block = np.hstack([cube.data for cube in cubeset])
-                        stats[period].loc[i, 'mean'] = block.mean()
-                        stats[period].loc[i, STATS[1:]] = np.percentile(block, percs)
-
-                diff = pd.DataFrame()
-                for col in STATS:
-                    diff[col] = stats['future'][col] - stats['control'][col]
-                    if var in relative:
-                        diff[col] = 100 * diff[col] / stats['control'][col]
-                diffs[key][var][season] = diff
+                for period in PERIODS:
+                    segments = data[key][var][season][period]
+                    arraykey = ('segments', id(segments))
+                    arrays[arraykey] = segments
+                    rows = np.asarray(value['data'][period])
+                    taskkey = (arraykey, rows.shape, rows.tobytes())
+                    tasks.setdefault(taskkey, (arraykey, rows))
+                    keys[key, var, season, period] = taskkey
+        ntasks[key] = len(tasks)
+
+    func = _segment_statistics
+    if method == 'sketch':
+        # Each segmented data array is sketched once, for all its resamples
+        sketches = {('sketch',) + key[1:]: sketch.sketch_segments(segments, error)
+                    for key, segments in arrays.items()}
+        arrays = {key + (field,): value for key, item in sketches.items()
+                  for field, value in zip(sketch.Sketch._fields, item)}
+        tasks = {taskkey: (('sketch',) + key[1:], rows) for taskkey, (key, rows) in tasks.items()}
+        func = _sketch_statistics
+        logger.debug("Calculated %d sketches with %d bins", len(sketches),
+                     sketch.nbins_for(error))
+
+    def scenario_diffs(key):
+        diffs = {}
+        for var in variables:
+            diffs[var] = {}
+            for season in seasons:
+                control = results[keys[key, var, season, 'control']]
+                future = results[keys[key, var, season, 'future']]
+                diff = future - control
+                if var in relative:
+                    diff = 100 * diff / control
+                diffs[var][season] = pd.DataFrame(diff, columns=STATS)
+        return diffs
+
+    diffs = {}
+    results = {}
+    pending = list(indices)
+    with contextlib.ExitStack() as stack:
+        if nproc > 1 and len(tasks) > 1:
+            # The segmented data (or sketches) are shared with, not
+            # pickled for, the workers
+            pool = stack.enter_context(shared.pool(min(nproc, len(tasks)), arrays))
+            values = pool.imap(func, list(tasks.values()))
+        elif method == 'sketch':
+            percs = list(map(float, STATS[1:]))
+            values = (sketch.sketch_statistics(sketches[key], rows, percs)
+                      for key, rows in tasks.values())
+        else:
+            values = (segment_statistics(arrays[key], rows) for key, rows in tasks.values())
+        # Tasks are ordered by scenario, so the scenarios complete in order
+        for taskkey, value in zip(tasks, values):
+            results[taskkey] = value
+            while pending and ntasks[pending[0]] <= len(results):
+                key = pending.pop(0)
+                diffs[key] = scenario_diffs(key)
+                if callback is not None:
+                    callback(key, diffs[key])
+    logger.debug("Calculated statistics for %d unique resample selections, out of %d",
+                 len(tasks), len(keys))
     return diffs
 
 
+def _find_resamples(args):
+    """Run `find_resamples` for a single scenario in a worker process
+
+    The segment averages and step 1 control rankings are taken from
+    the shared arrays.
+
+    """
+
+    (variables, seasons, penalties, rankingkeys,
+     mainkey, combinations, precip_change, rrange, kwargs) = args
+    means = SegmentMeans(variables, seasons, shared.get(('means', mainkey)))
+    rankings = {key: shared.get(('s1', key)) for key in rankingkeys}
+    kwargs['step1_nproc'] = 1
+    return find_resamples(combinations, means, precip_change, rrange, penalties,
+                          nproc=1, cache=rankings, **kwargs)
+
+
+def _share_segments(data):
+    """Replace the segmented data arrays in `data` by copies in shared memory
+
+    This way, the data are not kept twice when shared with a
+    `shared.WorkerPool`. Memory-mapped arrays are left as they are.
+    Returns a list of the (unique) arrays.
+
+    """
+
+    # Scenarios share arrays (for the control period): copy each only
+    # once, and keep the originals until all references are replaced
+    copies = {}
+    for scenario_data in data.values():
+        for var_data in scenario_data.values():
+            for season_data in var_data.values():
+                for period, segments in season_data.items():
+                    if id(segments) not in copies:
+                        copies[id(segments)] = segments, shared.to_shared(segments)
+                    season_data[period] = copies[id(segments)][1]
+    return [copy for _, copy in copies.values()]
+
+
+def prepare_scenarios(dataset, steering_table, nsections, reference_period, directory=None):
+    """Prepare the data for all scenarios in the steering table
+
+    The segmentation of periods that scenarios have in common (in
+    particular the control period) is done only once. With
+    `directory`, the segmented data are memory-mapped from files in
+    that directory (see `segment_period`).
+
+    Returns dicts with the segmented data, the combination space and
+    the segment averages, with the (epoch, scenario, subscenario)
+    tuples as keys.
+
+    """
+
+    data = {}
+    indices = {}
+    means = {}
+    variables = dataset['var'].unique()
+    segments = {}
+    for _, row in steering_table.iterrows():
+        period = tuple(map(int, row['period']))
+        scenario = row['scenario']
+        subscenario = row['subscenario']
+        epoch = row['epoch']
+        mainkey = (str(epoch), scenario, subscenario)
+        logger.info("Preparing data for %s_%s - %s %s", scenario, subscenario, epoch, period)
+        data[mainkey], indices[mainkey], means[mainkey], _ = prepare_data(
+            dataset, variables, period, reference_period, nsections, cache=segments,
+            directory=directory)
+    return data, indices, means
+
+
 def calc(dataset, steering_table, ranges, penalties,
          nstep1=None, nstep3=None, nsample=None,
          nsections=None, reference_period=None,
-         relative=None, nproc=None):
+         relative=None, nproc=None, step1_method=None, chunksize=None,
+         step3_method=None, seed=None, nchains=None, cache_dir=None, s1_shards=None,
+         statistics_method=None, sketch_error=None, memmap_dir=None, callback=None):
     """DUMMY DOCSTRING"""
 
     if relative is None:
@@ -371,22 +719,36 @@ def calc(dataset, steering_table, ranges, penalties,
         nsections = default_config['resampling']['nsections']
     if not nproc:
         nproc = default_config['resampling']['nproc']
+    if not statistics_method:
+        statistics_method = default_config['resampling']['statistics_method']
+    if not step3_method:
+        step3_method = default_config['resampling']['step3_method']
+    if not nchains:
+        nchains = default_config['resampling']['step3_nchains'] or nproc
 
-    data = {}
-    indices = {}
-    means = {}
     variables = dataset['var'].unique()
-
-    for _, row in steering_table.iterrows():
-        period = tuple(map(int, row['period']))
-        scenario = row['scenario']
-        subscenario = row['subscenario']
-        epoch = row['epoch']
-        mainkey = (str(epoch), scenario, subscenario)
-        logger.info("Preparing data for %s_%s - %s %s", scenario, subscenario, epoch, period)
-        data[mainkey], indices[mainkey], means[mainkey], _ = prepare_data(
-            dataset, variables, period, reference_period, nsections)
-
+    data, indices, means = prepare_scenarios(dataset, steering_table, nsections,
+                                             reference_period, directory=memmap_dir)
+    # Scenarios share the control period: reuse its step 1 ranking
+    rankings = {}
+    stage_cache = StageCache(cache_dir) if cache_dir else None
+
+    if not step1_method:
+        step1_method = default_config['resampling']['step1_method']
+    step1_nproc = nproc
+    if s1_shards is not None:
+        # Merged shards give the same result as a "stream" step 1
+        step1_method = 'stream'
+    elif step1_method == 'auto':
+        # Choose once for all scenarios, so that these use the same method
+        first = next(iter(means.values()))
+        nperiods = len({tuple(map(int, period)) for period in steering_table['period']})
+        chosen, report = plan.plan_step1(first.nruns, first.nsections, len(steering_table),
+                                         nperiods, nstep1, nproc, chunksize)
+        logger.info("Step 1 estimates:\n%s", report)
+        step1_method, step1_nproc = chosen.method, chosen.nproc
+
+    tasks = []
     all_indices = {}
     for _, row in steering_table.iterrows():
         period = tuple(map(int, row['period']))
@@ -395,21 +757,79 @@ def calc(dataset, steering_table, ranges, penalties,
         epoch = row['epoch']
         mainkey = (str(epoch), scenario, subscenario)
         precip_change = row['precip_change']
+        # Derive a separate, reproducible, step 3 seed for each scenario
+        scenario_seed = None if seed is None else [seed, zlib.crc32("/".join(mainkey).encode())]
 
         rrange = ranges[scenario][subscenario][epoch]
         logger.info("Processing %s_%s - %s %s, %.2f pr", scenario, subscenario, epoch,
                     period, precip_change)
-        final_indices = find_resamples(indices[mainkey], means[mainkey],
-                                       precip_change, rrange, penalties,
-                                       nstep1, nstep3, nsample, nproc)
+        kwargs = {'nstep1': nstep1, 'nstep3': nstep3, 'nsample': nsample,
+                  'step1_method': step1_method, 'chunksize': chunksize,
+                  'step3_method': step3_method, 'seed': scenario_seed, 'nchains': nchains,
+                  'stage_cache': stage_cache, 'step1_nproc': step1_nproc}
+        if s1_shards is not None:
+            kwargs['s1_indices'] = shards.merge_s1_shards(s1_shards, mainkey, means[mainkey],
+                                                          indices[mainkey], precip_change, nstep1)
+        tasks.append((mainkey, indices[mainkey], precip_change, rrange, kwargs))
 
         attrs = {
             'scenario': scenario, 'subscenario': subscenario, 'epoch': epoch,
             'period': period, 'reference-period': reference_period,
             'ranges': rrange, 'winter-precip-change': precip_change}
-        all_indices[mainkey] = {'data': final_indices, 'meta': attrs}
-
-    diffs = resample(all_indices, data, variables, seasons=['djf', 'mam', 'jja', 'son'],
-                     relative=relative)
+        all_indices[mainkey] = {'meta': attrs}
+
+    with contextlib.ExitStack() as stack:
+        if nproc > 1:
+            # Start the worker processes once, for all parallel stages,
+            # sharing the segment averages and segmented data up front
+            # (the statistics from sketches don't need the latter)
+            arrays = {('means', mainkey): value.values for mainkey, value in means.items()}
+            if statistics_method == 'exact':
+                arrays.update({('segments', id(segments)): segments
+                               for segments in _share_segments(data)})
+            stack.enter_context(shared.WorkerPool(nproc, arrays))
+
+        if nproc > 1 and len(tasks) > 1:
+            # Run the scenarios in parallel, each in a single process. The
+            # control period is ranked beforehand, with all processes, so
+            # that the workers can share the ranking; the same goes for
+            # the sorted indices of the "index" step 1 method. Scenarios
+            # with cached results (of any step) don't need step 1.
+            step1_tasks = []
+            if s1_shards is None:   # Otherwise step 1 has been done by the shards
+                for task in tasks:
+                    mainkey, combinations, precip_change, rrange, kwargs = task
+                    keys = None if stage_cache is None else stage_keys(
+                        combinations, means[mainkey], precip_change, rrange, penalties,
+                        nstep1, nstep3, nsample, step1_method, step3_method, kwargs['seed'],
+                        nchains)
+                    if needs_step1(stage_cache, keys, kwargs['seed']):
+                        step1_tasks.append(task)
+            if step1_method == 'index':
+                for mainkey, combinations, precip_change, *_ in step1_tasks:
+                    calculate_s1(means[mainkey], combinations, precip_change, nproc=step1_nproc,
+                                 nstep1=nstep1, method='index', chunksize=chunksize,
+                                 cache=rankings)
+            elif step1_tasks:
+                first = step1_tasks[0][0]
+                calculate_s1_control(means[first], indices[first], nproc=step1_nproc,
+                                     nstep1=nstep1, method=step1_method, chunksize=chunksize,
+                                     cache=rankings)
+            arrays = {('s1', key): value for key, value in rankings.items()}
+            logger.info("Processing %d scenarios in parallel", len(tasks))
+            args = [(means[task[0]].variables, means[task[0]].seasons, penalties, list(rankings))
+                    + task for task in tasks]
+            with shared.pool(min(nproc, len(tasks)), arrays) as pool:
+                results = pool.map(_find_resamples, args)
+        else:
+            results = [find_resamples(combinations, means[mainkey], precip_change, rrange,
+                                      penalties, nproc=nproc, cache=rankings, **kwargs)
+                       for mainkey, combinations, precip_change, rrange, kwargs in tasks]
+        for (mainkey, *_), final_indices in zip(tasks, results):
+            all_indices[mainkey]['data'] = final_indices
+
+        diffs = resample(all_indices, data, variables, seasons=['djf', 'mam', 'jja', 'son'],
+                         relative=relative, nproc=nproc, method=statistics_method,
+                         error=sketch_error, callback=callback)
 
     return all_indices, diffs
@@ -0,0 +1,193 @@
+"""Estimate the cost of step 1, and select a method for it
+
+Step 1 ranks (part of) the nruns^nsections resamples for each
+scenario, and once for the control period. Depending on the size of
+this combination space, the number of scenarios and the available
+processes and memory, a different method is fastest:
+
+- "full" scores and sorts all resamples: simple, but memory grows
+  with the combination space;
+
+- "stream" scores the resamples in chunks, and keeps only the best;
+
+- "mitm" does a meet-in-the-middle search, whose time and memory
+  grow with the square root of the combination space;
+
+- "index" sorts all resamples once per period, which pays off when
+  several scenarios share a period.
+
+The scoring of the "full", "stream" and "index" methods can also be
+pooled over multiple processes, which only pays off for large
+combination spaces.
+
+The estimates use the measured time to score a small batch of
+resamples and to sort an array, on the current machine, and rough
+models of each method. They are meant to select a method, and to give
+an idea of the running time, not as accurate predictions.
+
+"""
+
+import collections
+import math
+import os
+import time
+import numpy as np
+from ..config import default_config
+from .combinations import Combinations
+
+
+METHODS = ('full', 'stream', 'mitm', 'index')
+
+# Rough start-up and communication overhead of a pool, per process, in seconds
+POOL_OVERHEAD = 0.1
+
+# Number of resamples scored, and elements sorted, for the timings
+NBENCHMARK = 50_000
+
+
+Estimate = collections.namedtuple('Estimate', ['method', 'nproc', 'memory', 'time'])
+Estimate.__doc__ = """Estimated memory use (bytes) and running time (seconds) of a step 1 method"""
+
+
+def physical_memory():
+    """Return the physical memory in bytes, or None if unknown"""
+
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def benchmark(nruns, nsections):
+    """Measure the time to score a resample, and the time per `n log2(n)`
+    of sorting an array of length `n`, in seconds"""
+
+    rng = np.random.default_rng(0)
+    data = rng.random((nruns, nsections)).astype(np.float32)
+    combinations = Combinations(nruns, nsections)
+    columns = np.arange(nsections)
+    ids = range(min(NBENCHMARK, len(combinations)))
+    tstart = time.perf_counter()
+    # The same operations as `step1.Calculation`
+    means = data[combinations.decode(ids), columns].mean(axis=1)
+    np.abs(means.astype(np.float64) - 0.5)
+    tscore = (time.perf_counter() - tstart) / len(ids)
+
+    values = rng.random(NBENCHMARK)
+    tstart = time.perf_counter()
+    np.argsort(values, kind='stable')
+    tsort = (time.perf_counter() - tstart) / (NBENCHMARK * math.log2(NBENCHMARK))
+    return tscore, tsort
+
+
+def estimate(nruns, nsections, nstep1, nscenarios, nperiods, nproc=1,
+             chunksize=100_000, timings=None):
+    """Estimate the memory use and running time of step 1 for each method
+
+    `nscenarios` is the number of scenarios (future period rankings),
+    `nperiods` the number of distinct future periods among them; the
+    control period is ranked once. `timings` are the outcome of
+    `benchmark`, which is run if not given.
+
+    Returns a list of `Estimate`s, for each method, and for each
+    method that can use a pool, both with and without pool (if
+    `nproc` > 1).
+
+    """
+
+    if timings is None:
+        timings = benchmark(nruns, nsections)
+    tscore, tsort = timings
+    size = nruns ** nsections
+    idsize = Combinations(nruns, nsections).dtype.itemsize
+    nrankings = nscenarios + 1
+    sort = size * math.log2(max(size, 2)) * tsort
+
+    def score(nprocs):
+        if nprocs == 1:
+            return size * tscore
+        return size * tscore / nprocs + POOL_OVERHEAD * nprocs
+
+    estimates = []
+    for nprocs in sorted({1, max(nproc, 1)}):
+        # Scores (float64), argsort output (int64) and the sorted IDs
+        estimates.append(Estimate('full', nprocs, size * (8 + 8 + idsize),
+                                  nrankings * (score(nprocs) + sort)))
+        # Per chunk: decoded IDs (uint64), gathered data (float32) and
+        # intermediates, in each process
+        estimates.append(Estimate('stream', nprocs,
+                                  nprocs * chunksize * nsections * 24 + nstep1 * 16,
+                                  nrankings * score(nprocs)))
+        # A sorted index (float32 averages plus IDs) is kept for each
+        # period; the control period is ranked with a temporary index
+        estimates.append(Estimate('index', nprocs,
+                                  nperiods * size * (4 + idsize) + size * (4 + 8),
+                                  (nperiods + 1) * (score(nprocs) + sort)))
+    # Sums and IDs for both halves, sorted, plus the rescored candidates
+    half = nruns ** math.ceil(nsections / 2)
+    estimates.append(Estimate('mitm', 1, half * 40 + 16 * nstep1 * 8,
+                              nrankings * (2 * half * tscore
+                                           + 2 * half * math.log2(max(half, 2)) * tsort
+                                           + 16 * nstep1 * tscore)))
+    return estimates
+
+
+def choose(estimates, memory_limit=None):
+    """Choose the fastest estimate that fits within `memory_limit` (bytes)
+
+    If none fits, the estimate with the least memory use is chosen.
+
+    """
+
+    fits = [item for item in estimates if memory_limit is None or item.memory <= memory_limit]
+    if fits:
+        return min(fits, key=lambda item: (item.time, METHODS.index(item.method), item.nproc))
+    return min(estimates, key=lambda item: (item.memory, item.time))
+
+
+def report(estimates, chosen, size, memory_limit=None):
+    """Return a readable overview of the estimates and the chosen method"""
+
+    lines = [f"Number of resamples (combinations): {size:,}"]
+    if memory_limit is not None:
+        lines.append(f"Memory limit: {memory_limit / 1e9:.2f} GB")
+    lines.append(f"{'method':<8} {'nproc':>5} {'memory':>12} {'time':>12}")
+    for item in sorted(estimates, key=lambda item: (item.time, item.memory)):
+        mark = "  <- chosen" if item == chosen else ""
+        lines.append(f"{item.method:<8} {item.nproc:>5} {item.memory / 1e6:>9.1f} MB "
+                     f"{item.time:>10.2f} s{mark}")
+    return "\n".join(lines)
+
+
+def plan_step1(nruns, nsections, nscenarios=1, nperiods=1, nstep1=None, nproc=None,
+               chunksize=None, memory_limit=None):
+    """Estimate the cost of the step 1 methods, and choose one
+
+    `nscenarios` is the number of scenarios (precipitation targets),
+    `nperiods` the number of distinct future periods among these.
+    `memory_limit` is in GB; if zero, half of the physical memory is
+    used.
+
+    Returns the chosen `Estimate`, and a report of all estimates.
+
+    """
+
+    if not nstep1:
+        nstep1 = default_config['resampling']['nstep1']
+    if not nproc:
+        nproc = default_config['resampling']['nproc']
+    if not chunksize:
+        chunksize = default_config['resampling']['chunksize']
+    if memory_limit is None:
+        memory_limit = default_config['resampling']['memory_limit']
+    if memory_limit:
+        memory_limit = memory_limit * 1e9
+    else:
+        memory_limit = physical_memory()
+        if memory_limit is not None:
+            memory_limit /= 2
+
+    estimates = estimate(nruns, nsections, nstep1, nscenarios, nperiods,
+                         nproc=nproc, chunksize=chunksize)
+    chosen = choose(estimates, memory_limit)
+    return chosen, report(estimates, chosen, nruns ** nsections, memory_limit)
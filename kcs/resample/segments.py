@@ -0,0 +1,88 @@
+"""Storage for segmented data and their statistics
+
+The resampling works on the n-year segments of each run, for every
+variable, season and period (control and future). The classes here
+keep the values for all these in contiguous NumPy arrays, so that the
+values for a (variable, season, period) can be sliced directly, as a
+(run, section) array, without going through a Pandas (multi-)index.
+
+"""
+
+import numpy as np
+
+
+PERIODS = ('control', 'future')
+
+
+def segment_means(segments):
+    """Average segments along their last (time) axis, ignoring NaN padding"""
+
+    if np.isnan(segments).any():
+        return np.nanmean(segments, axis=-1)
+    return segments.mean(axis=-1)
+
+
+class SegmentMeans:
+    """Array-backed store of the averages of all segments
+
+    The averages are stored in a single array with shape (nvariables,
+    nseasons, nperiods, nruns, nsections). `get` returns a view on the
+    (nruns, nsections) averages for a given variable, season and
+    period.
+
+    Other statistics (such as the standard deviation) are only
+    calculated when requested, through `statistic`, and then cached.
+    This requires the segmented data to be given at construction.
+
+    """
+
+    def __init__(self, variables, seasons, values, data=None):
+        self.variables = list(variables)
+        self.seasons = list(seasons)
+        self.values = values
+        self.data = data
+        # Positions of the variables, seasons and periods along the first three axes
+        self._positions = [{key: i for i, key in enumerate(keys)}
+                           for keys in (self.variables, self.seasons, PERIODS)]
+        self._statistics = {}
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: variables {self.variables}, "
+                f"seasons {self.seasons}, {self.nruns} runs, {self.nsections} sections>")
+
+    @property
+    def nruns(self):
+        """Number of runs (data sets)"""
+        return self.values.shape[-2]
+
+    @property
+    def nsections(self):
+        """Number of sections per period"""
+        return self.values.shape[-1]
+
+    def index(self, var, season, period):
+        """Return the index into the first three dimensions of the values array"""
+        varindex, seasonindex, periodindex = self._positions
+        return varindex[var], seasonindex[season], periodindex[period]
+
+    def get(self, var, season, period):
+        """Return the (nruns, nsections) averages for a variable, season and period"""
+        return self.values[self.index(var, season, period)]
+
+    def statistic(self, name, var, season, period):
+        """Return a (nruns, nsections) array with a statistic of each segment
+
+        `name` is the name of a NumPy function that has a NaN-aware
+        variant (the segments can be padded with NaN), such as "std",
+        "median" or "max". The statistic is calculated on first
+        request, and cached.
+
+        """
+
+        key = (name, var, season, period)
+        if key not in self._statistics:
+            if self.data is None:
+                raise ValueError("segmented data are required to calculate statistics")
+            func = getattr(np, 'nan' + name)
+            self._statistics[key] = func(self.data[var][season][period], axis=-1)
+        return self._statistics[key]
@@ -0,0 +1,204 @@
+"""Step 1 over shards of the combination space
+
+For large ensembles, step 1 can be split over separate jobs: each job
+(shard) scores a contiguous range of resample IDs, and keeps the best
+`nstep1` resamples of its range, with their scores. These are written
+to a small file. Merging the files of all shards, by keeping the best
+`nstep1` of all shard results, gives the same result as a (streaming)
+step 1 over the whole combination space, since each shard keeps any
+resample that is among the overall best.
+
+Shards are numbered from 1 to the number of shards.
+
+"""
+
+import logging
+import re
+import numpy as np
+from ..config import default_config
+from .segments import PERIODS
+from .cache import hash_key
+from .step1 import select_closest, s1_controlmean
+
+
+logger = logging.getLogger(__name__)   # pylint: disable=invalid-name
+
+
+def parse_shard(text):
+    """Parse a "i/n" shard specification into (i, n)"""
+
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text)
+    if not match:
+        raise ValueError(f"invalid shard specification: {text!r}; use the format 'i/n'")
+    shard, nshards = int(match.group(1)), int(match.group(2))
+    if not 1 <= shard <= nshards:
+        raise ValueError(f"shard number {shard} should be between 1 and {nshards}")
+    return shard, nshards
+
+
+def shard_range(size, shard, nshards):
+    """Return the (start, stop) IDs of `shard` out of `nshards`, for
+    a combination space of `size` resamples"""
+
+    return size * (shard - 1) // nshards, size * shard // nshards
+
+
+def merge(results, nselect):
+    """Merge shard results into the overall best `nselect` resamples
+
+    `results` is a list of per-shard results: dicts with the periods
+    as keys, and an (IDs, scores) tuple as values. Returns a dict with
+    the sorted IDs for each period; equal scores are ordered by ID.
+
+    """
+
+    merged = {}
+    for period in PERIODS:
+        ids = np.concatenate([result[period][0] for result in results])
+        scores = np.concatenate([result[period][1] for result in results])
+        order = np.lexsort((ids, scores))[:nselect]
+        merged[period] = ids[order]
+    return merged
+
+
+def save(filename, results, shard, nshards):
+    """Save the shard results of all scenarios to a NumPy .npz file
+
+    `results` is a dict with the scenario keys (epoch, scenario,
+    subscenario) as keys, and for each a dict with an input 'key'
+    (hash) and the (IDs, scores) per period.
+
+    """
+
+    arrays = {'shard': np.array([shard, nshards])}
+    for mainkey, result in results.items():
+        name = "/".join(mainkey)
+        arrays[f"{name}/key"] = np.array(result['key'])
+        for period in PERIODS:
+            arrays[f"{name}/{period}/ids"], arrays[f"{name}/{period}/scores"] = result[period]
+    np.savez(filename, **arrays)
+    logger.info("Saved results for shard %d/%d to %s", shard, nshards, filename)
+
+
+def load(filenames):
+    """Load and check the result files of all shards
+
+    Returns a dict with the scenario keys as keys, and for each a
+    dict with the input 'key' (hash) and a list of the shard results.
+
+    Raises a ValueError if shards are missing, duplicated, or not
+    computed for the same scenarios and inputs.
+
+    """
+
+    results = {}
+    shards = []
+    for filename in filenames:
+        with np.load(filename) as data:
+            shard, nshards = map(int, data['shard'])
+            shards.append((shard, nshards))
+            names = {"/".join(key.split('/')[:3]) for key in data.files if key != 'shard'}
+            for name in names:
+                mainkey = tuple(name.split('/'))
+                key = str(data[f"{name}/key"])
+                result = {period: (data[f"{name}/{period}/ids"], data[f"{name}/{period}/scores"])
+                          for period in PERIODS}
+                if mainkey not in results:
+                    results[mainkey] = {'key': key, 'shards': []}
+                elif results[mainkey]['key'] != key:
+                    raise ValueError(f"shard file {filename} was calculated with different "
+                                     f"inputs for scenario {name}")
+                results[mainkey]['shards'].append(result)
+
+    nshards = {n for _, n in shards}
+    if len(nshards) != 1:
+        raise ValueError(f"shard files are from different numbers of shards: {sorted(nshards)}")
+    nshards = nshards.pop()
+    if sorted(shard for shard, _ in shards) != list(range(1, nshards + 1)):
+        raise ValueError(f"expected each of the shards 1 to {nshards} exactly once, "
+                         f"got {sorted(shard for shard, _ in shards)}")
+    for mainkey, result in results.items():
+        if len(result['shards']) != nshards:
+            raise ValueError(f"scenario {'/'.join(mainkey)} is missing from some shard files")
+    logger.info("Loaded %d shards for %d scenarios", nshards, len(results))
+    return results
+
+
+def s1_shard_key(means, combinations, target, nstep1, var='pr', season='djf'):
+    """Return a hash of the inputs of step 1, to check that shards match"""
+    return hash_key('s1-shard', var, season, means.get(var, season, 'control'),
+                    means.get(var, season, 'future'), repr(combinations), target, nstep1)
+
+
+def calculate_s1_shard(means, combinations, target, shard, nshards, var='pr', season='djf',
+                       nproc=None, nstep1=None, chunksize=None):
+    """Calculate subset S1 for a single shard of the combination space
+
+    The resample IDs are divided into `nshards` contiguous ranges;
+    `shard` (numbered from 1) selects the range. The resamples in the
+    range are streamed as for the "stream" step 1 method, see
+    `calculate_s1`.
+
+    Returns a dict with the best `nstep1` resamples of the range, for
+    each period, as an (IDs, scores) tuple, plus the input 'key' (see
+    `s1_shard_key`).
+
+    """
+
+    if not nproc:
+        nproc = default_config['resampling']['nproc']
+    if not nstep1:
+        nstep1 = default_config['resampling']['nstep1']
+    if not chunksize:
+        chunksize = default_config['resampling']['chunksize']
+
+    start, stop = shard_range(len(combinations), shard, nshards)
+    logger.info("Calculating S1 for shard %d/%d: IDs %d to %d", shard, nshards, start, stop)
+    controlmean = s1_controlmean(means, var, season)
+    future = 100 * (means.get(var, season, 'future') - controlmean) / controlmean
+    control = means.get(var, season, 'control') - controlmean
+    result = {'key': s1_shard_key(means, combinations, target, nstep1, var, season)}
+    for period, data, periodtarget in [('future', future, target), ('control', control, 0)]:
+        result[period] = select_closest(data, combinations, periodtarget, nstep1, nproc=nproc,
+                                        chunksize=chunksize, start=start, stop=stop,
+                                        scores=True)
+    return result
+
+
+def merge_s1_shards(s1_shards, mainkey, means, combinations, target, nstep1):
+    """Merge the step 1 shard results for a scenario
+
+    `s1_shards` is the output of `shards.load`. Raises a ValueError if
+    the shards were calculated for other inputs.
+
+    """
+
+    if mainkey not in s1_shards:
+        raise ValueError(f"no shard results for scenario {'/'.join(mainkey)}")
+    if s1_shards[mainkey]['key'] != s1_shard_key(means, combinations, target, nstep1):
+        raise ValueError(f"the shard results for scenario {'/'.join(mainkey)} were "
+                         "calculated with different inputs or parameters")
+    return merge(s1_shards[mainkey]['shards'], nstep1)
+
+
+def calc_shard(means, indices, steering_table, shard, nshards, nstep1=None, nproc=None,
+               chunksize=None):
+    """Calculate step 1 for a shard of the combination space, for all scenarios
+
+    `means` and `indices` are the per-scenario dicts of
+    `core.prepare_scenarios`. The results can be saved with `save`;
+    the results of all shards are then merged, and the calculation
+    finished, with `core.calc` and its `s1_shards` argument.
+
+    """
+
+    if not nstep1:
+        nstep1 = default_config['resampling']['nstep1']
+
+    results = {}
+    for _, row in steering_table.iterrows():
+        mainkey = (str(row['epoch']), row['scenario'], row['subscenario'])
+        results[mainkey] = calculate_s1_shard(means[mainkey], indices[mainkey],
+                                              row['precip_change'], shard, nshards,
+                                              nproc=nproc, nstep1=nstep1, chunksize=chunksize)
+    return results
@@ -0,0 +1,280 @@
+"""A persistent worker pool, with read-only NumPy arrays shared with its workers
+
+All parallel stages of the resampling (scoring resamples in step 1,
+the step 3 chains, the scenarios and the resample statistics) can use
+the same process pool: `WorkerPool` starts the worker processes once,
+and `pool` hands out the active pool to each stage (or, outside of an
+active pool, creates a temporary one).
+
+Arrays that the workers need (such as the segmented data, the segment
+averages, or the step 1 rankings) are shared with the workers instead
+of being pickled with every task; tasks refer to the arrays by their
+key, and use `get` to obtain them.
+
+- Arrays given when the pool is created are copied into shared memory
+  (`multiprocessing.RawArray`), and attached in each worker process at
+  start-up, without copying. RawArray is available for all supported
+  Python versions, and works with both the "fork" and "spawn" start
+  methods. Arrays that are already in shared memory (created with
+  `to_shared`) are not copied again: the caller can thus replace its
+  own arrays by shared copies up front, instead of keeping both.
+
+- Arrays shared later, with `WorkerPool.share`, cannot be handed to
+  running workers that way. These are saved to .npy files in a
+  temporary directory, which the workers memory-map on first use:
+  they then share the operating system's page cache, read-only.
+
+- Arrays that are already memory-mapped from a .npy file (such as
+  segmented data stored with `--memmap-dir`) are not copied at all:
+  the workers memory-map the same file.
+
+"""
+
+import contextlib
+import ctypes
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import pathlib
+import shutil
+import tempfile
+import numpy as np
+
+
+logger = logging.getLogger(__name__)   # pylint: disable=invalid-name
+
+
+# The shared arrays, as attached in the current process
+_ARRAYS = {}
+# Directory with arrays shared after the pool was started
+_DIRECTORY = None
+# The active persistent pool, in the process that created it
+_ACTIVE = None
+
+
+def _backing_file(array):
+    """Return the .npy file that `array` is memory-mapped from, or None
+
+    Only arrays opened with `numpy.load` with `mmap_mode` (not views of
+    those) qualify.
+
+    """
+
+    if (isinstance(array, np.memmap) and array.filename
+            and isinstance(array.base, mmap.mmap)):
+        return str(array.filename)
+    return None
+
+
+def _shared_buffer(array):
+    """Return the shared memory that holds (all of) `array`, or None
+
+    Only arrays created with `to_shared` (not views of part of those)
+    qualify.
+
+    """
+
+    base = array
+    while isinstance(base, np.ndarray):
+        base = base.base
+    if (isinstance(base, ctypes.Array) and array.flags.c_contiguous
+            and array.ctypes.data == ctypes.addressof(base)):
+        return base
+    return None
+
+
+def to_shared(array):
+    """Return a copy of `array` in shared memory
+
+    Memory-mapped arrays, and arrays that are already in shared memory,
+    are returned as is. Arrays in shared memory are shared with the
+    workers of a `WorkerPool` without further copies.
+
+    """
+
+    if _backing_file(array) or _shared_buffer(array) is not None:
+        return array
+    array = np.ascontiguousarray(array)
+    raw = multiprocessing.RawArray('b', max(array.nbytes, 1))
+    view = np.frombuffer(raw, dtype=array.dtype, count=array.size).reshape(array.shape)
+    view[...] = array
+    return view
+
+
+def share(arrays):
+    """Place a dict of arrays in shared memory
+
+    Memory-mapped arrays are referred to by their file name instead;
+    arrays already in shared memory are not copied. Returns a dict with
+    the same keys, to be passed to `attach`.
+
+    """
+
+    shared = {}
+    for key, array in arrays.items():
+        filename = _backing_file(array)
+        if filename:
+            shared[key] = filename
+            continue
+        array = to_shared(array)
+        shared[key] = (_shared_buffer(array), array.dtype, array.shape)
+    return shared
+
+
+def attach(shared, directory=None):
+    """Wrap shared memory as read-only arrays, accessible through `get`
+
+    This is the pool initializer. `directory` contains the arrays that
+    are shared after the pool was started.
+
+    """
+
+    global _DIRECTORY   # pylint: disable=global-statement
+    _ARRAYS.clear()
+    _DIRECTORY = directory
+    for key, value in shared.items():
+        if isinstance(value, str):
+            _ARRAYS[key] = np.load(value, mmap_mode='r')
+            continue
+        raw, dtype, shape = value
+        array = np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        array.flags.writeable = False
+        _ARRAYS[key] = array
+
+
+def _filename(key):
+    """Return the file name for an array shared after the start of the pool"""
+    return hashlib.sha256(repr(key).encode()).hexdigest() + '.npy'
+
+
+def get(key):
+    """Return the shared array for `key`"""
+
+    if key not in _ARRAYS:
+        if _DIRECTORY is None:
+            raise KeyError(key)
+        path = pathlib.Path(_DIRECTORY) / _filename(key)
+        if not path.exists():
+            raise KeyError(key)
+        _ARRAYS[key] = np.load(path, mmap_mode='r')
+    return _ARRAYS[key]
+
+
+class WorkerPool:
+    """A process pool that is started once, and reused by all parallel stages
+
+    Use as a context manager: within the `with` block, `pool` returns
+    this pool (in the process that created it), instead of starting a
+    new pool. The worker processes are started on first use, so that
+    no processes are started if none of the stages uses them.
+
+    Usage example:
+
+        with WorkerPool(4, arrays={'data': data}):
+            ...
+            with pool(4) as workers:
+                results = workers.map(func, tasks)   # func uses get('data')
+
+    """
+
+    def __init__(self, nproc, arrays=None):
+        self.nproc = nproc
+        self.pid = os.getpid()
+        self.directory = None
+        self.arrays = dict(arrays) if arrays else {}
+        self._pool = None
+        self._previous = None
+
+    def start(self):
+        """Start the worker processes, if not done yet
+
+        This happens automatically on first use. Arrays shared until
+        then are placed in shared memory, and attached in the workers
+        at start-up.
+
+        """
+
+        if self._pool is not None:
+            return
+        self.directory = tempfile.mkdtemp(prefix='kcs-resample-')
+        shared = share(self.arrays)
+        # The pool outlives this method: `close` or `terminate` shut it down
+        self._pool = multiprocessing.Pool(  # pylint: disable=consider-using-with
+            self.nproc, initializer=attach, initargs=(shared, self.directory))
+        # Make the arrays available to tasks run in this process as well
+        attach(shared, self.directory)
+        logger.debug("Started a pool of %d processes, sharing %d arrays",
+                     self.nproc, len(self.arrays))
+
+    def __enter__(self):
+        global _ACTIVE   # pylint: disable=global-statement
+        self._previous, _ACTIVE = _ACTIVE, self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _ACTIVE   # pylint: disable=global-statement
+        _ACTIVE = self._previous
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def share(self, arrays):
+        """Share (additional) arrays with the workers"""
+
+        for key, array in arrays.items():
+            if key in self.arrays:
+                continue
+            self.arrays[key] = array
+            if self._pool is not None:
+                path = pathlib.Path(self.directory) / _filename(key)
+                filename = _backing_file(array)
+                if filename:
+                    os.symlink(filename, path)
+                else:
+                    np.save(path, np.asarray(array))
+                _ARRAYS[key] = array
+
+    def map(self, func, iterable):
+        """As `multiprocessing.Pool.map`"""
+        self.start()
+        return self._pool.map(func, iterable)
+
+    def imap(self, func, iterable):
+        """As `multiprocessing.Pool.imap`"""
+        self.start()
+        return self._pool.imap(func, iterable)
+
+    def close(self):
+        """Wait for the workers to finish, and clean up"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._pool = None
+
+    def terminate(self):
+        """Stop the workers immediately, and clean up"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._pool = None
+
+
+@contextlib.contextmanager
+def pool(nproc, arrays=None):
+    """Return the active `WorkerPool`, or else start a temporary one
+
+    `arrays` are shared with the workers of either pool.
+
+    """
+
+    if _ACTIVE is not None and _ACTIVE.pid == os.getpid():
+        _ACTIVE.share(arrays or {})
+        yield _ACTIVE
+    else:
+        with WorkerPool(nproc, arrays) as workers:
+            yield workers
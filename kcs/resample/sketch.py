@@ -0,0 +1,120 @@
+"""Mergeable histogram sketches of segmented data
+
+For long (daily) time series, stacking the values of all selected
+segments of every resample, to calculate its percentiles, is slow and
+takes a lot of memory. Instead, the values of each segment (run and
+section) can be summarized once, in a histogram with fixed bins. All
+segments of a (variable, season, period) use the same bins, so that
+the histogram of a resample is simply the sum of the histograms of its
+segments.
+
+Percentiles are estimated from the summed histograms, by locating the
+bin that holds each required order statistic, and interpolating
+within that bin. Each estimate is then off by less than one bin width:
+with `nbins` bins spanning the data range, the error is less than the
+data range divided by `nbins`. The mean is calculated exactly, from
+the sum of the values of each segment.
+
+"""
+
+import collections
+import math
+import numpy as np
+
+
+Sketch = collections.namedtuple('Sketch', ['counts', 'sums', 'limits'])
+Sketch.__doc__ = """Histograms of all segments of segmented data
+
+- counts: (nruns, nsections, nbins) array with the histogram of each segment
+- sums: (nruns, nsections) array with the sum of the values of each segment
+- limits: the lower and upper limit of the bins
+"""
+
+
+def nbins_for(error):
+    """Return the number of bins for a maximum percentile error of
+    `error`, as a fraction of the data range"""
+
+    if not 0 < error < 1:
+        raise ValueError(f"the sketch error should be between 0 and 1, not {error}")
+    return math.ceil(1 / error)
+
+
+def sketch_segments(segments, error):
+    """Calculate the histogram sketch of segmented data
+
+    `segments` is a (nruns, nsections, ntimes) array, where NaN values
+    (padding) are ignored. `error` is the maximum error of the
+    percentiles, as a fraction of the data range.
+
+    """
+
+    nbins = nbins_for(error)
+    nruns, nsections = segments.shape[:2]
+    if np.isnan(segments).all():
+        lower = upper = 0.0
+    else:
+        lower, upper = float(np.nanmin(segments)), float(np.nanmax(segments))
+    scale = nbins / (upper - lower) if upper > lower else 0.0
+
+    counts = np.empty((nruns, nsections, nbins), dtype=np.int32)
+    offsets = np.arange(nsections)[:, None] * nbins
+    # One run at a time, to limit the size of the temporary bin numbers
+    for run in range(nruns):
+        values = segments[run].astype(np.float64)
+        valid = ~np.isnan(values)
+        values[~valid] = lower
+        bins = np.minimum(((values - lower) * scale).astype(np.int64), nbins - 1)
+        bins = (bins + offsets)[valid]
+        counts[run] = np.bincount(bins, minlength=nsections * nbins).reshape(nsections, nbins)
+    sums = np.nansum(segments, axis=-1, dtype=np.float64)
+    return Sketch(counts, sums, np.array([lower, upper]))
+
+
+def _order_statistics(cumulative, ranks, limits):
+    """Estimate the values at (integer) `ranks` from cumulative histograms"""
+
+    nbins = cumulative.shape[1]
+    width = (limits[1] - limits[0]) / nbins
+    index = (cumulative <= ranks[:, None]).sum(axis=1)
+    index = np.minimum(index, nbins - 1)
+    rows = np.arange(len(cumulative))
+    count = cumulative[rows, index] - np.where(index > 0, cumulative[rows, index - 1], 0)
+    before = cumulative[rows, index] - count
+    # Spread the values in the bin evenly over the bin
+    position = (ranks - before + 0.5) / np.maximum(count, 1)
+    return limits[0] + (index + position) * width
+
+
+def sketch_statistics(sketch, rows, percentiles):
+    """Calculate the mean and percentiles of resamples from a sketch
+
+    `rows` is a (nresamples, nsections) array of run indices, as for
+    `segment_statistics`. The percentiles follow the definition of
+    `numpy.percentile` (linear interpolation between the nearest
+    values), and are accurate to within one bin width.
+
+    Returns a (nresamples, 1 + len(percentiles)) array, with the mean
+    followed by the percentiles.
+
+    """
+
+    columns = np.arange(sketch.counts.shape[1])
+    counts = sketch.counts[rows, columns].sum(axis=1, dtype=np.int64)
+    cumulative = np.cumsum(counts, axis=1)
+    total = cumulative[:, -1]
+    valid = total > 0
+    total = np.maximum(total, 1)
+
+    stats = np.empty((len(rows), 1 + len(percentiles)))
+    stats[:, 0] = sketch.sums[rows, columns].sum(axis=1) / total
+    for i, perc in enumerate(percentiles, start=1):
+        rank = perc / 100 * (total - 1)
+        below = np.floor(rank).astype(np.int64)
+        above = np.minimum(below + 1, total - 1)
+        low = _order_statistics(cumulative, below, sketch.limits)
+        high = _order_statistics(cumulative, above, sketch.limits)
+        stats[:, i] = low + (rank - below) * (high - low)
+    stats[:, 1:] = np.clip(stats[:, 1:], sketch.limits[0], sketch.limits[1])
+    stats[~valid] = np.nan
+    return stats
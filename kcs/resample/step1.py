@@ -0,0 +1,495 @@
+"""Step 1: select the resamples closest to a target
+
+Step 1 scores resamples by the distance of their winter precipitation
+change to the scenario target, and keeps the `nstep1` best. The
+resamples are either given as a `Combinations` space of resample IDs,
+or as an array of index rows. The step 1 methods ("full", "stream",
+"mitm" and "index") all return the same ranking; see `calculate_s1`.
+
+"""
+
+from datetime import datetime
+import logging
+import numpy as np
+from ..config import default_config
+from .combinations import Combinations, smallest_uint
+from . import shared
+
+
+# Default number of resamples (index rows) that are scored at once in step 1
+CHUNKSIZE = 100_000
+
+
+logger = logging.getLogger(__name__)   # pylint: disable=invalid-name
+
+
+class Calculation:
+    """Class to calculate the difference between a calculated precipiation
+    change, and a target value
+
+    We use a class, so it can be used with multiprocessing: fixed
+    arguments are passed to the constructor, while the variable
+    argument (the subselection of the data) is passed to the call
+    method.
+
+    The call method takes a block of index rows (a 2D array, one
+    resample per row), not a single row: the segment values for the
+    whole block are gathered with one fancy-indexing operation, and
+    averaged in one go. This avoids a Python function call (and, with
+    multiprocessing, the pickling of a task) per resample.
+
+    If `combinations` is given, the blocks are resample IDs (or a
+    `range` of IDs), which are first decoded into index rows.
+
+    If `target` is None, the resample averages themselves are returned.
+
+    An alternative is the use of functools.partial.
+
+    """
+
+    def __init__(self, data, target, combinations=None):
+        self.data = data
+        self.target = target
+        self.combinations = combinations
+        self.cols = np.arange(data.shape[1])
+
+    def __call__(self, indices):
+        if self.combinations is not None:
+            indices = self.combinations.decode(indices)
+        means = self.data[indices, self.cols].mean(axis=1)
+        if self.target is None:
+            return means
+        # Subtract in double precision, as was done for the per-row
+        # (scalar) calculation: this keeps the ordering of near-ties identical
+        return np.abs(means.astype(np.float64) - self.target)
+
+
+def score_indices(data, indices, target, nproc=1, chunksize=CHUNKSIZE):
+    """Calculate the distance to the target value for all resample indices
+
+    `indices` is either a `Combinations` object, or an array of index
+    rows. The indices are scored in blocks of `chunksize` resamples,
+    which are distributed over `nproc` processes if `nproc` > 1. If
+    `target` is None, the resample averages are returned instead (see
+    `Calculation`).
+
+    Returns an array with a value for each resample, in the order of
+    `indices`.
+
+    """
+
+    if isinstance(indices, Combinations):
+        calculation = Calculation(data, target, combinations=indices)
+        blocks = list(indices.chunks(chunksize))
+    else:
+        calculation = Calculation(data, target)
+        blocks = [indices[i:i+chunksize] for i in range(0, len(indices), chunksize)]
+    tstart = datetime.now()
+    if nproc == 1:
+        values = list(map(calculation, blocks))
+    else:
+        with shared.pool(nproc) as pool:
+            values = pool.map(calculation, blocks)
+    logger.debug("time(calculation) = %s", datetime.now() - tstart)
+    return np.concatenate(values)
+
+
+def rank_indices(data, indices, target, nproc=1, chunksize=CHUNKSIZE):
+    """Order the resample indices by their distance to the target value
+
+    `indices` is either a `Combinations` object, or an array of index
+    rows. The indices are scored in blocks of `chunksize` resamples,
+    which are distributed over `nproc` processes if `nproc` > 1.
+
+    Returns the resample IDs (for a `Combinations` object) or the
+    index rows, sorted from closest to furthest. Equal distances keep
+    the order of `indices`, as with the other step 1 methods.
+
+    """
+
+    values = score_indices(data, indices, target, nproc=nproc, chunksize=chunksize)
+    order = np.argsort(values, kind='stable')
+
+    if isinstance(indices, Combinations):
+        # The position in the combination space is the ID itself
+        return order.astype(indices.dtype)
+    return indices[order]
+
+
+def build_mean_index(data, indices, nproc=1, chunksize=CHUNKSIZE):
+    """Calculate the averages of all resamples, and sort them
+
+    The resulting index does not depend on a target value: the
+    resamples closest to any target can then be found with
+    `query_mean_index`, without scoring all resamples again. It takes
+    (nruns^nsections) times the size of an average plus that of a
+    resample ID (usually 4 + 4 bytes).
+
+    `indices` is either a `Combinations` object, or an array of index
+    rows. The averages are calculated in blocks of `chunksize`
+    resamples, in `nproc` processes if `nproc` > 1.
+
+    Returns the sorted averages, and the corresponding positions in
+    `indices` (for a `Combinations` object, the resample IDs).
+
+    """
+
+    means = score_indices(data, indices, None, nproc=nproc, chunksize=chunksize)
+    order = np.argsort(means, kind='stable')
+    dtype = indices.dtype if isinstance(indices, Combinations) else smallest_uint(len(indices))
+    return means[order], order.astype(dtype)
+
+
+def query_mean_index(means, positions, target, nselect):
+    """Select the `nselect` resamples closest to `target` from a sorted
+    index, as created by `build_mean_index`
+
+    Since the averages are sorted, the closest resamples form a
+    contiguous block around the target value: a binary search plus a
+    window of `nselect` on each side finds them. Ties are ordered by
+    position, as in `select_closest`.
+
+    Returns the positions of the closest resamples, ordered from
+    closest to furthest.
+
+    """
+
+    nselect = min(nselect, len(means))
+    pos = np.searchsorted(means, target)
+    low = max(pos - nselect, 0)
+    high = min(pos + nselect, len(means))
+
+    def score(i):
+        return abs(float(means[i]) - target)
+
+    scores = np.abs(means[low:high].astype(np.float64) - target)
+    threshold = np.partition(scores, nselect - 1)[nselect - 1]
+    # Extend the window with any resamples that are as close as the
+    # furthest selected one: the distance only increases moving away
+    # from the target, so these are found next to the window edges
+    start, stop = low, high
+    while start > 0 and score(start - 1) <= threshold:
+        start -= 1
+    while stop < len(means) and score(stop) <= threshold:
+        stop += 1
+    if (start, stop) != (low, high):
+        scores = np.abs(means[start:stop].astype(np.float64) - target)
+
+    window = positions[start:stop]
+    order = np.lexsort((window, scores))[:nselect]
+    return window[order]
+
+
+def select_closest(data, indices, target, nselect, nproc=1, chunksize=CHUNKSIZE,
+                   start=0, stop=None, scores=False):
+    """Select the `nselect` resample indices closest to the target value
+
+    This streams over the indices: each chunk of `chunksize`
+    resamples is scored, and merged with the best `nselect` resamples
+    so far, after which only the best `nselect` are kept. Peak memory
+    usage thus depends on `nselect` and `chunksize`, not on the total
+    number of resamples. Chunks are scored in `nproc` processes if
+    `nproc` > 1.
+
+    `indices` is either a `Combinations` object, or an array of index
+    rows. Returns the resample IDs (for a `Combinations` object) or
+    index rows, sorted from closest to furthest; equal distances are
+    ordered by ID (or row number).
+
+    Only the resamples from position (ID) `start` up to `stop` are
+    considered, if given. With `scores`, the distances to the target
+    are returned as well, as a second array.
+
+    """
+
+    if stop is None:
+        stop = len(indices)
+    if isinstance(indices, Combinations):
+        calculation = Calculation(data, target, combinations=indices)
+        chunks = list(indices.chunks(chunksize, start, stop))
+        blocks = chunks
+    else:
+        calculation = Calculation(data, target)
+        chunks = [range(i, min(i+chunksize, stop)) for i in range(start, stop, chunksize)]
+        blocks = (indices[chunk.start:chunk.stop] for chunk in chunks)
+
+    tstart = datetime.now()
+    if nproc == 1:
+        best, values = _stream_closest(chunks, map(calculation, blocks), nselect)
+    else:
+        with shared.pool(nproc) as pool:
+            best, values = _stream_closest(chunks, pool.imap(calculation, blocks), nselect)
+    logger.debug("time(calculation) = %s", datetime.now() - tstart)
+
+    order = np.lexsort((best, values))
+    best, values = best[order], values[order]
+    best = best.astype(indices.dtype) if isinstance(indices, Combinations) else indices[best]
+    if scores:
+        return best, values
+    return best
+
+
+def _stream_closest(chunks, results, nselect):
+    """Merge the scores of consecutive chunks, keeping the best `nselect`"""
+
+    best = np.empty(0, dtype=np.int64)
+    values = np.empty(0, dtype=np.float64)
+    for chunk, chunkvalues in zip(chunks, results):
+        best = np.concatenate([best, np.arange(chunk.start, chunk.stop)])
+        values = np.concatenate([values, chunkvalues])
+        if len(values) > nselect:
+            best, values = _keep_closest(best, values, nselect)
+    return best, values
+
+
+def _keep_closest(positions, values, nselect):
+    """Keep the `nselect` positions with the lowest values
+
+    For equal values at the cut-off, the lowest positions are kept.
+
+    """
+
+    kth = np.partition(values, nselect-1)[nselect-1]
+    below = values < kth
+    equal = np.flatnonzero(values == kth)
+    equal = equal[np.argsort(positions[equal], kind='stable')]
+    keep = np.concatenate([np.flatnonzero(below), equal[:nselect - below.sum()]])
+    return positions[keep], values[keep]
+
+
+def search_closest(data, combinations, target, nselect):
+    """Select the `nselect` resamples closest to the target value, using
+    a meet-in-the-middle search
+
+    The score of a resample is the absolute difference between the
+    mean over its sections and the target, and that mean is a sum of
+    independent contributions from each section. The sections are
+    therefore split into two halves, and the partial sums over each
+    half are calculated for all (nsets^(nsections/2)) partial
+    resamples. The partial sums of the second half are sorted, so that
+    the number of resamples within a distance `d` of the target can
+    be counted with a binary search for each partial sum of the first
+    half. Bisecting on `d` yields the smallest distance that includes
+    at least `nselect` resamples; only those resamples are then
+    enumerated.
+
+    This takes roughly O(n^(k/2) log n) instead of O(n^k) time (for n
+    sets and k sections), and O(n^(k/2)) memory.
+
+    The candidate resamples are rescored with `Calculation`, and the
+    result is exactly that of `select_closest`: the resample IDs,
+    sorted from closest to furthest, with equal distances ordered by
+    ID.
+
+    """
+
+    nsets, nsections = combinations.nsets, combinations.nsections
+    nselect = min(nselect, len(combinations))
+    calculation = Calculation(data, target, combinations=combinations)
+    data = np.asarray(data, dtype=np.float64)
+    nhalf = nsections // 2
+    first = Combinations(nsets, nhalf)
+    second = Combinations(nsets, nsections - nhalf)
+    cols = np.arange(nsections)
+    sum1 = data[first.decode(range(len(first))), cols[:nhalf]].sum(axis=1)
+    sum2 = data[second.decode(range(len(second))), cols[nhalf:]].sum(axis=1)
+    # Sort both halves: the second half for the binary search, the first
+    # half (in descending order) so the search keys are in ascending order,
+    # which makes the search much faster for large arrays
+    order1 = np.argsort(-sum1, kind='stable')
+    sum1 = sum1[order1]
+    order2 = np.argsort(sum2, kind='stable')
+    sum2 = sum2[order2]
+    # Work with sums instead of means: the target scales along
+    target = target * nsections
+
+    def window(distance):
+        low = np.searchsorted(sum2, target - sum1 - distance, side='left')
+        high = np.searchsorted(sum2, target - sum1 + distance, side='right')
+        return low, high
+
+    def count(distance):
+        low, high = window(distance)
+        return (high - low).sum()
+
+    scale = np.abs(sum1).max() + np.abs(sum2).max() + abs(target)
+    if len(sum1) >= nselect:
+        # Each first-half sum with its nearest second-half sum yields a
+        # distinct resample, so the nselect-th smallest of these
+        # distances includes at least nselect resamples
+        pos = np.searchsorted(sum2, target - sum1)
+        right = np.minimum(pos, len(sum2) - 1)
+        left = np.maximum(pos - 1, 0)
+        nearest = np.minimum(np.abs(sum1 + sum2[right] - target),
+                             np.abs(sum1 + sum2[left] - target))
+        upper = np.partition(nearest, nselect-1)[nselect-1]
+    else:
+        upper = 2 * scale
+    # Bisect until the number of resamples to enumerate is reasonably small
+    lower = 0.0
+    nupper = count(upper)
+    for _ in range(64):
+        middle = (lower + upper) / 2
+        if nupper <= 4 * nselect or middle in (lower, upper):
+            break
+        nmiddle = count(middle)
+        if nmiddle >= nselect:
+            upper, nupper = middle, nmiddle
+        else:
+            lower = middle
+
+    # Allow for rounding differences with the rescoring below, unless
+    # the resamples are so dense that this would include far too many
+    low, high = window(upper + 1e-6 * scale)
+    if (high - low).sum() > max(16 * nupper, CHUNKSIZE):
+        low, high = window(upper)
+    counts = high - low
+    total = counts.sum()
+    index1 = np.repeat(order1, counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    index2 = order2[np.repeat(low, counts) + offsets]
+    ids = index1.astype(np.uint64) * np.uint64(len(second)) + index2.astype(np.uint64)
+
+    values = calculation(ids)
+    ids = ids[np.lexsort((ids, values))][:nselect]
+    logger.debug("Meet-in-the-middle: %d candidates for %d resamples", total, nselect)
+
+    return ids.astype(combinations.dtype)
+
+
+def calculate_s1(means, indices, target, var='pr', season='djf', nproc=None,
+                 nstep1=None, method=None, chunksize=None, cache=None):
+    """Calculate the subset S1: winter precipitation change equals `target`
+
+    `indices` is the `Combinations` space (as created by
+    `create_indices`), or an array of index rows. The result, for
+    both the future and control period, is then an array of sorted
+    resample IDs, or of sorted index rows, respectively.
+
+    With `method` "full", all resamples are scored and sorted. With
+    `method` "stream", only the best `nstep1` resamples are kept (and
+    returned) while scoring the resamples `chunksize` at a time. With
+    `method` "mitm", the best `nstep1` resamples are found with a
+    meet-in-the-middle search; this requires `indices` to be a
+    `Combinations` object. With `method` "index", the averages of all
+    resamples are sorted once, after which the best `nstep1` resamples
+    for a target are found with a binary search.
+
+    The control period ranking does not depend on `target`. If a
+    `cache` dict is given, the control ranking is stored in it, and
+    reused by later calls with the same control period averages (and
+    the same `indices`). The same goes for the sorted index of the
+    "index" method, which is reused for other targets.
+
+    """
+
+    if not nproc:
+        nproc = default_config['resampling']['nproc']
+    if not nstep1:
+        nstep1 = default_config['resampling']['nstep1']
+    if not method:
+        method = default_config['resampling']['step1_method']
+    if not chunksize:
+        chunksize = default_config['resampling']['chunksize']
+
+    rank = s1_ranker(indices, nproc, nstep1, method, chunksize, cache=cache)
+
+    # Calculate the procentual change in winter precipitation for all sections individually,
+    # With respect to an overall-averaged control period
+    controlmean = s1_controlmean(means, var, season)
+    data = means.get(var, season, 'future')
+    data = 100 * (data - controlmean) / controlmean
+
+    selind = {'future': rank(data, target)}
+    selind['control'] = calculate_s1_control(means, indices, var, season, nproc=nproc,
+                                             nstep1=nstep1, method=method,
+                                             chunksize=chunksize, cache=cache)
+
+    return selind
+
+
+def calculate_s1_control(means, indices, var='pr', season='djf', nproc=None,
+                         nstep1=None, method=None, chunksize=None, cache=None):
+    """Calculate the control period part of subset S1
+
+    The control period resamples are ranked by their distance to the
+    overall control period average. See `calculate_s1` for the
+    arguments.
+
+    """
+
+    if not nproc:
+        nproc = default_config['resampling']['nproc']
+    if not nstep1:
+        nstep1 = default_config['resampling']['nstep1']
+    if not method:
+        method = default_config['resampling']['step1_method']
+    if not chunksize:
+        chunksize = default_config['resampling']['chunksize']
+
+    data = means.get(var, season, 'control')
+    cachekey = (var, season, method, nstep1, data.shape, data.tobytes())
+    if cache is not None and cachekey in cache:
+        logger.debug("Reusing the step 1 control ranking")
+        return cache[cachekey]
+
+    # There is only one control target: no use keeping a sorted index
+    rank = s1_ranker(indices, nproc, nstep1, method, chunksize)
+    ranking = rank(data - s1_controlmean(means, var, season), 0)
+    if cache is not None:
+        cache[cachekey] = ranking
+    return ranking
+
+
+def s1_controlmean(means, var, season):
+    """Return the overall control period average used in step 1"""
+
+    controlmean = means.get(var, season, 'control')
+    # Average each section over the runs, then average the sections.
+    # Summing contiguous values keeps the result identical to the
+    # (column-wise) summation of the former DataFrame implementation.
+    return np.ascontiguousarray(controlmean.T).mean(axis=1).mean()
+
+
+def s1_ranker(indices, nproc, nstep1, method, chunksize, cache=None):
+    """Return a function that ranks `indices` for given data and target,
+    with the step 1 `method`
+
+    For the "index" method, the sorted index is kept in `cache` (if
+    given), keyed by the data, so that further targets for the same
+    data only require a query of the index.
+
+    """
+
+    if method == 'full':
+        def rank(data, target):
+            return rank_indices(data, indices, target, nproc=nproc, chunksize=chunksize)
+    elif method == 'stream':
+        def rank(data, target):
+            return select_closest(data, indices, target, nstep1,
+                                  nproc=nproc, chunksize=chunksize)
+    elif method == 'mitm':
+        if not isinstance(indices, Combinations):
+            raise ValueError("the 'mitm' step 1 method requires a Combinations object")
+
+        def rank(data, target):
+            return search_closest(data, indices, target, nstep1)
+    elif method == 'index':
+        def rank(data, target):
+            key = ('index', repr(indices) if isinstance(indices, Combinations) else len(indices),
+                   data.shape, data.tobytes())
+            if cache is not None and key + ('means',) in cache:
+                logger.debug("Reusing the step 1 sorted index")
+                means, positions = cache[key + ('means',)], cache[key + ('positions',)]
+            else:
+                means, positions = build_mean_index(data, indices, nproc=nproc,
+                                                    chunksize=chunksize)
+                if cache is not None:
+                    cache[key + ('means',)], cache[key + ('positions',)] = means, positions
+            positions = query_mean_index(means, positions, target, nstep1)
+            if isinstance(indices, Combinations):
+                return positions
+            return indices[positions]
+    else:
+        raise ValueError(f"unknown step 1 method: {method}")
+    return rank
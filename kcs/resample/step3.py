@@ -0,0 +1,302 @@
+"""Step 3: select combinations of resamples with the lowest penalty
+
+Step 3 draws samples of `nstep3` resamples from the S2 subset (see
+`calculate_s3`), and keeps the sample whose segments are reused least,
+as scored with the penalties for repeated segments.
+
+"""
+
+from datetime import datetime
+import itertools
+import logging
+import math
+import numpy as np
+from ..config import default_config
+from . import shared
+
+
+# Default number of samples that are drawn and scored at once in step 3
+BATCHSIZE = 1000
+
+
+logger = logging.getLogger(__name__)   # pylint: disable=invalid-name
+
+
+def penalty_lookup(penalties, nstep3):
+    """Create an array with the penalty for each number of occurrences
+    of a segment, from 0 up to and including `nstep3`
+
+    Numbers of occurrences missing from `penalties` get an infinite
+    penalty; no occurrence has no penalty.
+
+    """
+
+    lookup = np.array([penalties.get(count, math.inf) for count in range(nstep3 + 1)],
+                      dtype=np.float64)
+    lookup[0] = 0
+    return lookup
+
+
+def score_selections(selections, lookup, nsets):
+    """Calculate the total penalty for a batch of S3 selections
+
+    `selections` is an array of index rows with shape (batch, nstep3,
+    nsections). The occurrences of each segment are counted for all
+    selections and sections at once, with a single `np.bincount` over
+    the segment indices offset by selection and section, and the
+    counts are converted to penalties with the `lookup` array (as
+    created by `penalty_lookup`).
+
+    Returns an array with the penalty for each selection.
+
+    """
+
+    nbatch, _, nsections = selections.shape
+    offsets = (np.arange(nbatch)[:, np.newaxis, np.newaxis] * nsections +
+               np.arange(nsections)) * nsets
+    counts = np.bincount((selections + offsets).ravel(), minlength=nbatch * nsections * nsets)
+    return lookup[counts].reshape(nbatch, -1).sum(axis=1)
+
+
+def _s3_random(rows, lookup, nsets, nstep3, nsample, minimum_penalty, rng,
+               batchsize=BATCHSIZE):
+    """Find the S3 selection with the lowest penalty by random sampling
+
+    The random samples are drawn and scored in batches of `batchsize`
+    samples (see `score_selections`). The (last found) best sample is
+    kept, and sampling stops at the first sample with a penalty below
+    `minimum_penalty`.
+
+    Returns the best penalty and the corresponding selection of rows.
+
+    """
+
+    n = len(rows)  # pylint: disable=invalid-name
+    best, selection = np.inf, None
+    for first in range(0, nsample, batchsize):
+        nbatch = min(batchsize, nsample - first)
+        # The nstep3 smallest of uniform random keys form a random subset
+        keys = rng.random((nbatch, n))
+        choices = rows[np.argpartition(keys, nstep3 - 1, axis=1)[:, :nstep3]]
+        values = score_selections(choices, lookup, nsets)
+        below = np.flatnonzero(values < minimum_penalty)
+        if len(below):
+            i = below[0]
+        else:
+            # Last occurrence of the minimum, as ties replace the best sample
+            i = nbatch - 1 - np.argmin(values[::-1])
+        if values[i] <= best:
+            best, selection = values[i], choices[i]
+        if best < minimum_penalty:
+            logger.debug("Minimum penalty reached after %d iterations", first + i)
+            break
+    return best, selection
+
+
+def _s3_exact(rows, lookup, nsets, nstep3, minimum_penalty, batchsize=BATCHSIZE):
+    """Find the S3 selection with the lowest penalty by scoring all
+    possible selections, `batchsize` at a time
+
+    Stops at the first selection with a penalty below `minimum_penalty`.
+
+    Returns the best penalty and the corresponding selection of rows.
+
+    """
+
+    combs = itertools.combinations(range(len(rows)), nstep3)
+    best, selection = np.inf, None
+    nscored = 0
+    while True:
+        batch = np.fromiter(itertools.chain.from_iterable(itertools.islice(combs, batchsize)),
+                            dtype=np.intp).reshape(-1, nstep3)
+        if batch.size == 0:
+            break
+        choices = rows[batch]
+        values = score_selections(choices, lookup, nsets)
+        i = np.argmin(values)
+        if values[i] < best or selection is None:
+            best, selection = values[i], choices[i]
+        nscored += len(batch)
+        if best < minimum_penalty:
+            logger.debug("Minimum penalty reached after %d selections", nscored)
+            break
+    return best, selection
+
+
+def _s3_anneal(rows, lookup, nsets, nstep3, nsample, minimum_penalty, rng):
+    """Find an S3 selection with a low penalty with simulated annealing
+
+    Starting from a random selection, each of the `nsample` steps
+    proposes to swap one selected row for one unselected row. The
+    segment occurrence counts are updated incrementally, so a step
+    only looks at the two rows involved. Improvements are always
+    accepted, deteriorations with a probability that decreases with
+    the (geometrically decreasing) temperature. Infinite penalties
+    are replaced by a finite value that exceeds any finite total
+    penalty, so that the search can move away from them.
+
+    Stops at the first selection with a penalty below `minimum_penalty`.
+
+    Returns the best penalty and the corresponding selection of rows.
+
+    """
+
+    n, nsections = rows.shape  # pylint: disable=invalid-name
+    finite = lookup[np.isfinite(lookup)]
+    surrogate = np.where(np.isfinite(lookup), lookup,
+                         (finite.max() + 1) * nstep3 * nsections)
+
+    order = rng.permutation(n)
+    selected, unselected = order[:nstep3], order[nstep3:]
+    cols = np.arange(nsections)
+    counts = np.zeros((nsections, nsets), dtype=np.intp)
+    np.add.at(counts, (np.tile(cols, nstep3), rows[selected].ravel()), 1)
+    current = surrogate[counts].sum()
+    best, selection = lookup[counts].sum(), rows[selected]
+    if best < minimum_penalty or unselected.size == 0:
+        return best, selection
+
+    # Start at a temperature of order the smallest non-zero penalty
+    temperature = finite[finite > 0].min() if (finite > 0).any() else 1.0
+    cooling = 1e-3 ** (1 / nsample)
+    for step, (i, j, accept) in enumerate(zip(rng.integers(nstep3, size=nsample),
+                                              rng.integers(len(unselected), size=nsample),
+                                              rng.random(nsample))):
+        old, new = rows[selected[i]], rows[unselected[j]]
+        changed = old != new
+        count_old = counts[cols, old][changed]
+        count_new = counts[cols, new][changed]
+        delta = (surrogate[count_old - 1] - surrogate[count_old] +
+                 surrogate[count_new + 1] - surrogate[count_new]).sum()
+        temperature *= cooling
+        if delta <= 0 or accept < math.exp(-delta / temperature):
+            counts[cols, old] -= 1
+            counts[cols, new] += 1
+            selected[i], unselected[j] = unselected[j], selected[i]
+            current += delta
+            if current < best:
+                penalty = lookup[counts].sum()
+                if penalty < best:
+                    best, selection = penalty, rows[selected]
+            if best < minimum_penalty:
+                logger.debug("Minimum penalty reached after %d iterations", step)
+                break
+    return best, selection
+
+
+def _s3_chain(args):
+    """Run a single step 3 search chain, with its own random stream
+
+    The arguments are passed as a single tuple, for use with
+    multiprocessing.
+
+    """
+
+    method, rows, lookup, nsets, nstep3, nsample, minimum_penalty, seedseq = args
+    rng = np.random.default_rng(seedseq)   # pylint: disable=no-member
+    if method == 'exact':
+        return _s3_exact(rows, lookup, nsets, nstep3, minimum_penalty)
+    if method == 'anneal':
+        return _s3_anneal(rows, lookup, nsets, nstep3, nsample, minimum_penalty, rng)
+    return _s3_random(rows, lookup, nsets, nstep3, nsample, minimum_penalty, rng)
+
+
+def calculate_s3(indices_dict, penalties, nstep3=None, nsample=None,
+                 minimum_penalty=None, combinations=None, method=None, exact_limit=None,
+                 seed=None, nchains=None, nproc=None):
+
+    """Calculate the subset S3: find a subset with the least re-use of
+    segments
+
+    The `method` determines how the subset is searched for:
+
+    - "random": random sampling of `nsample` subsets
+
+    - "exact": score all possible subsets
+
+    - "anneal": simulated annealing, with `nsample` steps
+
+    - "auto": "exact" if the number of possible subsets is at most
+      `exact_limit`, "anneal" otherwise.
+
+    All methods stop as soon as a subset with a penalty below
+    `minimum_penalty` is found.
+
+    For each period, `nchains` independent searches are run (except
+    for the deterministic "exact" method), distributed over `nproc`
+    processes, and the subset with the lowest penalty is kept (the
+    first chain wins ties). Each chain gets its own random stream,
+    spawned from `seed` (an integer, a sequence of integers or a
+    `numpy.random.SeedSequence`). The result thus depends on `seed`
+    and `nchains`, but not on `nproc`. Without `nchains` (and a
+    configured number of chains), there is one chain per process.
+    Without a `seed`, fresh entropy is used, which is logged.
+
+    If `indices_dict` contains resample IDs instead of index rows, the
+    corresponding `combinations` should be given, to decode the
+    IDs. The selected subsets are always returned as index rows.
+
+    """
+
+    if not nstep3:
+        nstep3 = default_config['resampling']['nstep3']
+    if not nsample:
+        nsample = default_config['resampling']['nsample']
+    if minimum_penalty is None:
+        minimum_penalty = np.finfo(float).eps
+    if not method:
+        method = default_config['resampling']['step3_method']
+    if not exact_limit:
+        exact_limit = default_config['resampling']['step3_exact_limit']
+    if not nproc:
+        nproc = default_config['resampling']['nproc']
+    if not nchains:
+        nchains = default_config['resampling']['step3_nchains'] or nproc
+    if method not in ('random', 'exact', 'anneal', 'auto'):
+        raise ValueError(f"unknown step 3 method: {method}")
+
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    logger.debug("Step 3 seed entropy: %s", seed.entropy)
+    streams = dict(zip(sorted(indices_dict), seed.spawn(len(indices_dict))))
+
+    lookup = penalty_lookup(penalties, nstep3)
+    tasks = []
+    methods = {}
+    for period, indices in indices_dict.items():
+        n = len(indices)  # pylint: disable=invalid-name
+        if n < nstep3:
+            raise ValueError(f"cannot select {nstep3} resamples out of {n} "
+                             f"for the {period} period")
+        ncomb = math.factorial(n) // math.factorial(nstep3) // math.factorial(n - nstep3)
+        logger.debug("Number of combinations for the %s period = %d", period, ncomb)
+        rows = combinations.decode(indices) if combinations is not None else np.asarray(indices)
+        nsets = int(rows.max()) + 1
+        methods[period] = method
+        if method == 'auto':
+            methods[period] = 'exact' if ncomb <= exact_limit else 'anneal'
+        nperiod = 1 if methods[period] == 'exact' else nchains
+        for stream in streams[period].spawn(nperiod):
+            tasks.append((period, (methods[period], rows, lookup, nsets, nstep3, nsample,
+                                   minimum_penalty, stream)))
+
+    tstart = datetime.now()
+    if nproc == 1 or len(tasks) == 1:
+        results = list(map(_s3_chain, [args for _, args in tasks]))
+    else:
+        with shared.pool(min(nproc, len(tasks))) as pool:
+            results = pool.map(_s3_chain, [args for _, args in tasks])
+    logger.debug("time(step 3) = %s", datetime.now() - tstart)
+
+    s3_indices = {}
+    best = {}
+    for (period, _), (penalty, selection) in zip(tasks, results):
+        if period not in best or penalty < best[period]:
+            best[period] = penalty
+            s3_indices[period] = selection
+    for period, period_method in methods.items():
+        logger.info("Best sample for %s (penalty: %f, method: %s, chains: %d): %s",
+                    period, best[period], period_method,
+                    1 if period_method == 'exact' else nchains, s3_indices[period])
+
+    return s3_indices
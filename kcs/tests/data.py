@@ -0,0 +1,188 @@
+"""Small synthetic data sets for the tests, and checks to compare results
+
+The extraction input are monthly global fields of 'tas'. The
+resampling input are monthly time series of area averages of 'tas'
+and 'pr', with year and season coordinates, as made by the
+extraction; the individual resampling steps take segment averages,
+segmented data or index rows.
+
+"""
+
+import math
+import numpy as np
+import pandas as pd
+import iris.coords
+import iris.cube
+import iris.coord_categorisation
+from cf_units import Unit
+
+
+YEARS = (1951, 2070)
+REFERENCE_PERIOD = (1991, 2020)
+PENALTIES = {1: 0.0, 2: 0.0, 3: 1.0, 4: math.inf}
+
+# Keyword arguments for `kcs.resample.calc`, for a quick calculation
+CALC_KWARGS = {'nstep1': 60, 'nstep3': 4, 'nsample': 200, 'nsections': 3,
+               'reference_period': REFERENCE_PERIOD, 'relative': ['pr'], 'seed': 1,
+               'nproc': 1}
+
+
+def field(seed, ntimes=24, nlat=18, nlon=36, masked=False):
+    """Create a cube with monthly global 'tas' fields
+
+    With `masked`, part of the data is masked.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    time = iris.coords.DimCoord(np.arange(ntimes) * 30.0 + 15, standard_name='time',
+                                units=Unit('days since 2000-01-01', calendar='360_day'))
+    lat = iris.coords.DimCoord(np.linspace(-85, 85, nlat), standard_name='latitude',
+                               units='degrees')
+    lon = iris.coords.DimCoord(np.linspace(5, 355, nlon), standard_name='longitude',
+                               units='degrees', circular=True)
+    for coord in (lat, lon):
+        coord.guess_bounds()
+    values = rng.random((ntimes, nlat, nlon)).astype(np.float32) + 273
+    if masked:
+        values = np.ma.masked_less(values, 273.1)
+    return iris.cube.Cube(values, var_name='tas', standard_name='air_temperature', units='K',
+                          dim_coords_and_dims=[(time, 0), (lat, 1), (lon, 2)])
+
+
+def save_fields(directory, nruns=2, **kwargs):
+    """Save the fields of `nruns` runs to netCDF files, named as CMIP
+    files; return the paths
+
+    Other keyword arguments are passed on to `field`.
+
+    """
+
+    paths = []
+    for run in range(1, nruns + 1):
+        paths.append(directory / f"tas_Amon_TEST_historical_r{run}i1p1_200001-200112.nc")
+        iris.save(field(run, **kwargs), str(paths[-1]))
+    return paths
+
+
+def monthly(values, start_year, var='pr'):
+    """Create a time series cube of monthly `values`, from January of
+    `start_year`, with year and season coordinates"""
+
+    months = np.arange(len(values))
+    time = iris.coords.DimCoord(months * 30 + 15, standard_name='time',
+                                units=Unit(f'days since {start_year}-01-01', calendar='360_day'))
+    cube = iris.cube.Cube(np.asarray(values, dtype=np.float32), var_name=var,
+                          dim_coords_and_dims=[(time, 0)])
+    iris.coord_categorisation.add_season(cube, 'time')
+    iris.coord_categorisation.add_year(cube, 'time')
+    return cube
+
+
+def timeseries(var, seed, years=YEARS):
+    """Create a random monthly time series cube, with year and season coordinates"""
+
+    rng = np.random.default_rng(seed)
+    nmonths = (years[1] - years[0] + 1) * 12
+    months = np.arange(nmonths)
+    base, scale = (280.0, 1.0) if var == 'tas' else (3e-5, 3e-6)
+    values = base + scale * (np.linspace(0, 3, nmonths) + rng.normal(size=nmonths) +
+                             np.sin(months * 2 * np.pi / 12))
+    return monthly(values, years[0], var)
+
+
+def save_timeseries(directory, var='pr', nruns=3):
+    """Save time series of `nruns` runs to netCDF files; return the paths"""
+
+    paths = []
+    for run in range(nruns):
+        paths.append(directory / f"{var}_{run}.nc")
+        iris.save(timeseries(var, run), str(paths[-1]))
+    return paths
+
+
+def dataset(nruns=5):
+    """Return a dataset (as read by `kcs.resample`) of `nruns` runs for 'tas' and 'pr'"""
+
+    rows = []
+    for i, var in enumerate(['tas', 'pr']):
+        for run in range(nruns):
+            rows.append({'var': var, 'cube': timeseries(var, 100 * i + run)})
+    return pd.DataFrame(rows)
+
+
+def steering_table():
+    """Return a steering table with two scenarios, for one epoch"""
+
+    return pd.DataFrame({'epoch': ['2050', '2050'], 'scenario': ['G', 'G'],
+                         'subscenario': ['L', 'H'], 'period': [(2036, 2065), (2036, 2065)],
+                         'precip_change': [2.0, 6.0]})
+
+
+def ranges():
+    """Return the step 2 percentile ranges for the scenarios of `steering_table`"""
+
+    conditions = [{'var': 'pr', 'season': 'jja', 'control': [10, 90], 'future': [10, 90]},
+                  {'var': 'tas', 'season': 'djf', 'control': [10, 90], 'future': [10, 90]}]
+    return {'G': {'L': {'2050': conditions}, 'H': {'2050': conditions}}}
+
+
+def segment_means(nruns, nsections, seed=1, ties=False):
+    """Return random (nruns, nsections) segment averages
+
+    With `ties`, the averages take only a few distinct values, so that
+    many resamples have the same score.
+
+    """
+
+    rng = np.random.default_rng(seed)
+    if ties:
+        return rng.integers(0, 3, (nruns, nsections)).astype(np.float32)
+    return rng.normal(size=(nruns, nsections)).astype(np.float32)
+
+
+def segments(nruns=6, nsections=3, ntimes=200, seed=1):
+    """Return random (nruns, nsections, ntimes) segmented data, with NaN
+    padding at the end of the segments of every other run"""
+
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(2.0, 1.5, (nruns, nsections, ntimes))
+    values[::2, :, ntimes - 17:] = np.nan
+    return values
+
+
+def index_rows(nsets, nsections, nrows=12, seed=1):
+    """Return random index rows (resamples) of `nsections` run indices"""
+
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, nsets, (nrows, nsections))
+
+
+def check_same_data(cube, expected, rtol=1e-6):
+    """Check that two cubes have the same shape, mask and data"""
+
+    assert cube.shape == expected.shape
+    np.testing.assert_array_equal(np.ma.getmaskarray(cube.data),
+                                  np.ma.getmaskarray(expected.data))
+    np.testing.assert_allclose(np.ma.filled(cube.data, 0), np.ma.filled(expected.data, 0),
+                               rtol=rtol)
+
+
+def check_same_indices(indices, expected):
+    """Check that two `kcs.resample.calc` results have the same resamples"""
+
+    assert set(indices) == set(expected)
+    for key, value in expected.items():
+        for period in ('control', 'future'):
+            np.testing.assert_array_equal(indices[key]['data'][period], value['data'][period])
+
+
+def check_same_diffs(diffs, expected):
+    """Check that two sets of resample statistics are identical"""
+
+    assert set(diffs) == set(expected)
+    for key, variables in expected.items():
+        for var, seasons in variables.items():
+            for season, diff in seasons.items():
+                assert list(diffs[key][var][season].columns) == list(diff.columns)
+                np.testing.assert_array_equal(diffs[key][var][season].values, diff.values)
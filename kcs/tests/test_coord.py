@@ -0,0 +1,156 @@
+"""Tests for the area extraction in kcs.utils.coord
+
+The results are compared with those of extracting each area
+separately, with iris.
+
+"""
+
+import iris
+import iris.analysis.cartography
+import numpy as np
+from kcs.tests import data
+from kcs.utils import coord
+
+
+BOXES = {'global': None, 'box': {'latitude': [40, 60], 'longitude': [0, 30]},
+         'band': {'lat': [-20, 20], 'lon': [100, 250]}}
+POINTS = {'point': {'lat': 51.25, 'lon': 6.25}, 'corner': {'lat': 80.0, 'lon': 352.0}}
+
+
+def average_area(cube, area):
+    """Extract and average a single area with iris"""
+
+    if area is not None:
+        cube = cube.extract(coord.parse_area(area)[0])
+    weights = iris.analysis.cartography.area_weights(cube)
+    return cube.collapsed(['latitude', 'longitude'], iris.analysis.MEAN, weights=weights)
+
+
+def test_area_weight_matrix():
+    """The weights of each area are the areas of its cells; the weights
+    are reused for a cube on the same grid"""
+
+    cube = data.field(1)
+    cells, weights, selections = coord.area_weight_matrix(cube, BOXES)
+    assert list(selections) == list(BOXES)
+    cellareas = iris.analysis.cartography.area_weights(cube[0]).ravel()
+    for i, area in enumerate(BOXES.values()):
+        extracted = cube[0] if area is None else cube[0].extract(coord.parse_area(area)[0])
+        assert np.isclose(weights[:, i].sum(),
+                          iris.analysis.cartography.area_weights(extracted).sum())
+        assert np.all((weights[:, i] == 0) | np.isclose(weights[:, i], cellareas[cells]))
+    assert coord.area_weight_matrix(data.field(2), BOXES)[1] is weights
+
+
+def test_average_areas():
+    """All boxes are averaged at once, as with separate extractions;
+    points are left out"""
+
+    for masked in (False, True):
+        cube = data.field(1, masked=masked)
+        results = coord.average_areas(cube, dict(BOXES, **POINTS))
+        assert list(results) == list(BOXES)
+        for name, area in BOXES.items():
+            expected = average_area(cube, area)
+            data.check_same_data(results[name], expected)
+            for coordname in ('latitude', 'longitude'):
+                np.testing.assert_allclose(results[name].coord(coordname).bounds,
+                                           expected.coord(coordname).bounds)
+
+
+def test_regrid_weights(tmp_path, monkeypatch):
+    """The regridding weights are stored in the directory and read back
+    from there by later runs"""
+
+    monkeypatch.setattr(coord, '_REGRID_WEIGHTS', {})
+    cube = data.field(1)
+    targetgrid = coord.create_grid()
+    latweights, lonweights = coord.regrid_weights(cube, targetgrid, directory=tmp_path)
+    assert latweights.shape == (targetgrid.shape[0], cube.shape[1])
+    assert lonweights.shape == (targetgrid.shape[1], cube.shape[2])
+    paths = list(tmp_path.glob('regrid-*.npz'))
+    assert len(paths) == 1
+
+    monkeypatch.setattr(coord, '_REGRID_WEIGHTS', {})
+    mtime = paths[0].stat().st_mtime_ns
+    weights = coord.regrid_weights(cube, targetgrid, directory=tmp_path)
+    assert paths[0].stat().st_mtime_ns == mtime
+    np.testing.assert_array_equal(weights[0], latweights)
+    np.testing.assert_array_equal(weights[1], lonweights)
+
+    # Same points, other bounds: separate weights
+    shifted = cube.copy()
+    shifted.coord('longitude').bounds = shifted.coord('longitude').bounds + 1
+    weights = coord.regrid_weights(shifted, targetgrid, directory=tmp_path)
+    assert len(list(tmp_path.glob('regrid-*.npz'))) == 2
+    assert not np.array_equal(weights[1], lonweights)
+
+
+def test_regrid_weights_memory(tmp_path, monkeypatch):
+    """By default, the regridding weights are kept in memory only"""
+
+    monkeypatch.setattr(coord, '_REGRID_WEIGHTS', {})
+    monkeypatch.chdir(tmp_path)
+    cube = data.field(1)
+    weights = coord.regrid_weights(cube, coord.create_grid())
+    assert coord.regrid_weights(cube, coord.create_grid()) is weights
+    assert not list(tmp_path.iterdir())
+
+
+def test_average_areas_regrid(tmp_path):
+    """Averaging on a target grid is the same as regridding first"""
+
+    targetgrid = coord.create_grid()
+    for masked in (False, True):
+        cube = data.field(1, masked=masked)
+        results = coord.average_areas(cube, BOXES, targetgrid=targetgrid, directory=tmp_path)
+        expected = coord.average_areas(cube.regrid(targetgrid, iris.analysis.AreaWeighted()),
+                                       BOXES)
+        assert list(results) == list(expected)
+        for name, result in results.items():
+            data.check_same_data(result, expected[name])
+
+
+def test_interpolate_points():
+    """All points are interpolated as with iris, for each point separately,
+    also across the longitude wrap-around"""
+
+    points = [(51.25, 6.25), (51.0, -3.2), (51.0, 356.8), (-60.5, 1.0), (10.0, 180.0),
+              (84.0, 359.0), (-84.9, 123.4)]
+    for masked in (False, True):
+        cube = data.field(1, masked=masked)
+        result = coord.interpolate_points(cube, points)
+        assert result.shape == (cube.shape[0], len(points))
+        assert result.dtype == cube.dtype
+        np.testing.assert_array_equal(result.coord('latitude').points,
+                                      [lat for lat, _ in points])
+        for i, (lat, lon) in enumerate(points):
+            expected = cube.interpolate([('latitude', lat), ('longitude', lon)],
+                                        iris.analysis.Linear())
+            data.check_same_data(result[:, i], expected)
+
+
+def test_extract_areas():
+    """Areas extracted from the part of the cube around the areas are
+    the same as those from the full cube"""
+
+    areas = {'box': BOXES['box'], 'point': POINTS['point'],
+             'points': {'points': [[51.25, 6.25], [45.0, 15.0]]}}
+    cube = data.field(1, masked=True)
+    # The box reaches west of the first longitude, so all longitudes are used
+    assert cube[coord.area_hyperslab(cube, areas)].shape == (cube.shape[0], 4, cube.shape[2])
+    index = coord.area_hyperslab(cube, {'box': {'latitude': [40, 60], 'longitude': [10, 30]}})
+    assert cube[index].shape == (cube.shape[0], 4, 4)
+    assert coord.area_hyperslab(cube, BOXES) == (slice(None),) * cube.ndim
+
+    results = coord.extract_areas(cube, areas)
+    assert list(results) == list(areas)
+    data.check_same_data(results['box'], average_area(cube, areas['box']))
+    data.check_same_data(results['point'],
+                         cube.interpolate([('latitude', 51.25), ('longitude', 6.25)],
+                                          iris.analysis.Linear()))
+    data.check_same_data(results['points'],
+                         coord.interpolate_points(cube, areas['points']['points']))
+
+    results = coord.extract_areas(cube, {'box': BOXES['box']}, average_area=False)
+    data.check_same_data(results['box'], cube.extract(coord.parse_area(BOXES['box'])[0]))
@@ -0,0 +1,71 @@
+"""Tests for kcs.extraction"""
+
+import dask
+import iris
+import numpy as np
+import pytest
+from kcs.extraction import core
+from kcs.utils.coord import extract_areas
+from kcs.tests import data
+
+
+AREAS = {'global': None, 'point': {'latitude': 51.25, 'longitude': 6.25},
+         'box': {'latitude': [40, 60], 'longitude': [0, 30]}}
+
+
+def check_same_cubes(cubes, expected):
+    """Check that two cubes have the same data (including the mask) and coordinates"""
+
+    assert cubes.name() == expected.name() and cubes.units == expected.units
+    data.check_same_data(cubes, expected)
+    assert [coord.name() for coord in cubes.coords()] == \
+        [coord.name() for coord in expected.coords()]
+    for coord in expected.coords():
+        np.testing.assert_array_equal(cubes.coord(coord.name()).points, coord.points)
+
+
+def test_shared_memory():
+    """A cube passes through shared memory unchanged, including its mask"""
+
+    if core.shared_memory is None:
+        return   # Python < 3.8, or not a POSIX system: temporary files are used
+    for masked in (False, True):
+        cube = data.field(1, masked=masked)
+        record = core.to_shared_memory(cube.copy())
+        result = core.from_shared_memory(record)
+        assert np.ma.isMaskedArray(result.data) == masked
+        check_same_cubes(result, cube)
+
+
+def test_process(tmp_path):
+    """The data returned by worker processes equal those of a single process"""
+
+    # Forked workers can hang on the locks of dask's thread pool, if
+    # that was used in this process before (by other tests): use the
+    # synchronous scheduler, also in the workers
+    with dask.config.set(scheduler='synchronous'):
+        paths = data.save_fields(tmp_path, masked=True)
+        expected = {(item.realization, item.area): item.cube
+                    for item in core.calc(paths, AREAS, save_result=False, nproc=1)}
+        results = core.calc(paths, AREAS, save_result=False, nproc=2, tempdir=tmp_path)
+        assert {(item.realization, item.area) for item in results} == set(expected)
+        for item in results:
+            check_same_cubes(item.cube, expected[item.realization, item.area])
+
+
+def test_extract_windows(tmp_path):
+    """Extracting the areas a window of time steps at a time gives the
+    same cubes as extracting them at once"""
+
+    path = str(data.save_fields(tmp_path, nruns=1, masked=True)[0])
+    for average_area in (True, False):
+        expected = extract_areas(iris.load_cube(path), AREAS, average_area=average_area)
+        for window in (1, 5, 24, 100):
+            cubes = core.extract_windows(iris.load_cube(path), window, AREAS,
+                                         average_area=average_area)
+            assert list(cubes) == list(expected)
+            for name, cube in cubes.items():
+                check_same_cubes(cube, expected[name])
+                assert cube.cell_methods == expected[name].cell_methods
+    with pytest.raises(ValueError):
+        core.extract_windows(iris.load_cube(path), 0, AREAS)
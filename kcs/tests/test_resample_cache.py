@@ -0,0 +1,49 @@
+"""Tests for the stage cache of kcs.resample"""
+
+import numpy as np
+from kcs.resample import core
+from kcs.resample.cache import StageCache, hash_key
+from kcs.tests import data
+
+
+def test_hash_key():
+    """The hash depends on the values, and on the dtype of arrays"""
+
+    values = np.arange(10)
+    assert hash_key('s1', values, 2.5) == hash_key('s1', values.copy(), 2.5)
+    assert hash_key('s1', values, 2.5) != hash_key('s1', values, 2.6)
+    assert hash_key('s1', values) != hash_key('s1', values.astype(np.float64))
+    assert hash_key('s1', 'ab', 'c') != hash_key('s1', 'a', 'bc')
+
+
+def test_stage_cache(tmp_path):
+    """Results are stored and read back; missing or invalid files are ignored"""
+
+    cache = StageCache(tmp_path / 'cache')
+    result = {'control': np.arange(6).reshape(2, 3), 'future': np.arange(4)}
+    assert cache.load('s1', 'abc') is None
+    cache.save('s1', 'abc', result)
+    loaded = cache.load('s1', 'abc')
+    assert all(np.array_equal(loaded[period], values) for period, values in result.items())
+    cache.path('s2', 'abc').write_bytes(b'not a NumPy file')
+    assert cache.load('s2', 'abc') is None
+
+
+def test_calc(tmp_path, monkeypatch):
+    """A rerun of `calc` takes the results of all steps from the cache,
+    also when the scenarios run in parallel"""
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the result should have been taken from the cache")
+
+    args = (data.dataset(), data.steering_table(), data.ranges(), data.PENALTIES)
+    for nproc in (1, 2):
+        kwargs = dict(data.CALC_KWARGS, cache_dir=tmp_path / str(nproc))
+        kwargs['nproc'] = nproc
+        indices, diffs = core.calc(*args, **kwargs)
+        with monkeypatch.context() as patch:
+            for name in ('calculate_s1', 'calculate_s1_control', 'calculate_s3'):
+                patch.setattr(core, name, fail)
+            cached_indices, cached_diffs = core.calc(*args, **kwargs)
+        data.check_same_indices(cached_indices, indices)
+        data.check_same_diffs(cached_diffs, diffs)
@@ -0,0 +1,50 @@
+"""Tests for the resample IDs of kcs.resample"""
+
+import itertools
+import numpy as np
+import pytest
+from kcs.resample.combinations import Combinations, smallest_uint
+
+
+def test_decode():
+    """The IDs follow the order of `itertools.product`"""
+
+    for nsets, nsections in ((1, 3), (2, 5), (5, 3), (7, 1)):
+        combinations = Combinations(nsets, nsections)
+        expected = list(itertools.product(range(nsets), repeat=nsections))
+        assert len(combinations) == len(expected)
+        rows = combinations.decode(range(len(combinations)))
+        np.testing.assert_array_equal(rows, expected)
+        np.testing.assert_array_equal(combinations.decode(combinations.ids()), expected)
+        np.testing.assert_array_equal(combinations.encode(expected), combinations.ids())
+        assert [len(chunk) for chunk in combinations.chunks(4)] == \
+            [4] * (len(expected) // 4) + ([len(expected) % 4] if len(expected) % 4 else [])
+
+
+def test_boundaries():
+    """The IDs use the smallest dtype that fits, and decode and encode
+    are each other's inverse up to the largest ID"""
+
+    for nsets, nsections, dtype in ((2, 8, np.uint8), (2, 9, np.uint16), (256, 1, np.uint8),
+                                    (257, 1, np.uint16), (16, 4, np.uint16),
+                                    (2, 17, np.uint32), (2, 32, np.uint32),
+                                    (2, 33, np.uint64), (2, 64, np.uint64),
+                                    (65536, 2, np.uint32), (65537, 2, np.uint64)):
+        combinations = Combinations(nsets, nsections)
+        assert combinations.dtype == dtype
+        assert combinations.index_dtype == smallest_uint(nsets - 1)
+        last = combinations.size - 1
+        # The first and last IDs, and those around the dtype boundaries
+        ids = {0, 1, last // 2, last - 1, last}
+        for bits in (8, 16, 32):
+            ids |= {min(2**bits - 1, last), min(2**bits, last)}
+        ids = np.array(sorted(ids), dtype=dtype)
+        rows = combinations.decode(ids)
+        assert rows.dtype == combinations.index_dtype
+        assert rows.max() < nsets
+        encoded = combinations.encode(rows)
+        assert encoded.dtype == dtype
+        np.testing.assert_array_equal(encoded, ids)
+    np.testing.assert_array_equal(Combinations(2, 64).decode([2**64 - 1]), np.ones((1, 64)))
+    with pytest.raises(ValueError):
+        Combinations(2, 65)
@@ -0,0 +1,66 @@
+"""Tests for the output of the resampled data of kcs.resample"""
+
+import h5py
+import pytest
+from kcs.resample import core
+from kcs.resample.__main__ import ResamplesWriter, load_resamples, save_resamples
+from kcs.tests import data
+
+
+def test_round_trip(tmp_path, monkeypatch):
+    """The resampled data are read back as calculated, also when
+    written from the `calc` callback"""
+
+    monkeypatch.chdir(tmp_path)
+    args = (data.dataset(), data.steering_table(), data.ranges(), data.PENALTIES)
+    with ResamplesWriter(tmp_path / 'stream.h5') as writer:
+        _, diffs = core.calc(*args, callback=writer.write, **data.CALC_KWARGS)
+    save_resamples(tmp_path / 'resamples.h5', diffs, as_csv=True)
+    for filename in ('stream.h5', 'resamples.h5'):
+        data.check_same_diffs(load_resamples(tmp_path / filename), diffs)
+    assert len(list(tmp_path.glob('resampled_*.csv'))) == sum(
+        len(seasons) for variables in diffs.values() for seasons in variables.values())
+
+
+def test_keep_file(tmp_path):
+    """An existing file is kept if no results are written"""
+
+    path = tmp_path / 'resamples.h5'
+    path.write_text('previous results')
+    with pytest.raises(RuntimeError):
+        with ResamplesWriter(path):
+            raise RuntimeError("failed calculation")
+    assert path.read_text() == 'previous results'
+
+
+def test_write_error(tmp_path):
+    """A write error is raised at the end, unless another exception is
+    already raised"""
+
+    diffs = {'pr': {'djf': None}}   # Not a DataFrame: fails to write
+    with pytest.raises(KeyError, match='calculation'):
+        with ResamplesWriter(tmp_path / 'resamples.h5') as writer:
+            writer.write(('2050', 'G', 'L'), diffs)
+            raise KeyError('calculation')
+    with pytest.raises(AttributeError):
+        with ResamplesWriter(tmp_path / 'resamples.h5') as writer:
+            writer.write(('2050', 'G', 'L'), diffs)
+
+
+def test_old_layout(tmp_path):
+    """Files with a group per scenario, variable and season are read as well"""
+
+    args = (data.dataset(), data.steering_table(), data.ranges(), data.PENALTIES)
+    _, diffs = core.calc(*args, **data.CALC_KWARGS)
+    with h5py.File(tmp_path / 'resamples.h5', 'w') as h5file:
+        for key, variables in diffs.items():
+            for var, seasons in variables.items():
+                for season, diff in seasons.items():
+                    group = h5file.create_group("/".join(key + (var, season)))
+                    group.create_dataset('diff', data=diff.values)
+                    group.create_dataset('mean', data=diff.mean(axis=0))
+                    group.create_dataset('std', data=diff.std(axis=0))
+                    # pylint: disable=no-member
+                    group.create_dataset('keys', data=list(diff.columns),
+                                         dtype=h5py.string_dtype())
+    data.check_same_diffs(load_resamples(tmp_path / 'resamples.h5'), diffs)
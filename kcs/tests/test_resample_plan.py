@@ -0,0 +1,77 @@
+"""Tests for the choice of the step 1 method in kcs.resample"""
+
+from kcs.resample import core, plan
+from kcs.resample.plan import Estimate
+from kcs.tests import data
+
+
+# Fixed timings (scoring a resample, and sorting per n log2(n)), instead of a benchmark
+TIMINGS = (1e-7, 1e-8)
+
+
+def test_choose():
+    """The fastest method within the memory limit is chosen; ties go to
+    the simplest method, then the fewest processes. If nothing fits,
+    the method with the least memory use is chosen."""
+
+    estimates = [Estimate('full', 1, 800, 2.0), Estimate('full', 4, 800, 1.0),
+                 Estimate('stream', 1, 100, 3.0), Estimate('stream', 4, 400, 1.0),
+                 Estimate('mitm', 1, 200, 1.5)]
+    assert plan.choose(estimates) == Estimate('full', 4, 800, 1.0)
+    assert plan.choose(estimates, 500) == Estimate('stream', 4, 400, 1.0)
+    assert plan.choose(estimates, 300) == Estimate('mitm', 1, 200, 1.5)
+    assert plan.choose(estimates, 50) == Estimate('stream', 1, 100, 3.0)
+    assert plan.choose(estimates[:1] + [Estimate('full', 2, 800, 2.0)]) == estimates[0]
+
+
+def test_estimate():
+    """The estimates for fixed timings select the meet-in-the-middle
+    search, unless that does not fit in memory"""
+
+    estimates = plan.estimate(30, 8, 1000, nscenarios=4, nperiods=2, nproc=4,
+                              chunksize=100_000, timings=TIMINGS)
+    assert {(item.method, item.nproc) for item in estimates} == {
+        ('full', 1), ('full', 4), ('stream', 1), ('stream', 4),
+        ('index', 1), ('index', 4), ('mitm', 1)}
+    assert plan.choose(estimates, 1e9)[:2] == ('mitm', 1)
+    assert plan.choose(estimates, 1e7)[:2] == ('stream', 1)
+    full = [item for item in estimates if item.method == 'full']
+    # Scores, sort order and (uint64) IDs of all resamples
+    assert all(item.memory == 30**8 * (8 + 8 + 8) for item in full)
+
+
+def test_memory_limit(monkeypatch):
+    """A zero memory limit means half of the physical memory; without
+    known physical memory, there is no limit"""
+
+    monkeypatch.setattr(plan, 'benchmark', lambda nruns, nsections: TIMINGS)
+    monkeypatch.setattr(plan, 'physical_memory', lambda: 64e6)
+    estimates = plan.estimate(30, 8, 1000, 1, 1, nproc=1, chunksize=100_000, timings=TIMINGS)
+    chosen, report = plan.plan_step1(30, 8, nstep1=1000, nproc=1, chunksize=100_000,
+                                     memory_limit=0)
+    assert chosen == plan.choose(estimates, 32e6)
+    assert chosen.method == 'stream'
+    assert "Memory limit: 0.03 GB" in report
+    chosen, _ = plan.plan_step1(30, 8, nstep1=1000, nproc=1, chunksize=100_000,
+                                memory_limit=1)
+    assert chosen == plan.choose(estimates, 1e9)
+    assert chosen.method == 'mitm'
+    monkeypatch.setattr(plan, 'physical_memory', lambda: None)
+    chosen, report = plan.plan_step1(30, 8, nstep1=1000, nproc=1, chunksize=100_000,
+                                     memory_limit=0)
+    assert chosen == plan.choose(estimates)
+    assert "Memory limit" not in report
+
+
+def test_auto(monkeypatch):
+    """Whichever method "auto" chooses, the resamples are those of the
+    "full" method"""
+
+    args = (data.dataset(), data.steering_table(), data.ranges(), data.PENALTIES)
+    full, _ = core.calc(*args, step1_method='full', **data.CALC_KWARGS)
+    data.check_same_indices(core.calc(*args, step1_method='auto', **data.CALC_KWARGS)[0], full)
+    for method in plan.METHODS:
+        monkeypatch.setattr(plan, 'choose', lambda estimates, memory_limit=None, method=method:
+                            Estimate(method, 1, 0, 0.0))
+        auto, _ = core.calc(*args, step1_method='auto', **data.CALC_KWARGS)
+        data.check_same_indices(auto, full)
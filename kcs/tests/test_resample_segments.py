@@ -0,0 +1,191 @@
+"""Tests for the segmentation of the data in kcs.resample, the segment
+averages, and the memory-mapped segment files"""
+
+import os
+import iris
+import numpy as np
+import pytest
+from kcs.resample import core
+from kcs.resample.segments import SegmentMeans, segment_means
+from kcs.tests import data
+
+
+def dated(first, last, var='pr'):
+    """Return a time series whose values are the year times 100 plus the
+    month, for the years `first` up to `last` (inclusive)"""
+
+    return data.monthly([year * 100 + month for year in range(first, last + 1)
+                         for month in range(1, 13)], first, var)
+
+
+def check_equal(segments, expected):
+    """Check that two sets of segmented data (dicts with seasons as keys) are the same"""
+
+    assert list(segments) == list(expected)
+    for season, values in expected.items():
+        np.testing.assert_array_equal(segments[season], values)
+
+
+def test_segment_means():
+    """Segments are averaged over time, ignoring NaN padding"""
+
+    nan = np.nan
+    segments = np.array([[[1, 2, 3, nan], [4, 4, 4, 4]], [[0, nan, nan, nan], [1, 3, nan, nan]]])
+    np.testing.assert_array_equal(segment_means(segments), [[2, 4], [0, 2]])
+    np.testing.assert_array_equal(segment_means(segments[:, 1:, :2]), [[4], [2]])
+
+
+def test_segment_data():
+    """The segments of runs of different length are padded with NaN; the
+    averages are those of the available time steps"""
+
+    # The second run ends a year before the end of the last section
+    cubes = [dated(2000, 2009), dated(2000, 2007)]
+    segments = core.segment_data(cubes, (2000, 2008), (2000, 2008), 3, seasons=['djf', 'jja'])
+    djf = segments['djf']['future']
+    # Three years of Jan, Feb and Dec per section
+    assert djf.shape == (2, 3, 9)
+    assert np.isnan(djf[1, 2, 6:]).all() and not np.isnan(djf[1, 2, :6]).any()
+    assert not np.isnan(djf[0]).any() and not np.isnan(djf[1, :2]).any()
+    np.testing.assert_array_equal(djf[0, 0], [200001, 200002, 200012, 200101, 200102,
+                                              200112, 200201, 200202, 200212])
+
+    means = core.calc_means({'pr': segments}, seasons=['djf', 'jja'])
+    assert (means.nruns, means.nsections) == (2, 3)
+    # The average month of Jan, Feb and Dec is 5, of Jun, Jul and Aug 7
+    np.testing.assert_array_equal(means.get('pr', 'djf', 'future'),
+                                  [[200105, 200405, 200705], [200105, 200405, 200655]])
+    np.testing.assert_array_equal(means.get('pr', 'jja', 'control'),
+                                  [[200107, 200407, 200707], [200107, 200407, 200657]])
+    # The standard deviation of one section of the months (1, 2, 12) of
+    # three consecutive years
+    std = np.std([month + 100 * year for year in range(3) for month in (1, 2, 12)])
+    np.testing.assert_allclose(means.statistic('std', 'pr', 'djf', 'future')[:, :2], std,
+                               rtol=1e-6)
+
+    stored = SegmentMeans(['pr'], ['djf', 'jja'], means.values)
+    assert stored.get('pr', 'jja', 'future') is not None
+    with pytest.raises(ValueError):
+        stored.statistic('std', 'pr', 'djf', 'future')
+
+
+def test_segment_period(tmp_path, monkeypatch):
+    """The memory-mapped segments equal the in-memory ones, and are
+    reused without reading the data again, until an input file changes"""
+
+    paths = data.save_timeseries(tmp_path)
+    cubes = [iris.load_cube(str(path)) for path in paths]
+    assert all(cube.has_lazy_data() for cube in cubes)
+    runs = core.read_runs(cubes)
+    expected = core.segment_period(runs, data.REFERENCE_PERIOD, 3)
+    directory = tmp_path / 'memmap'
+    segments = core.segment_period(runs, data.REFERENCE_PERIOD, 3, directory=directory,
+                                   paths=paths)
+    check_equal(segments, expected)
+    assert all(isinstance(values, np.memmap) for values in segments.values())
+    assert all(cube.has_lazy_data() for cube in cubes)
+    files = sorted(directory.glob('*.npy'))
+    assert len(files) == len(expected)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the data should not be read again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(core, 'read_run', fail)
+        check_equal(core.segment_period(runs, data.REFERENCE_PERIOD, 3, directory=directory,
+                                        paths=paths), expected)
+
+    stat = os.stat(paths[0])
+    os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    check_equal(core.segment_period(runs, data.REFERENCE_PERIOD, 3, directory=directory,
+                                    paths=paths), expected)
+    assert len(list(directory.glob('*.npy'))) == 2 * len(files)
+
+
+def test_segment_period_data(tmp_path):
+    """Without input files, the memory-mapped files are keyed on the data"""
+
+    runs = core.read_runs([data.timeseries('pr', run) for run in range(3)])
+    expected = core.segment_period(runs, data.REFERENCE_PERIOD, 3)
+    for _ in range(2):
+        check_equal(core.segment_period(runs, data.REFERENCE_PERIOD, 3, directory=tmp_path),
+                    expected)
+    assert len(list(tmp_path.glob('*.npy'))) == len(expected)
+
+
+def points(cube, npoints=3):
+    """Return a (time, point) cube with `npoints` multiples (1 to
+    `npoints` times) of the time series `cube`"""
+
+    values = cube.data[:, np.newaxis] * np.arange(1, npoints + 1, dtype=np.float32)
+    result = iris.cube.Cube(values, var_name=cube.var_name,
+                            dim_coords_and_dims=[(cube.coord('time'), 0)])
+    for name in ('season', 'year'):
+        result.add_aux_coord(cube.coord(name), 0)
+    return result
+
+
+def test_segment_period_points():
+    """For cubes with more dimensions than time, the segments contain
+    all values of their time steps"""
+
+    cubes = [data.timeseries('pr', run) for run in range(3)]
+    expected = core.segment_period(core.read_runs(cubes), data.REFERENCE_PERIOD, 3)
+    segments = core.segment_period(core.read_runs([points(cube) for cube in cubes]),
+                                   data.REFERENCE_PERIOD, 3)
+    for season, values in expected.items():
+        assert segments[season].shape == values.shape[:2] + (3 * values.shape[2],)
+        np.testing.assert_array_equal(segments[season][..., ::3], values)
+        np.testing.assert_allclose(np.nanmean(segments[season], axis=-1),
+                                   2 * np.nanmean(values, axis=-1), rtol=1e-6)
+
+
+def test_calc(tmp_path):
+    """`calc` gives the same resamples with and without memory-mapped files"""
+
+    args = (data.dataset(), data.steering_table(), data.ranges(), data.PENALTIES)
+    indices, _ = core.calc(*args, **data.CALC_KWARGS)
+    memmap_indices, _ = core.calc(*args, memmap_dir=tmp_path, **data.CALC_KWARGS)
+    data.check_same_indices(memmap_indices, indices)
+
+
+def test_prepare_scenarios(tmp_path, monkeypatch):
+    """Periods that scenarios have in common are segmented once, and
+    their segments are shared; the averages are the same as without
+    sharing, and with memory-mapped segments"""
+
+    dataset = data.dataset()
+    table = data.steering_table()
+    table['period'] = [(2036, 2065), (2041, 2070)]
+
+    calls = []
+
+    def segment_period(runs, years, *args, **kwargs):
+        calls.append(tuple(years))
+        return period(runs, years, *args, **kwargs)
+
+    period = core.segment_period
+    with monkeypatch.context() as patch:
+        patch.setattr(core, 'segment_period', segment_period)
+        segments, _, means = core.prepare_scenarios(dataset, table, 3, data.REFERENCE_PERIOD)
+    # Both variables for the control period and the two future periods
+    assert sorted(calls) == sorted(2 * [data.REFERENCE_PERIOD, (2036, 2065), (2041, 2070)])
+    low, high = segments[('2050', 'G', 'L')], segments[('2050', 'G', 'H')]
+    for var in ('tas', 'pr'):
+        for season, values in low[var].items():
+            assert values['control'] is high[var][season]['control']
+            assert values['future'] is not high[var][season]['future']
+
+    for _, row in table.iterrows():
+        key = ('2050', 'G', row['subscenario'])
+        _, _, expected, _ = core.prepare_data(dataset, ['tas', 'pr'], row['period'],
+                                              data.REFERENCE_PERIOD, 3)
+        assert means[key].values.tobytes() == expected.values.tobytes()
+
+    for _ in range(2):
+        _, _, memmap_means = core.prepare_scenarios(dataset, table, 3, data.REFERENCE_PERIOD,
+                                                    directory=tmp_path)
+        for key, value in means.items():
+            assert memmap_means[key].values.tobytes() == value.values.tobytes()
+    # Both variables for three periods and four seasons
+    assert len(list(tmp_path.glob('*.npy'))) == 2 * 3 * 4
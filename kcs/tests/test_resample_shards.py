@@ -0,0 +1,74 @@
+"""Tests for the sharded step 1 of kcs.resample"""
+
+import numpy as np
+import pytest
+from kcs.resample import core, shards
+from kcs.resample.combinations import Combinations
+from kcs.resample.step1 import select_closest
+from kcs.tests import data
+
+
+def test_parse_shard():
+    """Shards are given as 'i/n', with i from 1 to n"""
+
+    assert shards.parse_shard(' 2 / 5') == (2, 5)
+    for text in ('0/5', '6/5', '2-5'):
+        with pytest.raises(ValueError):
+            shards.parse_shard(text)
+
+
+def test_merge():
+    """Merging the results of all shards gives the result of a streaming
+    selection over the whole combination space"""
+
+    rng = np.random.default_rng(1)
+    combinations = Combinations(6, 4)
+    # Few distinct values, so that the merge has to order ties by ID
+    values = rng.integers(0, 4, (6, 4)).astype(np.float32)
+    nshards, nselect = 3, 50
+    results = []
+    for shard in range(1, nshards + 1):
+        start, stop = shards.shard_range(len(combinations), shard, nshards)
+        results.append({period: select_closest(values, combinations, 1.5, nselect, start=start,
+                                               stop=stop, scores=True)
+                        for period in ('control', 'future')})
+    expected = select_closest(values, combinations, 1.5, nselect)
+    for ids in shards.merge(results, nselect).values():
+        assert np.array_equal(ids, expected)
+
+
+def save_shards(directory, dataset, table, nshards=2):
+    """Calculate and save step 1 for all shards; return the file names"""
+
+    _, indices, means = core.prepare_scenarios(dataset, table, data.CALC_KWARGS['nsections'],
+                                               data.REFERENCE_PERIOD)
+    filenames = []
+    for shard in range(1, nshards + 1):
+        results = shards.calc_shard(means, indices, table, shard, nshards,
+                                    nstep1=data.CALC_KWARGS['nstep1'], nproc=1)
+        filenames.append(directory / f"shard-{shard}.npz")
+        shards.save(filenames[-1], results, shard, nshards)
+    return filenames
+
+
+def test_calc(tmp_path):
+    """`calc` with the merged shard files gives the same resamples as
+    the "stream" step 1 method"""
+
+    dataset, table = data.dataset(), data.steering_table()
+    s1_shards = shards.load(save_shards(tmp_path, dataset, table))
+    args = (dataset, table, data.ranges(), data.PENALTIES)
+    merged, _ = core.calc(*args, s1_shards=s1_shards, **data.CALC_KWARGS)
+    stream, _ = core.calc(*args, step1_method='stream', **data.CALC_KWARGS)
+    data.check_same_indices(merged, stream)
+
+
+def test_calc_mismatch(tmp_path):
+    """Shards calculated for other inputs are refused"""
+
+    dataset, table = data.dataset(), data.steering_table()
+    s1_shards = shards.load(save_shards(tmp_path, dataset, table))
+    kwargs = data.CALC_KWARGS.copy()
+    kwargs['nstep1'] += 1
+    with pytest.raises(ValueError):
+        core.calc(dataset, table, data.ranges(), data.PENALTIES, s1_shards=s1_shards, **kwargs)
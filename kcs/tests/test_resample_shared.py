@@ -0,0 +1,59 @@
+"""Tests for the worker pool of kcs.resample, and the arrays shared with it"""
+
+import numpy as np
+from kcs.resample import core, shared
+from kcs.tests import data
+
+
+def total(key):
+    """Return the sum of a shared array, in a worker process"""
+    return float(shared.get(key).sum())
+
+
+def test_lazy_start():
+    """No worker processes are started if the pool is not used"""
+
+    with shared.WorkerPool(2, {'a': np.arange(4)}) as workers:
+        with shared.pool(2) as active:
+            assert active is workers
+    assert workers.directory is None
+
+
+def test_share_after_start(tmp_path):
+    """Arrays shared after the start of the pool, in memory or
+    memory-mapped, are available in the workers"""
+
+    arrays = {'start': np.arange(10.0), 'later': np.arange(12.0).reshape(3, 4)}
+    np.save(tmp_path / 'mapped.npy', np.full(5, 2.0))
+    arrays['mapped'] = np.load(tmp_path / 'mapped.npy', mmap_mode='r')
+    with shared.WorkerPool(2, {'start': arrays['start']}) as workers:
+        workers.start()
+        workers.share({key: arrays[key] for key in ('later', 'mapped')})
+        assert workers.map(total, list(arrays)) == [value.sum() for value in arrays.values()]
+        for key, value in arrays.items():
+            np.testing.assert_array_equal(shared.get(key), value)
+
+
+def test_to_shared():
+    """Arrays in shared memory are shared as is, without a copy"""
+
+    array = shared.to_shared(np.arange(12.0).reshape(3, 4))
+    assert shared.to_shared(array) is array
+    raw, dtype, shape = shared.share({'a': array})['a']
+    assert np.frombuffer(raw, dtype=dtype).ctypes.data == array.ctypes.data
+    assert shape == array.shape
+    # Part of the shared memory is copied
+    raw, _, _ = shared.share({'a': array[1:]})['a']
+    assert np.frombuffer(raw, dtype=dtype).ctypes.data != array[1:].ctypes.data
+
+
+def test_calc():
+    """`calc` with multiple processes gives the same results as with one"""
+
+    args = (data.dataset(), data.steering_table(), data.ranges(), data.PENALTIES)
+    indices, diffs = core.calc(*args, **data.CALC_KWARGS)
+    kwargs = data.CALC_KWARGS.copy()
+    kwargs['nproc'] = 2
+    parallel_indices, parallel_diffs = core.calc(*args, **kwargs)
+    data.check_same_indices(parallel_indices, indices)
+    data.check_same_diffs(parallel_diffs, diffs)
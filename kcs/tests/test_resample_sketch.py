@@ -0,0 +1,31 @@
+"""Tests for the histogram sketches of kcs.resample"""
+
+import numpy as np
+from kcs.resample.core import STATS, segment_statistics
+from kcs.resample.sketch import sketch_segments, sketch_statistics
+from kcs.tests import data
+
+
+def test_sketch_statistics():
+    """The percentiles are within the given error of the exact ones,
+    as a fraction of the data range; the mean is exact"""
+
+    values = data.segments()
+    rng = np.random.default_rng(2)
+    rows = rng.integers(0, values.shape[0], (40, values.shape[1]))
+    exact = segment_statistics(values, rows)
+    bound = np.nanmax(values) - np.nanmin(values)
+    for error in (0.01, 0.001):
+        stats = sketch_statistics(sketch_segments(values, error), rows,
+                                  list(map(float, STATS[1:])))
+        assert np.allclose(stats[:, 0], exact[:, 0])
+        assert np.all(np.abs(stats[:, 1:] - exact[:, 1:]) <= error * bound)
+
+
+def test_constant():
+    """Constant data give exact statistics"""
+
+    values = np.full((2, 2, 10), 4.0)
+    rows = np.array([[0, 1], [1, 1]])
+    stats = sketch_statistics(sketch_segments(values, 0.01), rows, [5.0, 50.0, 95.0])
+    assert np.allclose(stats, 4.0)
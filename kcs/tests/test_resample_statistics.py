@@ -0,0 +1,70 @@
+"""Tests for the statistics of the resampled data in kcs.resample"""
+
+import numpy as np
+from kcs.resample import core
+from kcs.resample.core import STATS
+
+
+PERCS = np.array(list(map(float, STATS[1:])))
+
+
+def test_segment_statistics():
+    """The statistics are those of all values of the selected segments
+    together, ignoring NaN padding"""
+
+    # Run 0 has the values 1 to 4 in its segments, run 1 the values 5 to 8
+    segments = np.arange(1.0, 9.0).reshape(2, 2, 2)
+    stats = core.segment_statistics(segments, np.array([[0, 1], [1, 0], [0, 0]]))
+    assert stats.shape == (3, len(STATS))
+    # Segments (1, 2) and (7, 8); (5, 6) and (3, 4); (1, 2) and (3, 4)
+    np.testing.assert_allclose(stats[:, 0], [4.5, 4.5, 2.5])
+    np.testing.assert_allclose(stats[0, 1:], [np.percentile([1, 2, 7, 8], perc) for perc in PERCS])
+    np.testing.assert_allclose(stats[2, 1:], 1 + 3 * PERCS / 100)
+
+    # The values 1 to 8, with NaN padding in the second segment of run 1
+    segments = np.full((2, 2, 6), np.nan)
+    segments[0, 0, :4] = [1, 2, 3, 4]
+    segments[1, 1, :4] = [5, 6, 7, 8]
+    stats = core.segment_statistics(segments, np.array([[0, 1]]))
+    np.testing.assert_allclose(stats[0], [4.5] + list(1 + 7 * PERCS / 100))
+
+
+def test_resample(monkeypatch):
+    """Scenarios that share the data and resamples of the control period
+    share their statistics; the differences are calculated per scenario"""
+
+    rng = np.random.default_rng(1)
+    control = rng.normal(size=(4, 3, 10))
+    data = {}
+    indices = {}
+    for i, key in enumerate(['G', 'W']):
+        data[key] = {'pr': {'djf': {'control': control,
+                                    'future': rng.normal(size=(4, 3, 10)) + 2 * i + 5}}}
+        indices[key] = {'data': {'control': np.array([[0, 1, 2], [3, 3, 3]]),
+                                 'future': np.array([[i, 1, 2], [3, 2, i]])}}
+
+    calls = []
+
+    def segment_statistics(segments, rows):
+        calls.append(rows)
+        return statistics(segments, rows)
+
+    statistics = core.segment_statistics
+    monkeypatch.setattr(core, 'segment_statistics', segment_statistics)
+    diffs = core.resample(indices, data, ['pr'], ['djf'], relative=['pr'])
+    # One control and two futures
+    assert len(calls) == 3
+
+    before = statistics(control, indices['G']['data']['control'])
+    for key, value in indices.items():
+        after = statistics(data[key]['pr']['djf']['future'], value['data']['future'])
+        np.testing.assert_allclose(diffs[key]['pr']['djf'].to_numpy(),
+                                   100 * (after - before) / before)
+        assert list(diffs[key]['pr']['djf'].columns) == STATS
+
+    calls.clear()
+    diffs = core.resample(indices, data, ['pr'], ['djf'], relative=[])
+    assert len(calls) == 3
+    np.testing.assert_allclose(diffs['W']['pr']['djf'].to_numpy(),
+                               statistics(data['W']['pr']['djf']['future'],
+                                          indices['W']['data']['future']) - before)
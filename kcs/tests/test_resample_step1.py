@@ -0,0 +1,96 @@
+"""Tests for the step 1 methods of kcs.resample
+
+All methods should give the same ranking as the "full" method,
+which scores and sorts all resamples.
+
+"""
+
+import itertools
+import numpy as np
+from kcs.resample.combinations import Combinations
+from kcs.resample.step1 import rank_indices, s1_ranker, score_indices
+from kcs.tests import data
+
+
+NRUNS, NSECTIONS, NSTEP1 = 5, 4, 40
+
+
+def segment_means(seed=1, ties=False):
+    """Return random segment averages, see `data.segment_means`"""
+    return data.segment_means(NRUNS, NSECTIONS, seed=seed, ties=ties)
+
+
+def best(method, values, indices, target, nproc=1):
+    """Return the best `NSTEP1` resamples, as found with the step 1 `method`"""
+
+    return s1_ranker(indices, nproc, NSTEP1, method, chunksize=37)(values, target)
+
+
+def test_score_indices():
+    """Scoring blocks of resamples gives the scores of the individual
+    resamples, also for blocks that do not divide the number of resamples"""
+
+    values = segment_means()
+    rows = list(itertools.product(range(NRUNS), repeat=NSECTIONS))
+    columns = np.arange(NSECTIONS)
+    # The former calculation, one resample at a time
+    expected = [abs(values[list(row), columns].mean() - 0.3) for row in rows]
+    combinations = Combinations(NRUNS, NSECTIONS)
+    for chunksize in (2, 7, 100, len(rows) - 1, len(rows) + 5):
+        assert len(rows) % chunksize
+        np.testing.assert_array_equal(
+            score_indices(values, combinations, 0.3, chunksize=chunksize), expected)
+        np.testing.assert_array_equal(
+            score_indices(values, np.array(rows), 0.3, chunksize=chunksize), expected)
+    np.testing.assert_array_equal(
+        score_indices(values, combinations, 0.3, nproc=2, chunksize=7), expected)
+
+
+def test_stream():
+    """The streaming method keeps the same best resamples as a full sort"""
+
+    combinations = Combinations(NRUNS, NSECTIONS)
+    for ties in (False, True):
+        values = segment_means(ties=ties)
+        full = rank_indices(values, combinations, 0.5)[:NSTEP1]
+        assert np.array_equal(best('stream', values, combinations, 0.5), full)
+
+
+def test_stream_rows():
+    """The streaming method also works on an array of index rows"""
+
+    values = segment_means(ties=True)
+    rows = Combinations(NRUNS, NSECTIONS).decode(np.arange(200, 500))
+    full = rank_indices(values, rows, 1.0)[:NSTEP1]
+    assert np.array_equal(best('stream', values, rows, 1.0), full)
+    assert np.array_equal(best('stream', values, rows, 1.0, nproc=2), full)
+
+
+def test_mitm():
+    """The meet-in-the-middle search finds the same best resamples as a
+    full sort, also for an odd number of sections"""
+
+    for nsections in (NSECTIONS, 5):
+        combinations = Combinations(NRUNS, nsections)
+        for ties in (False, True):
+            values = np.resize(segment_means(ties=ties), (NRUNS, nsections))
+            for target in (-0.5, 1.0):
+                full = rank_indices(values, combinations, target)[:NSTEP1]
+                assert np.array_equal(best('mitm', values, combinations, target), full)
+
+
+def test_index():
+    """The sorted mean index gives the same best resamples as a full sort,
+    for several targets, also when the index is reused from the cache"""
+
+    combinations = Combinations(NRUNS, NSECTIONS)
+    rows = combinations.decode(np.arange(100, 400))
+    for ties in (False, True):
+        values = segment_means(ties=ties)
+        for indices in (combinations, rows):
+            cache = {}
+            rank = s1_ranker(indices, 1, NSTEP1, 'index', chunksize=37, cache=cache)
+            for target in (-1.0, 0.5, 0.5, 3.0):
+                full = rank_indices(values, indices, target)[:NSTEP1]
+                assert np.array_equal(rank(values, target), full)
+            assert cache
@@ -0,0 +1,98 @@
+"""Tests for step 3 of kcs.resample: the search for the combination
+of resamples with the lowest penalty"""
+
+import itertools
+import math
+import numpy as np
+from kcs.resample.step3 import penalty_lookup, score_selections, calculate_s3
+from kcs.tests import data
+
+
+NSETS, NSECTIONS, NSTEP3 = 5, 4, 4
+PENALTIES = {1: 0.0, 2: 1.0, 3: 4.0, 4: math.inf}
+
+
+def index_rows(nrows=12, seed=1):
+    """Return random index rows, see `data.index_rows`"""
+    return data.index_rows(NSETS, NSECTIONS, nrows=nrows, seed=seed)
+
+
+def penalty(selection):
+    """Calculate the penalty of a single selection of index rows, one
+    section (column) and run at a time"""
+
+    total = 0.0
+    for column in np.asarray(selection).T:
+        for count in np.bincount(column, minlength=NSETS):
+            total += PENALTIES.get(count, math.inf) if count else 0.0
+    return total
+
+
+def test_score_selections():
+    """The batched scoring gives the penalties of the individual selections"""
+
+    rows = index_rows()
+    selections = np.array([rows[list(subset)]
+                           for subset in itertools.combinations(range(len(rows)), NSTEP3)])
+    values = score_selections(selections, penalty_lookup(PENALTIES, NSTEP3), NSETS)
+    assert np.array_equal(values, [penalty(selection) for selection in selections])
+
+
+def lowest_penalty(rows):
+    """Return the lowest penalty of all selections of `NSTEP3` rows"""
+
+    return min(penalty(rows[list(subset)])
+               for subset in itertools.combinations(range(len(rows)), NSTEP3))
+
+
+def check_selection(selection, rows):
+    """Check that `selection` consists of `NSTEP3` different rows of `rows`"""
+
+    positions = [np.flatnonzero((rows == row).all(axis=1))[0] for row in selection]
+    assert len(set(positions)) == NSTEP3
+
+
+def test_exact():
+    """The exact search finds the selection with the lowest penalty"""
+
+    rows = {'control': index_rows(seed=1), 'future': index_rows(seed=2)}
+    result = calculate_s3(rows, PENALTIES, nstep3=NSTEP3, method='exact', nproc=1)
+    for period, selection in result.items():
+        check_selection(selection, rows[period])
+        assert penalty(selection) == lowest_penalty(rows[period])
+
+
+def test_anneal():
+    """Simulated annealing finds the lowest penalty of a small problem"""
+
+    rows = {'control': index_rows(seed=3), 'future': index_rows(seed=4)}
+    result = calculate_s3(rows, PENALTIES, nstep3=NSTEP3, nsample=2000, method='anneal',
+                          seed=1, nchains=1, nproc=1)
+    for period, selection in result.items():
+        check_selection(selection, rows[period])
+        assert penalty(selection) == lowest_penalty(rows[period])
+
+
+def test_seed():
+    """With a seed, the result does not depend on the number of processes"""
+
+    rows = {'control': index_rows(nrows=30, seed=5), 'future': index_rows(nrows=30, seed=6)}
+    results = [calculate_s3(rows, PENALTIES, nstep3=NSTEP3, nsample=200, method=method,
+                            seed=12, nchains=4, nproc=nproc)
+               for method in ('random', 'anneal') for nproc in (1, 3)]
+    for first, second in zip(results[::2], results[1::2]):
+        for period in rows:
+            assert np.array_equal(first[period], second[period])
+
+
+def test_default_nchains():
+    """By default, there is one chain per process"""
+
+    rows = {'control': index_rows(nrows=30, seed=5), 'future': index_rows(nrows=30, seed=6)}
+    for nproc in (1, 3):
+        result = calculate_s3(rows, PENALTIES, nstep3=NSTEP3, nsample=200, method='anneal',
+                              seed=12, nproc=nproc)
+        expected = calculate_s3(rows, PENALTIES, nstep3=NSTEP3, nsample=200, method='anneal',
+                                seed=12, nchains=nproc, nproc=1)
+        for period in rows:
+            assert np.array_equal(result[period], expected[period])
@@ -8,19 +8,51 @@ Handles:
 
 - extract areas from an iris cube
 
+Multiple areas are averaged in a single pass over the data: the area
+weights of all areas are combined in a (cells x areas) weight matrix,
+which is calculated once per grid (and set of areas), and applied to
+all time steps at once.
+
+Area-weighted regridding is done with weights that are calculated once
+per source grid and target grid, and stored on disk, so that later
+files and runs on the same grid reuse them. The weights are separable:
+one matrix for latitude and one for longitude. When the regridded
+areas are averaged, the regridding and averaging are combined in a
+single weight vector on the source grid, so that the regridded field
+itself is never calculated.
+
+Without regridding, only the part of the grid that contains the areas
+(plus one grid cell around it, for interpolation) is read. Areas with
+a list of points (such as stations) are interpolated at all points at
+once.
+
 """
 
+import hashlib
 import logging
+import os
+import pathlib
+import tempfile
 import numpy as np
 import iris
+import iris.analysis
+import iris.analysis.cartography
 import iris.coords
 import iris.coord_categorisation
+import iris.exceptions
 from .constraints import CoordConstraint
+from ..config import default_config
 
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+# Area weight matrices, per grid signature; see `area_weight_matrix`
+_AREA_WEIGHTS = {}
+# Regridding weights, per source grid, target grid and scheme; see `regrid_weights`
+_REGRID_WEIGHTS = {}
+
+
 def fixcoords(cube, realization):
     """Add a number of auxiliary coordinates, and adds bounds for
     longitude and latitude.
@@ -70,7 +102,7 @@ def create_grid():
     logger.info("Creating grid")
     longitude = np.linspace(0.5, 359.5, 360)
     latitude = np.linspace(-89.5, 89.5, 180)
-    data = np.zeros((len(latitude), len(longitude)), dtype=np.float)
+    data = np.zeros((len(latitude), len(longitude)), dtype=float)
     longitude = iris.coords.DimCoord(longitude, standard_name='longitude', units='degrees')
     longitude.guess_bounds()
     latitude = iris.coords.DimCoord(latitude, standard_name='latitude', units='degrees')
@@ -80,9 +112,14 @@ def create_grid():
     return targetgrid
 
 
-def parse_area(area):
-    """Parse areas as defined in the config file & format"""
+def _area_latlon(area):
+    """Return the latitude(s) and longitude(s) of an area definition"""
 
+    if 'points' in area:
+        points = np.asarray(area['points'], dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 2:
+            raise ValueError("points area definition is the wrong format")
+        return points[:, 0], points[:, 1]
     if 'latitude' in area:
         lat = area['latitude']
     elif 'lat' in area:
@@ -100,8 +137,16 @@ def parse_area(area):
     elif 'e' in area and 'w' in area:
         lon = [area['e'], area['w']]
     else:
-        raise KeyError("missing latitude in area definition")
+        raise KeyError("missing longitude in area definition")
+    return lat, lon
+
+
+def parse_area(area):
+    """Parse areas as defined in the config file & format"""
 
+    lat, lon = _area_latlon(area)
+    if 'points' in area:
+        return None, [('latitude', lat), ('longitude', lon)]
     if isinstance(lon, (int, float)) and isinstance(lat, (int, float)):
         return None, [('latitude', lat), ('longitude', lon)]
 
@@ -109,16 +154,540 @@ def parse_area(area):
         raise ValueError("longitude area definition is the wrong format")
     if len(lat) != 2:
         raise ValueError("latitude area definition is the wrong format")
-    lon_constraint = CoordConstraint(area['longitude'][0], area['longitude'][1])
-    lat_constraint = CoordConstraint(area['latitude'][0], area['latitude'][1])
+    lon_constraint = CoordConstraint(min(lon), max(lon))
+    lat_constraint = CoordConstraint(min(lat), max(lat))
     constraint = iris.Constraint(longitude=lon_constraint, latitude=lat_constraint)
     return constraint, None
 
 
+def _latlon_dims(cube):
+    """Return the dimensions of the latitude and longitude dimension
+    coordinates, or None if the cube has no such (rectilinear) grid"""
+
+    try:
+        latdim, = cube.coord_dims(cube.coord('latitude', dim_coords=True))
+        londim, = cube.coord_dims(cube.coord('longitude', dim_coords=True))
+    except (iris.exceptions.CoordinateNotFoundError, ValueError):
+        return None
+    return latdim, londim
+
+
+def _grid_template(cube, dims):
+    """Return a 2D (latitude, longitude) slice of cube, for use with constraints and weights"""
+    return cube[tuple(slice(None) if dim in dims else 0 for dim in range(cube.ndim))]
+
+
+def _cell_areas(cube, dims):
+    """Return the (lat, lon) cell areas: from a cell measure (such as
+    areacella) if available, calculated from the grid otherwise"""
+
+    for measure in cube.cell_measures():
+        if measure.measure == 'area' and tuple(cube.cell_measure_dims(measure)) == dims:
+            logger.debug("Using cell measure %s as area weights", measure.name())
+            areas = np.ma.filled(np.ma.asarray(measure.data, dtype=np.float64), 0)
+            return areas if dims[0] < dims[1] else areas.T
+    template = _grid_template(cube, dims)
+    areas = iris.analysis.cartography.area_weights(template)
+    return areas if dims[0] < dims[1] else areas.T
+
+
+def _area_selection(template, area):
+    """Return the (lat, lon) boolean selection of grid cells within `area`
+
+    `area` is None (global), or a dict that defines a box. Returns None
+    for other area definitions (such as single points).
+
+    """
+
+    lat, lon = template.coord('latitude'), template.coord('longitude')
+    if area is None:
+        return np.ones((len(lat.points), len(lon.points)), dtype=bool)
+    if not isinstance(area, dict):
+        return None
+    constraint, _ = parse_area(area)
+    if constraint is None:
+        return None
+    extracted = template.extract(constraint)
+    if extracted is None:
+        return np.zeros((len(lat.points), len(lon.points)), dtype=bool)
+    latsel = np.isin(lat.points, extracted.coord('latitude').points)
+    lonsel = np.isin(lon.points, extracted.coord('longitude').points)
+    return latsel[:, None] & lonsel[None, :]
+
+
+def _grid_signature(cube, dims, areas):
+    """Return a key that identifies the grid (and cell areas) of a cube, and the areas"""
+
+    digest = hashlib.sha256()
+    for name in ('latitude', 'longitude'):
+        coord = cube.coord(name)
+        digest.update(np.ascontiguousarray(coord.points).tobytes())
+        if coord.bounds is not None:
+            digest.update(np.ascontiguousarray(coord.bounds).tobytes())
+    for measure in cube.cell_measures():
+        if measure.measure == 'area':
+            digest.update(np.ascontiguousarray(np.ma.filled(measure.data, 0)).tobytes())
+    digest.update(repr(dims).encode())
+    digest.update(repr(sorted(areas.items(), key=lambda item: item[0])).encode())
+    return digest.hexdigest()
+
+
+def area_weight_matrix(cube, areas):
+    """Return the weights to average multiple areas of a cube at once
+
+    `areas` is a dict with area names as keys, and None (global) or a
+    box definition as values.
+
+    Returns a tuple with the flat (latitude x longitude) indices of the
+    cells that are within any of the areas, a (len(cells), len(areas))
+    matrix with the (unnormalized) weight of each cell for each area,
+    and a dict with the latitude and longitude selection of each area.
+    Areas that select no or only a single grid cell get no weights, and
+    are left out of the dict.
+
+    The result is cached per grid and set of areas, so that files on
+    the same grid reuse it.
+
+    """
+
+    dims = _latlon_dims(cube)
+    key = _grid_signature(cube, dims, areas)
+    if key in _AREA_WEIGHTS:
+        return _AREA_WEIGHTS[key]
+
+    template = _grid_template(cube, dims)
+    cellareas = _cell_areas(cube, dims)
+    selections = {}
+    for name, area in areas.items():
+        selection = _area_selection(template, area)
+        if selection is None:
+            continue
+        latsel, lonsel = selection.any(axis=1), selection.any(axis=0)
+        if latsel.sum() <= 1 and lonsel.sum() <= 1:
+            # Extraction fails (no cells) or no averaging is needed (one cell)
+            continue
+        selections[name] = (selection, latsel, lonsel)
+
+    inside = np.zeros(cellareas.shape, dtype=bool)
+    for selection, _, _ in selections.values():
+        inside |= selection
+    cells = np.flatnonzero(inside)
+    weights = np.empty((len(cells), len(selections)))
+    for i, (selection, _, _) in enumerate(selections.values()):
+        weights[:, i] = (cellareas * selection).ravel()[cells]
+    selections = {name: (latsel, lonsel) for name, (_, latsel, lonsel) in selections.items()}
+    logger.debug("Calculated area weights for %d areas, over %d grid cells",
+                 len(selections), len(cells))
+    _AREA_WEIGHTS[key] = cells, weights, selections
+    return cells, weights, selections
+
+
+def _cell_bounds(coord):
+    """Return the (sorted) cell bounds of a coordinate, in degrees"""
+
+    coord = coord.copy()
+    coord.convert_units('degrees')
+    if coord.bounds is None:
+        coord.guess_bounds()
+    return np.sort(coord.bounds.astype(np.float64), axis=1)
+
+
+def _overlaps(target, source, latitude):
+    """Return the (ntarget, nsource) overlaps of the cells of two coordinates
+
+    `target` and `source` are the cell bounds. Latitude overlaps are
+    in sin(latitude), which is proportional to the area on the sphere;
+    longitude overlaps are in degrees, and wrap around.
+
+    """
+
+    if latitude:
+        target = np.sin(np.radians(np.clip(target, -90, 90)))
+        source = np.sin(np.radians(np.clip(source, -90, 90)))
+        shifts = (0,)
+    else:
+        shifts = (-360, 0, 360)
+    overlaps = np.zeros((len(target), len(source)))
+    for shift in shifts:
+        overlaps += np.maximum(0, np.minimum(target[:, None, 1], source[None, :, 1] + shift) -
+                               np.maximum(target[:, None, 0], source[None, :, 0] + shift))
+    # Target cells that are not completely covered by source cells get
+    # no weights, since iris masks these
+    complete = np.isclose(overlaps.sum(axis=1), target[:, 1] - target[:, 0], rtol=1e-6, atol=0)
+    overlaps[~complete] = 0
+    return overlaps
+
+
+def regrid_weights(cube, targetgrid, directory=None):
+    """Return the weights for area-weighted regridding of `cube` to `targetgrid`
+
+    The weights are a tuple of a (target, source) latitude and a
+    (target, source) longitude matrix, with the overlaps between the
+    cells of the two grids; target cells outside the source grid have
+    no weights. For a single (latitude, longitude) field
+    `x`, the regridded field is `lat @ x @ lon.T`, divided by the same
+    with `x` all ones (or, for missing values, the valid data
+    mask). This is the same as `iris.analysis.AreaWeighted`.
+
+    The weights are cached in memory per source and target grid. If a
+    `directory` is given, they are also stored there, to be reused by
+    later runs. If `directory` is None, the `regrid_weights` directory
+    from the configuration is used; by default, this is empty, and the
+    weights are not stored. The files are keyed on the cell bounds of
+    both grids, so grids that differ only in their bounds have separate
+    files; files are not removed.
+
+    """
+
+    bounds = [_cell_bounds(grid.coord(name))
+              for grid in (targetgrid, cube) for name in ('latitude', 'longitude')]
+    digest = hashlib.sha256(b'area')
+    for array in bounds:
+        digest.update(repr(array.shape).encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    key = digest.hexdigest()
+    if key in _REGRID_WEIGHTS:
+        return _REGRID_WEIGHTS[key]
+
+    if directory is None:
+        directory = default_config['data']['extraction']['regrid_weights']
+    path = pathlib.Path(directory) / f"regrid-{key}.npz" if directory else None
+    if path is not None and path.exists():
+        logger.debug("Reading regridding weights from %s", path)
+        with np.load(path) as weights:
+            weights = weights['latitude'], weights['longitude']
+    else:
+        logger.debug("Calculating regridding weights")
+        weights = (_overlaps(bounds[0], bounds[2], latitude=True),
+                   _overlaps(bounds[1], bounds[3], latitude=False))
+        if path is not None:
+            # Write to a temporary file first, since other processes
+            # may read (or write) the same file
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz',
+                                             delete=False) as outfile:
+                np.savez(outfile, latitude=weights[0], longitude=weights[1])
+            os.replace(outfile.name, path)
+            logger.debug("Saved regridding weights in %s", path)
+    _REGRID_WEIGHTS[key] = weights
+    return weights
+
+
+def regrid_area_weight_matrix(cube, targetgrid, areas, directory=None):
+    """Return the weights to regrid and average multiple areas of a cube at once
+
+    As `area_weight_matrix`, but for the areas of `cube` regridded to
+    `targetgrid` (area-weighted; see `regrid_weights`). The
+    weights combine the regridding and the averaging, and apply
+    directly to the cells of `cube`. They are only valid for data
+    without missing values.
+
+    """
+
+    latweights, lonweights = regrid_weights(cube, targetgrid, directory)
+    targetcells, targetweights, selections = area_weight_matrix(targetgrid, areas)
+    key = (_grid_signature(cube, _latlon_dims(cube), areas),
+           _grid_signature(targetgrid, _latlon_dims(targetgrid), areas))
+    if key in _AREA_WEIGHTS:
+        return _AREA_WEIGHTS[key]
+
+    # Normalize the regridding weights per target cell. Target cells
+    # that overlap no source cells are left out (as iris masks these)
+    latnorm, lonnorm = latweights.sum(axis=1), lonweights.sum(axis=1)
+    latweights = np.divide(latweights, latnorm[:, None], out=np.zeros_like(latweights),
+                           where=latnorm[:, None] > 0)
+    lonweights = np.divide(lonweights, lonnorm[:, None], out=np.zeros_like(lonweights),
+                           where=lonnorm[:, None] > 0)
+    shape = (len(latweights), len(lonweights))
+    weights = np.empty((latweights.shape[1] * lonweights.shape[1], len(selections)))
+    for i, column in enumerate(targetweights.T):
+        areaweights = np.zeros(shape[0] * shape[1])
+        areaweights[targetcells] = column
+        weights[:, i] = (latweights.T @ areaweights.reshape(shape) @ lonweights).ravel()
+    cells = np.flatnonzero(weights.any(axis=1))
+    logger.debug("Calculated regridding and area weights for %d areas, over %d grid cells",
+                 len(selections), len(cells))
+    _AREA_WEIGHTS[key] = cells, weights[cells], selections
+    return _AREA_WEIGHTS[key]
+
+
+def _regridded_means(data, latweights, lonweights, cellareas, selections):
+    """Regrid and average areas of masked data, for all time steps at once
+
+    `data` is a (time, latitude, longitude) masked array. Only the
+    regridded cells within each area are calculated.
+
+    """
+
+    valid = (~np.ma.getmaskarray(data)).astype(np.float64)
+    values = np.ma.getdata(data).astype(np.float64)
+    values[valid == 0] = 0
+    means = np.empty((len(data), len(selections)))
+    for i, (latsel, lonsel) in enumerate(selections.values()):
+        lat, lon = latweights[latsel], lonweights[lonsel]
+        rows, columns = np.flatnonzero(lat.any(axis=0)), np.flatnonzero(lon.any(axis=0))
+        lat, lon = lat[:, rows], lon[:, columns]
+        index = (slice(None), rows[:, None], columns[None, :])
+        total = lat @ values[index] @ lon.T
+        norm = lat @ valid[index] @ lon.T
+        # Target cells without any valid source data are masked
+        weights = cellareas[np.ix_(latsel, lonsel)] * (norm > 0)
+        regridded = np.divide(total, norm, out=np.zeros_like(total), where=norm > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[:, i] = (regridded * weights).sum(axis=(1, 2)) / weights.sum(axis=(1, 2))
+    return means
+
+
+def average_areas(cube, areas, targetgrid=None, directory=None):
+    """Average multiple areas of a cube, in a single pass over its data
+
+    `areas` is a dict with area names as keys, and None (global) or a
+    box definition as values. The result is the same as extracting
+    each area, and averaging it over latitude and longitude with area
+    weights, where masked values are left out. If the cube has an area
+    cell measure (such as areacella), that is used for the weights.
+
+    If `targetgrid` is given, the areas are averaged as if the cube is
+    first regridded to `targetgrid`, with area-weighted regridding. The
+    regridding weights are stored in `directory` (see
+    `regrid_weights`).
+
+    Returns a dict with the area-averaged cubes for the areas that can
+    be averaged this way: single points, single grid cells and iris
+    Constraints are left out, and should be extracted separately.
+
+    """
+
+    dims = _latlon_dims(cube)
+    if dims is None or not areas:
+        return {}
+    grid = cube
+    if targetgrid is not None:
+        if _latlon_dims(targetgrid) is None:
+            return {}
+        grid = targetgrid
+        cells, weights, selections = regrid_area_weight_matrix(cube, targetgrid, areas,
+                                                               directory)
+    else:
+        cells, weights, selections = area_weight_matrix(cube, areas)
+    if not selections:
+        return {}
+
+    # All other dimensions (usually just time) on the first axis, the
+    # grid cells on the second axis
+    data = np.moveaxis(cube.data, dims, (-2, -1))
+    shape = data.shape[:-2]
+    data = np.ma.asarray(data).reshape(-1, data.shape[-2], data.shape[-1])
+    subset = data.reshape(len(data), -1)[:, cells]
+    mask = np.ma.getmaskarray(subset)
+    values = np.ma.getdata(subset).astype(np.float64)
+    if mask.any() and targetgrid is not None:
+        # Missing values change the regridding weights, per time step
+        means = _regridded_means(data, *regrid_weights(cube, targetgrid, directory),
+                                 _cell_areas(targetgrid, _latlon_dims(targetgrid)),
+                                 selections)
+    else:
+        if mask.any():
+            values[mask] = 0
+            norm = (~mask).astype(np.float64) @ weights
+        else:
+            norm = np.broadcast_to(weights.sum(axis=0), (len(values), weights.shape[1]))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (values @ weights) / norm
+
+    results = {}
+    template = cube[tuple(0 if dim in dims else slice(None) for dim in range(cube.ndim))]
+    if targetgrid is not None:
+        # As with regridding, drop what depends on the source grid
+        for coord in cube.aux_coords:
+            if set(cube.coord_dims(coord)) & set(dims) and template.coords(coord.name()):
+                template.remove_coord(coord.name())
+        for measure in template.cell_measures():
+            template.remove_cell_measure(measure)
+        for coordname in ('latitude', 'longitude'):
+            template.remove_coord(coordname)
+            template.add_aux_coord(targetgrid.coord(coordname)[0])
+    for i, (name, (latsel, lonsel)) in enumerate(selections.items()):
+        result = template.copy(data=np.ma.masked_invalid(means[:, i].reshape(shape)))
+        for coordname, selection in (('latitude', latsel), ('longitude', lonsel)):
+            coord = grid.coord(coordname)[np.flatnonzero(selection)]
+            result.replace_coord(coord.collapsed())
+        result.add_cell_method(iris.coords.CellMethod('mean', coords=('latitude', 'longitude')))
+        results[name] = result
+    return results
+
+
+def _slab_range(points, ranges):
+    """Return the slice of `points` that contains all (lower, upper) `ranges`,
+    plus one point on either side, or a full slice
+
+    A full slice is returned if a range is (partly) outside the points.
+
+    """
+
+    if len(points) < 2 or not ranges:
+        return slice(None)
+    selected = np.zeros(len(points), dtype=bool)
+    for lower, upper in ranges:
+        if lower < points.min() or upper > points.max():
+            return slice(None)
+        selected |= (points >= lower) & (points <= upper)
+        # Add the nearest points outside the range
+        below, above = points < lower, points > upper
+        if below.any():
+            selected[np.flatnonzero(below)[np.argmax(points[below])]] = True
+        if above.any():
+            selected[np.flatnonzero(above)[np.argmin(points[above])]] = True
+    indices = np.flatnonzero(selected)
+    return slice(indices[0], indices[-1] + 1)
+
+
+def area_hyperslab(cube, areas):
+    """Return the index of the smallest part of `cube` that contains all `areas`
+
+    `areas` is a dict as for `extract_areas`. The index selects the
+    latitude and longitude range of the cells within the areas, plus
+    one cell on either side, for (bilinear) interpolation of points.
+    Indexing a cube with lazy data with it reads only that part of the
+    data.
+
+    If an area is global, not a box or point(s), or reaches outside
+    the grid (when longitudes would wrap around, for example), the
+    full range of latitudes and longitudes is used.
+
+    """
+
+    index = [slice(None)] * cube.ndim
+    dims = _latlon_dims(cube)
+    if dims is None:
+        return tuple(index)
+    ranges = {'latitude': [], 'longitude': []}
+    for area in areas.values():
+        if not isinstance(area, dict):
+            return tuple(index)
+        lat, lon = _area_latlon(area)
+        ranges['latitude'].append((np.min(lat), np.max(lat)))
+        ranges['longitude'].append((np.min(lon), np.max(lon)))
+    for name, dim in zip(('latitude', 'longitude'), dims):
+        index[dim] = _slab_range(cube.coord(name).points, ranges[name])
+    logger.debug("Reading latitude range %s and longitude range %s",
+                 index[dims[0]], index[dims[1]])
+    return tuple(index)
+
+
+def _linear_weights(coord, values):
+    """Return the indices of the lower and upper neighbours of `values`
+    on a coordinate, and the weight of the upper neighbour
+
+    As `iris.analysis.Linear`, values outside the coordinate are
+    extrapolated, values of coordinates with a modulus (such as
+    longitude) are wrapped into the range of the coordinate, and
+    circular coordinates wrap around.
+
+    """
+
+    points = coord.points.astype(np.float64)
+    size = len(points)
+    if size < 2:
+        raise ValueError(f"can't interpolate {coord.name()} with a single point")
+    descending = points[0] > points[-1]
+    if descending:
+        points = points[::-1]
+    modulus = float(coord.units.modulus or 0)
+    if coord.circular and modulus:
+        points = np.append(points, points[0] + modulus)
+    if modulus:
+        offset = 0.5 * (points.max() + points.min() - modulus)
+        values = offset + (values - offset) % modulus
+    lower = np.clip(np.searchsorted(points, values, side='right') - 1, 0, len(points) - 2)
+    weight = (values - points[lower]) / (points[lower + 1] - points[lower])
+    upper = (lower + 1) % size
+    if descending:
+        lower, upper = size - 1 - lower, size - 1 - upper
+    return lower, upper, weight
+
+
+def _circular_range(indices, size):
+    """Return the start and length of the shortest (wrapped around) range
+    of `size` positions that contains all `indices`"""
+
+    indices = np.unique(indices)
+    gaps = np.diff(np.append(indices, indices[0] + size))
+    largest = np.argmax(gaps)
+    return indices[(largest + 1) % len(indices)], size - gaps[largest] + 1
+
+
+def interpolate_points(cube, points):
+    """Interpolate a cube bilinearly at multiple (latitude, longitude) points at once
+
+    The result is the same as that of `cube.interpolate` with
+    `iris.analysis.Linear` for each point, but only the grid cells
+    around the points are read, and all points are interpolated at
+    once.
+
+    Returns a cube where the latitude and longitude dimensions are
+    replaced by a single (last) station dimension, with the latitude
+    and longitude of the points as auxiliary coordinates.
+
+    """
+
+    dims = _latlon_dims(cube)
+    if dims is None:
+        raise ValueError("cube has no latitude and longitude dimensions")
+    points = np.asarray(points, dtype=np.float64)
+    latlower, latupper, latweight = _linear_weights(cube.coord('latitude'), points[:, 0])
+    lonlower, lonupper, lonweight = _linear_weights(cube.coord('longitude'), points[:, 1])
+
+    # Read only the latitude rows and (possibly wrapped) longitude
+    # columns between the neighbouring grid cells of all points
+    rows = np.concatenate([latlower, latupper])
+    start, length = _circular_range(np.concatenate([lonlower, lonupper]), cube.shape[dims[1]])
+    pieces = []
+    for columns in (slice(start, start + length), slice(0, start + length - cube.shape[dims[1]])):
+        index = [slice(None)] * cube.ndim
+        index[dims[0]] = slice(rows.min(), rows.max() + 1)
+        index[dims[1]] = columns
+        if columns.stop > columns.start:
+            pieces.append(np.ma.asarray(cube[tuple(index)].data))
+    data = np.moveaxis(np.ma.concatenate(pieces, axis=dims[1]), dims, (-2, -1))
+    latlower, latupper = latlower - rows.min(), latupper - rows.min()
+    lonlower = (lonlower - start) % cube.shape[dims[1]]
+    lonupper = (lonupper - start) % cube.shape[dims[1]]
+
+    values, mask = 0, 0
+    for lat, latw in ((latlower, 1 - latweight), (latupper, latweight)):
+        for lon, lonw in ((lonlower, 1 - lonweight), (lonupper, lonweight)):
+            weight = latw * lonw
+            values = values + weight * np.ma.getdata(data[..., lat, lon]).astype(np.float64)
+            mask = mask + weight * np.ma.getmaskarray(data[..., lat, lon])
+    dtype = cube.dtype if np.issubdtype(cube.dtype, np.floating) else np.float64
+    # As iris, the mask is interpolated as well
+    values = np.ma.array(values.astype(dtype), mask=mask > 0)
+
+    template = cube[tuple(0 if dim in dims else slice(None) for dim in range(cube.ndim))]
+    result = iris.cube.Cube(
+        values,
+        dim_coords_and_dims=[(coord, template.coord_dims(coord)) for coord in template.dim_coords],
+        aux_coords_and_dims=[(coord, template.coord_dims(coord)) for coord in template.aux_coords
+                             if coord.name() not in ('latitude', 'longitude')])
+    result.metadata = template.metadata
+    station = template.ndim
+    result.add_dim_coord(iris.coords.DimCoord(np.arange(len(points)), long_name='station',
+                                              var_name='station'), station)
+    for i, name in enumerate(('latitude', 'longitude')):
+        coord = iris.coords.AuxCoord.from_coord(cube.coord(name))
+        result.add_aux_coord(coord.copy(points=points[:, i], bounds=None), station)
+    return result
+
+
 def extract_areas(cube, areas=None, targetgrid=None, average_area=True, gridscheme='area'):
     """DUMMY DOCSTRING"""
     if areas is None:
         areas = {'global': None}
+    if targetgrid is None:
+        # Only read the part of the data that contains the areas
+        cube = cube[area_hyperslab(cube, areas)]
+    gridcube, scheme = cube, None
     if targetgrid is not None:
         if gridscheme == 'area':
             scheme = iris.analysis.AreaWeighted()
@@ -126,13 +695,28 @@ def extract_areas(cube, areas=None, targetgrid=None, average_area=True, gridsche
             scheme = iris.analysis.Linear()
         else:
             scheme = iris.analysis.Linear()
-        gridcube = cube.regrid(targetgrid, scheme)
+        gridcube = None   # Only regridded when needed, below
+
+    # Average all (box) areas at once; the others are extracted below.
+    # Area-weighted regridding is combined with the averaging.
+    if not average_area:
+        averaged = {}
+    elif gridcube is None and gridscheme == 'area':
+        averaged = average_areas(cube, areas, targetgrid=targetgrid)
     else:
-        gridcube = cube
+        if gridcube is None:
+            gridcube = cube.regrid(targetgrid, scheme)
+        averaged = average_areas(gridcube, areas)
+    if gridcube is None and any(name not in averaged for name in areas):
+        gridcube = cube.regrid(targetgrid, scheme)
 
     cubes = {}
     for name, area in areas.items():
-        excube = gridcube.copy()
+        if name in averaged:
+            logger.info("Averaged area %s", name)
+            cubes[name] = averaged[name]
+            continue
+        excube = gridcube
         if area is not None:
             # pragma pylint: disable=unsupported-membership-test
             # pragma pylint: disable=unsubscriptable-object
@@ -145,6 +729,11 @@ def extract_areas(cube, areas=None, targetgrid=None, average_area=True, gridsche
                 excube = excube.extract(area)
             elif isinstance(area, dict):
                 constraint, coords = parse_area(area)
+                if coords and np.ndim(coords[0][1]) > 0:
+                    logger.info("Interpolating %d points", len(coords[0][1]))
+                    cubes[name] = interpolate_points(excube, np.column_stack(
+                        [values for _, values in coords]))
+                    continue
                 if coords and not constraint:
                     excube = excube.interpolate(coords, iris.analysis.Linear())
                 else:
@@ -163,7 +752,7 @@ def extract_areas(cube, areas=None, targetgrid=None, average_area=True, gridsche
             excube_meanarea = excube.collapsed(['latitude', 'longitude'],
                                                iris.analysis.MEAN, weights=weights)
         else:
-            excube_meanarea = excube
+            excube_meanarea = excube.copy()
         cubes[name] = excube_meanarea
 
     return cubes
@@ -15,6 +15,7 @@ except ImportError:   # Iris 2
 import iris.exceptions
 from ..config import default_config
 from .constraints import CoordConstraint
+from .coord import average_areas, area_hyperslab
 from .attributes import get as get_attrs
 
 
@@ -79,6 +80,10 @@ def extract_areas(cube, areas=None, targetgrid=None, average_area=True, gridsche
     if isinstance(areas, str):
         areas = [areas]
 
+    if targetgrid is None:
+        # Only read the part of the data that contains the areas
+        cube = cube[area_hyperslab(cube, dict(enumerate(areas)))]
+    gridcube, scheme = cube, None
     if targetgrid is not None:
         if gridscheme == 'area':
             scheme = iris.analysis.AreaWeighted()
@@ -86,12 +91,30 @@ def extract_areas(cube, areas=None, targetgrid=None, average_area=True, gridsche
             scheme = iris.analysis.Linear()
         else:
             scheme = iris.analysis.Linear()
-        gridcube = cube.regrid(targetgrid, scheme)
+        gridcube = None   # Only regridded when needed, below
+
+    # Average all (box) areas at once; the others are extracted below.
+    # Area-weighted regridding is combined with the averaging.
+    if not average_area:
+        averaged = {}
+    elif gridcube is None and gridscheme == 'area':
+        averaged = average_areas(cube, dict(enumerate(areas)), targetgrid=targetgrid)
     else:
-        gridcube = cube
+        if gridcube is None:
+            gridcube = cube.regrid(targetgrid, scheme)
+        averaged = average_areas(gridcube, dict(enumerate(areas)))
+    if gridcube is None and len(averaged) < len(areas):
+        gridcube = cube.regrid(targetgrid, scheme)
 
     results = []
-    for area in areas:
+    for i, area in enumerate(areas):
+        if i in averaged:
+            excube = averaged[i]
+            iris.coord_categorisation.add_season(excube, 'time')
+            iris.coord_categorisation.add_season_year(excube, 'time')
+            iris.coord_categorisation.add_year(excube, 'time')
+            results.append(excube)
+            continue
         excube = gridcube.copy()
         if area is not None:
             if isinstance(area, iris.Constraint):